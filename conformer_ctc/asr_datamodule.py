@@ -347,9 +347,12 @@ class MultiVENTAsrDataModule:
         return cuts_train
 
     @lru_cache()
-    def multivent_cuts(self) -> CutSet:
-        logging.info("About to get multiVENT cuts")
-        return load_manifest_lazy(
+    def multivent_cuts_path(self) -> Path:
+        return (
             self.args.manifest_dir
             / f"multivent_cuts_{self.args.event}_{self.args.language}_trimmed_filtered.jsonl.gz"
         )
+
+    def multivent_cuts(self) -> CutSet:
+        logging.info("About to get multiVENT cuts")
+        return load_manifest_lazy(self.multivent_cuts_path())
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This script precompiles the OTC alignment graphs of all supervisions in a
+MultiVENT cut manifest and stores them in a memory-mappable archive, which
+can be passed to ./conformer_ctc/otc_alignment.py with --graph-archive.
+
+Graphs are compiled on CPU in parallel, so that this can run separately
+from the GPU alignment job. It only needs to be rerun when the transcripts
+change; graphs of cuts whose transcript has changed are ignored by the
+alignment script and compiled on the fly.
+
+Usage:
+
+./conformer_ctc/compile_otc_graphs.py \
+  --manifest-dir data/fbank \
+  --event emergency_data \
+  --language en \
+  --lang-dir data/lang_bpe_500 \
+  --num-jobs 16 \
+  --archive-dir conformer_ctc/exp/otc_graphs_emergency_data_en
+"""
+
+import argparse
+import logging
+import multiprocessing
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from lhotse import load_manifest_lazy
+from otc_graph_cache import (
+    OtcGraphArchiveWriter,
+    otc_graph_settings,
+    otc_lang_settings,
+)
+
+from icefall.otc_graph_compiler import OtcTrainingGraphCompiler
+from icefall.utils import str2bool
+
+# Each worker uses a single thread; parallelism comes from the processes.
+torch.set_num_threads(1)
+torch.set_num_interop_threads(1)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--manifest-dir",
+        type=Path,
+        default=Path("data/fbank"),
+        help="Path to directory with the MultiVENT cuts.",
+    )
+
+    parser.add_argument(
+        "--event",
+        type=str,
+        required=True,
+        help="The event name.",
+    )
+
+    parser.add_argument(
+        "--language",
+        type=str,
+        required=True,
+        help="The language of the event.",
+    )
+
+    parser.add_argument(
+        "--lang-dir",
+        type=Path,
+        default=Path("data/lang_bpe_500"),
+        help="The lang dir",
+    )
+
+    parser.add_argument(
+        "--archive-dir",
+        type=Path,
+        required=True,
+        help="The output directory of the graph archive.",
+    )
+
+    parser.add_argument(
+        "--num-jobs",
+        type=int,
+        default=8,
+        help="Number of worker processes.",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64,
+        help="Number of transcripts compiled per call to the graph compiler.",
+    )
+
+    parser.add_argument(
+        "--otc-token",
+        type=str,
+        default="▁<star>",
+        help="OTC token",
+    )
+
+    parser.add_argument(
+        "--allow-bypass-arc",
+        type=str2bool,
+        default=True,
+        help="""Whether to add bypass arc to training graph for substitution
+        and insertion errors (wrong or extra words in the transcript).""",
+    )
+
+    parser.add_argument(
+        "--allow-self-loop-arc",
+        type=str2bool,
+        default=True,
+        help="""Whether to self-loop bypass arc to training graph for deletion errors
+        (missing words in the transcript).""",
+    )
+
+    parser.add_argument(
+        "--bypass-weight",
+        type=float,
+        default=0.0,
+        help="Weight associated with bypass arc",
+    )
+
+    parser.add_argument(
+        "--self-loop-weight",
+        type=float,
+        default=0.0,
+        help="Weight associated with self-loop arc",
+    )
+
+    return parser
+
+
+_graph_compiler = None
+_settings = None
+
+
+def init_worker(lang_dir: Path, otc_token: str, settings: dict) -> None:
+    global _graph_compiler, _settings
+    _graph_compiler = OtcTrainingGraphCompiler(
+        lang_dir,
+        otc_token=otc_token,
+        device=torch.device("cpu"),
+    )
+    _settings = settings
+
+
+def compile_chunk(
+    chunk: List[Tuple[str, str]]
+) -> List[Tuple[str, str, np.ndarray, np.ndarray]]:
+    """Compile the graphs of a list of (cut_id, text) pairs.
+
+    Returns:
+      A list of (cut_id, text, arcs, aux_labels) tuples.
+    """
+    graphs = _graph_compiler.compile(
+        texts=[text for _, text in chunk],
+        **_settings,
+    )
+
+    ans = []
+    for i, (cut_id, text) in enumerate(chunk):
+        graph = graphs[i]
+        ans.append(
+            (
+                cut_id,
+                text,
+                graph.arcs.values().numpy(),
+                graph.aux_labels.to(torch.int32).numpy(),
+            )
+        )
+    return ans
+
+
+def get_chunks(cuts, chunk_size: int):
+    chunk = []
+    for cut in cuts:
+        if len(cut.supervisions) != 1:
+            logging.warning(
+                f"Skipping {cut.id} with {len(cut.supervisions)} supervisions"
+            )
+            continue
+        chunk.append((cut.id, cut.supervisions[0].text))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def main():
+    args = get_parser().parse_args()
+
+    settings = otc_graph_settings(
+        allow_bypass_arc=args.allow_bypass_arc,
+        allow_self_loop_arc=args.allow_self_loop_arc,
+        bypass_weight=args.bypass_weight,
+        self_loop_weight=args.self_loop_weight,
+    )
+    lang_settings = otc_lang_settings(args.lang_dir, args.otc_token)
+    logging.info(f"Graph settings: {settings}, lang settings: {lang_settings}")
+
+    cuts = load_manifest_lazy(
+        args.manifest_dir
+        / f"multivent_cuts_{args.event}_{args.language}_trimmed_filtered.jsonl.gz"
+    )
+
+    num_graphs = 0
+    with OtcGraphArchiveWriter(args.archive_dir, settings, lang_settings) as writer:
+        with multiprocessing.Pool(
+            args.num_jobs,
+            initializer=init_worker,
+            initargs=(args.lang_dir, args.otc_token, settings),
+        ) as pool:
+            for results in pool.imap(
+                compile_chunk, get_chunks(cuts, args.chunk_size)
+            ):
+                for cut_id, text, arcs, aux_labels in results:
+                    writer.write(cut_id, text, arcs, aux_labels)
+                num_graphs += len(results)
+                logging.info(f"Compiled {num_graphs} graphs")
+
+    logging.info(f"Saved {num_graphs} graphs to {args.archive_dir}")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    main()
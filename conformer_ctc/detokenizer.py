@@ -0,0 +1 @@
+../pruned_transducer_stateless7/detokenizer.py
\ No newline at end of file
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This script exports the encoder and the CTC head of the conformer CTC model
+used by ./conformer_ctc/otc_alignment.py, without the attention decoder,
+which is never used for alignment.
+
+Usage:
+
+./conformer_ctc/export.py \
+  --exp-dir conformer_ctc/exp \
+  --lang-dir data/lang_bpe_500
+
+It reads ${exp_dir}/pretrained.pt and generates:
+
+  - ${exp_dir}/cpu_jit_ctc.pt, a TorchScript model
+  - ${exp_dir}/ctc.onnx, an ONNX model
+  - ${exp_dir}/ctc.int8.onnx, the ONNX model with int8 weights
+
+Both models take
+
+  - x, a float32 tensor of shape (N, T, C), the features
+  - x_lens, an int64 tensor of shape (N,), the number of frames of each
+    utterance in x
+
+and return
+
+  - log_probs, a float32 tensor of shape (N, T', num_classes)
+  - log_probs_lens, an int64 tensor of shape (N,)
+
+The ONNX model can be used for alignment with
+
+./conformer_ctc/otc_alignment.py --onnx-model conformer_ctc/exp/ctc.onnx ...
+"""
+
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict, Tuple
+
+import onnx
+import torch
+import torch.nn as nn
+from conformer import Conformer
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from otc_alignment import get_params
+
+from icefall.checkpoint import load_checkpoint
+from icefall.otc_graph_compiler import OtcTrainingGraphCompiler
+from icefall.utils import setup_logger, str2bool
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--exp-dir",
+        type=Path,
+        default=Path("conformer_ctc/exp"),
+        help="The experiment dir containing pretrained.pt",
+    )
+
+    parser.add_argument(
+        "--lang-dir",
+        type=Path,
+        default=Path("data/lang_bpe_500"),
+        help="The lang dir",
+    )
+
+    parser.add_argument(
+        "--otc-token",
+        type=str,
+        default="▁<star>",
+        help="OTC token",
+    )
+
+    parser.add_argument(
+        "--max-frames",
+        type=int,
+        default=5000,
+        help="""Maximum number of output frames (after subsampling) the
+        exported models can process. It determines the size of the
+        positional encoding stored in the models. Longer inputs are
+        rejected.""",
+    )
+
+    parser.add_argument(
+        "--jit",
+        type=str2bool,
+        default=True,
+        help="Whether to export a TorchScript model.",
+    )
+
+    parser.add_argument(
+        "--onnx",
+        type=str2bool,
+        default=True,
+        help="Whether to export an ONNX model and its int8 version.",
+    )
+
+    return parser
+
+
+class CtcModel(nn.Module):
+    """The encoder and the CTC head of a :class:`Conformer`.
+
+    Unlike :meth:`Conformer.forward`, it takes the number of frames of each
+    utterance instead of the lhotse supervisions, and the positional
+    encoding is precomputed, so that it can be scripted and exported to ONNX.
+    """
+
+    def __init__(self, model: Conformer, max_frames: int = 5000):
+        """
+        Args:
+          model:
+            The conformer model. Its attention decoder is not used.
+          max_frames:
+            Maximum number of output frames (after subsampling).
+        """
+        super().__init__()
+        self.feat_scale = 1.0
+        self.feat_batchnorm = nn.Identity()
+        if isinstance(model.use_feat_batchnorm, float):
+            self.feat_scale = model.use_feat_batchnorm
+        elif model.use_feat_batchnorm:
+            self.feat_batchnorm = model.feat_batchnorm
+
+        self.encoder_embed = model.encoder_embed
+        self.encoder = model.encoder
+        self.after_norm = (
+            model.after_norm if model.normalize_before else nn.Identity()
+        )
+        self.output_layer = model.encoder_output_layer
+
+        model.encoder_pos.extend_pe(torch.tensor(0.0).expand(1, max_frames))
+        self.register_buffer("pe", model.encoder_pos.pe.clone())
+        self.xscale = model.encoder_pos.xscale
+
+    def forward(
+        self, x: torch.Tensor, x_lens: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+          x:
+            A 3-D tensor of shape (N, T, C).
+          x_lens:
+            A 1-D int64 tensor of shape (N,).
+        Returns:
+          Return a tuple containing:
+            - log_probs, a 3-D tensor of shape (N, T', num_classes)
+            - log_probs_lens, a 1-D tensor of shape (N,)
+        """
+        x = self.feat_batchnorm(x.permute(0, 2, 1)).permute(0, 2, 1)
+        x = x * self.feat_scale
+
+        x = self.encoder_embed(x)
+        T = x.size(1)
+        # The ONNX model is traced, so this check is done by OnnxCtcModel
+        # with the max_frames of its meta data instead
+        max_frames = self.pe.size(1) // 2 + 1
+        if not torch.jit.is_tracing() and T > max_frames:
+            raise ValueError(
+                f"The input has {T} frames after subsampling, but the model "
+                f"was exported for at most {max_frames}. Please export it "
+                "again with a larger --max-frames."
+            )
+        center = self.pe.size(1) // 2
+        pos_emb = self.pe[:, center - T + 1 : center + T]  # noqa E203
+        x = x * self.xscale
+        x = x.permute(1, 0, 2)  # (N, T, C) -> (T, N, C)
+
+        # Same as encoder_padding_mask() in ./transformer.py
+        log_probs_lens = ((x_lens - 1) // 2 - 1) // 2
+        mask = torch.arange(T, device=x.device).unsqueeze(0) >= (
+            log_probs_lens.unsqueeze(1)
+        )
+
+        x = self.encoder(x, pos_emb, src_key_padding_mask=mask)
+        x = self.after_norm(x)
+
+        x = self.output_layer(x)
+        x = x.permute(1, 0, 2)  # (T, N, C) -> (N, T, C)
+        log_probs = nn.functional.log_softmax(x, dim=-1)
+        return log_probs, log_probs_lens
+
+
+def add_meta_data(filename: str, meta_data: Dict[str, str]):
+    """Add meta data to an ONNX model. It is changed in-place.
+
+    Args:
+      filename:
+        Filename of the ONNX model to be changed.
+      meta_data:
+        Key-value pairs.
+    """
+    model = onnx.load(filename)
+    for key, value in meta_data.items():
+        meta = model.metadata_props.add()
+        meta.key = key
+        meta.value = value
+
+    onnx.save(model, filename)
+
+
+def export_ctc_model_onnx(
+    ctc_model: CtcModel,
+    filename: str,
+    num_features: int,
+    subsampling_factor: int,
+    opset_version: int = 13,
+) -> None:
+    """Export the given CTC model to ONNX format.
+
+    Args:
+      ctc_model:
+        The model to export.
+      filename:
+        The filename to save the exported ONNX model.
+      num_features:
+        The feature dimension.
+      subsampling_factor:
+        The subsampling factor of the model, saved in the meta data.
+      opset_version:
+        The opset version to use.
+    """
+    x = torch.zeros(1, 100, num_features, dtype=torch.float32)
+    x_lens = torch.tensor([100], dtype=torch.int64)
+
+    torch.onnx.export(
+        ctc_model,
+        (x, x_lens),
+        filename,
+        verbose=False,
+        opset_version=opset_version,
+        input_names=["x", "x_lens"],
+        output_names=["log_probs", "log_probs_lens"],
+        dynamic_axes={
+            "x": {0: "N", 1: "T"},
+            "x_lens": {0: "N"},
+            "log_probs": {0: "N", 1: "T"},
+            "log_probs_lens": {0: "N"},
+        },
+    )
+
+    meta_data = {
+        "model_type": "conformer_ctc",
+        "version": "1",
+        "subsampling_factor": str(subsampling_factor),
+        "max_frames": str(ctc_model.pe.size(1) // 2 + 1),
+        "comment": "encoder and CTC head only",
+    }
+    logging.info(f"meta_data: {meta_data}")
+    add_meta_data(filename=filename, meta_data=meta_data)
+
+
+@torch.no_grad()
+def main():
+    args = get_parser().parse_args()
+
+    params = get_params()
+    params.update(vars(args))
+
+    setup_logger(f"{params.exp_dir}/log-export/log-export-ctc")
+    logging.info(params)
+
+    graph_compiler = OtcTrainingGraphCompiler(
+        params.lang_dir,
+        otc_token=params.otc_token,
+        device=torch.device("cpu"),
+    )
+    # remove OTC token as it is actually a fake token (the average of all non-blank tokens)
+    num_classes = graph_compiler.get_max_token_id()
+
+    model = Conformer(
+        num_features=params.feature_dim,
+        nhead=params.nhead,
+        d_model=params.attention_dim,
+        num_classes=num_classes,
+        subsampling_factor=params.subsampling_factor,
+        num_decoder_layers=params.num_decoder_layers,
+        vgg_frontend=params.vgg_frontend,
+        use_feat_batchnorm=params.use_feat_batchnorm,
+    )
+    load_checkpoint(f"{params.exp_dir}/pretrained.pt", model)
+    model.eval()
+
+    ctc_model = CtcModel(model, max_frames=params.max_frames)
+    ctc_model.eval()
+    del model
+
+    num_param = sum([p.numel() for p in ctc_model.parameters()])
+    logging.info(f"Number of parameters of the CTC model: {num_param}")
+
+    if params.jit:
+        filename = params.exp_dir / "cpu_jit_ctc.pt"
+        torch.jit.script(ctc_model).save(str(filename))
+        logging.info(f"Exported TorchScript model to {filename}")
+
+    if params.onnx:
+        filename = params.exp_dir / "ctc.onnx"
+        export_ctc_model_onnx(
+            ctc_model,
+            str(filename),
+            num_features=params.feature_dim,
+            subsampling_factor=params.subsampling_factor,
+        )
+        logging.info(f"Exported ONNX model to {filename}")
+
+        filename_int8 = params.exp_dir / "ctc.int8.onnx"
+        quantize_dynamic(
+            model_input=filename,
+            model_output=filename_int8,
+            op_types_to_quantize=["MatMul"],
+            weight_type=QuantType.QInt8,
+        )
+        logging.info(f"Exported int8 ONNX model to {filename_int8}")
+
+
+if __name__ == "__main__":
+    main()
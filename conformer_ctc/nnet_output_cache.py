@@ -0,0 +1,229 @@
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+
+class NnetOutputCacheWriter(object):
+    """Write the per-cut network output used for OTC alignment (log-probs
+    with the OTC star column appended) to a sharded on-disk cache.
+
+    The cache is a directory containing:
+
+        - shard-xxxxx.bin: raw float32 arrays of shape (num_frames, num_classes),
+          holding the frames of several cuts back to back
+        - index.json: the number of classes and, for each cut ID, the shard
+          number, the frame offset within the shard and the number of frames
+
+    Shards are raw arrays so that they can be opened with `np.memmap`.
+
+    index.json is rewritten after each call to :meth:`write`, once the frames
+    are flushed to the shard, so that a cache left by a crashed run is
+    readable and contains every cut written before the crash.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_frames_per_shard: int = 1000000,
+        resume: bool = False,
+    ):
+        """
+        Args:
+          cache_dir:
+            The cache directory.
+          max_frames_per_shard:
+            A new shard is started when the current one would exceed this
+            number of frames.
+          resume:
+            If True and `cache_dir` contains an index, continue the cache:
+            cuts that are already in it are kept and not written again, and
+            new cuts go to a new shard.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_frames_per_shard = max_frames_per_shard
+
+        self.num_classes = None
+        self.shard_sizes = []
+        self.cuts = {}
+        self.shard_f = None
+
+        index_path = self.cache_dir / "index.json"
+        if resume and index_path.is_file():
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            self.num_classes = index["num_classes"]
+            self.shard_sizes = index["shard_sizes"]
+            self.cuts = index["cuts"]
+            # Drop frames written after the index was last saved
+            for i, num_frames in enumerate(self.shard_sizes):
+                os.truncate(
+                    self.cache_dir / f"shard-{i:05d}.bin",
+                    num_frames * self.num_classes * 4,
+                )
+            logging.info(
+                f"Resuming network output cache {self.cache_dir} "
+                f"with {len(self.cuts)} cuts"
+            )
+
+    def _open_shard(self) -> None:
+        if self.shard_f is not None:
+            self.shard_f.close()
+        shard = len(self.shard_sizes)
+        self.shard_f = open(self.cache_dir / f"shard-{shard:05d}.bin", "wb")
+        self.shard_sizes.append(0)
+
+    def write(
+        self,
+        cut_ids: List[str],
+        nnet_output: torch.Tensor,
+        supervision_segments: torch.Tensor,
+    ) -> None:
+        """
+        Args:
+          cut_ids:
+            Cut ID of each supervision segment. Cuts that are already in the
+            cache of a resumed run are skipped.
+          nnet_output:
+            A 3-D tensor of shape (N, T, C).
+          supervision_segments:
+            A 2-D int32 tensor of shape (num_segments, 3), as passed to
+            :class:`k2.DenseFsaVec`.
+        """
+        if self.num_classes is None:
+            self.num_classes = nnet_output.size(2)
+        assert nnet_output.size(2) == self.num_classes, nnet_output.shape
+
+        nnet_output = nnet_output.to(device="cpu", dtype=torch.float32)
+        T = nnet_output.size(1)
+        for cut_id, (seq, start, duration) in zip(
+            cut_ids, supervision_segments.tolist()
+        ):
+            if cut_id in self.cuts:
+                continue
+            # Same as allow_truncate in k2.DenseFsaVec
+            duration = min(duration, T - start)
+            frames = nnet_output[seq, start : start + duration].contiguous()
+
+            if (
+                self.shard_f is None
+                or self.shard_sizes[-1] + duration > self.max_frames_per_shard
+            ):
+                self._open_shard()
+            self.shard_f.write(frames.numpy().tobytes())
+
+            shard = len(self.shard_sizes) - 1
+            self.cuts[cut_id] = [shard, self.shard_sizes[-1], duration]
+            self.shard_sizes[-1] += duration
+
+        if self.shard_f is not None:
+            self.shard_f.flush()
+        self._save_index()
+
+    def _save_index(self) -> None:
+        # Written to a temporary file first so that a crash never leaves a
+        # truncated index
+        tmp_path = self.cache_dir / "index.json.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "num_classes": self.num_classes,
+                    "shard_sizes": self.shard_sizes,
+                    "cuts": self.cuts,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.cache_dir / "index.json")
+
+    def close(self) -> None:
+        if self.shard_f is not None:
+            self.shard_f.close()
+        self._save_index()
+        logging.info(
+            f"Saved network output of {len(self.cuts)} cuts "
+            f"in {len(self.shard_sizes)} shards to {self.cache_dir}"
+        )
+
+
+class NnetOutputCache(object):
+    """Read-only, memory-mapped view of a cache written by
+    :class:`NnetOutputCacheWriter`."""
+
+    def __init__(self, cache_dir: Path):
+        cache_dir = Path(cache_dir)
+        self.cache_dir = cache_dir
+        with open(cache_dir / "index.json", encoding="utf-8") as f:
+            index = json.load(f)
+
+        self.num_classes = index["num_classes"]
+        self.cuts = index["cuts"]
+        self.shards = [
+            np.memmap(
+                cache_dir / f"shard-{i:05d}.bin",
+                dtype=np.float32,
+                mode="r",
+                shape=(num_frames, self.num_classes),
+            )
+            for i, num_frames in enumerate(index["shard_sizes"])
+        ]
+        logging.info(f"Loaded network output of {len(self.cuts)} cuts from {cache_dir}")
+
+    def __contains__(self, cut_id: str) -> bool:
+        return cut_id in self.cuts
+
+    def read(
+        self,
+        cut_ids: List[str],
+        device: torch.device,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Read the network output of the given cuts.
+
+        Returns:
+          Return a tuple containing:
+            - nnet_output, a 3-D tensor of shape (N, T, C), where N is
+              len(cut_ids) and T is the number of frames of the longest cut
+            - supervision_segments, a 2-D int32 tensor of shape (N, 3)
+        """
+        missing = [cut_id for cut_id in cut_ids if cut_id not in self]
+        if len(missing) > 0:
+            raise KeyError(
+                f"{len(missing)} cuts are not in the network output cache "
+                f"{self.cache_dir}, e.g., {missing[0]}. Write the cache again "
+                "with --load-nnet-output False (and --resume True to keep "
+                "the cuts that are already in it)."
+            )
+        entries = [self.cuts[cut_id] for cut_id in cut_ids]
+        T = max(num_frames for _, _, num_frames in entries)
+
+        nnet_output = torch.zeros(len(cut_ids), T, self.num_classes)
+        for i, (shard, offset, num_frames) in enumerate(entries):
+            frames = self.shards[shard][offset : offset + num_frames]
+            nnet_output[i, :num_frames] = torch.from_numpy(np.array(frames))
+
+        supervision_segments = torch.tensor(
+            [[i, 0, num_frames] for i, (_, _, num_frames) in enumerate(entries)],
+            dtype=torch.int32,
+        )
+        return nnet_output.to(device), supervision_segments
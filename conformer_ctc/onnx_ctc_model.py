@@ -0,0 +1,86 @@
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+
+import onnxruntime as ort
+import torch
+from transformer import Supervisions
+
+
+class OnnxCtcModel(object):
+    """Run a CTC model exported by ./conformer_ctc/export.py with ONNX
+    Runtime on CPU."""
+
+    def __init__(self, filename: str, num_threads: int = 1):
+        """
+        Args:
+          filename:
+            Path to the ONNX model, e.g., ctc.onnx or ctc.int8.onnx.
+          num_threads:
+            Number of intra-op threads of ONNX Runtime.
+        """
+        session_opts = ort.SessionOptions()
+        session_opts.inter_op_num_threads = 1
+        session_opts.intra_op_num_threads = num_threads
+
+        self.session = ort.InferenceSession(
+            filename,
+            sess_options=session_opts,
+            providers=["CPUExecutionProvider"],
+        )
+
+        meta = self.session.get_modelmeta().custom_metadata_map
+        logging.info(f"Loaded {filename}, meta data: {meta}")
+        # Models exported before max_frames was added to the meta data are
+        # not checked
+        self.max_frames = int(meta.get("max_frames", 0))
+        self.filename = filename
+
+    def __call__(self, x: torch.Tensor, supervisions: Supervisions) -> torch.Tensor:
+        """
+        Args:
+          x:
+            A 3-D tensor of shape (N, T, C).
+          supervisions:
+            Supervision in lhotse format, as used by :meth:`Conformer.forward`.
+        Returns:
+          Return the CTC log-probs, a 3-D tensor of shape (N, T', num_classes).
+        """
+        # Number of frames after Conv2dSubsampling
+        T = ((x.size(1) - 1) // 2 - 1) // 2
+        if self.max_frames > 0 and T > self.max_frames:
+            raise ValueError(
+                f"The input has {T} frames after subsampling, but "
+                f"{self.filename} was exported for at most {self.max_frames}. "
+                "Please export it again with a larger --max-frames."
+            )
+
+        # Same as encoder_padding_mask() in ./transformer.py
+        x_lens = torch.zeros(x.size(0), dtype=torch.int64)
+        x_lens[supervisions["sequence_idx"].long()] = (
+            supervisions["start_frame"] + supervisions["num_frames"]
+        ).long()
+
+        log_probs = self.session.run(
+            ["log_probs"],
+            {
+                "x": x.to(device="cpu", dtype=torch.float32).numpy(),
+                "x_lens": x_lens.numpy(),
+            },
+        )[0]
+        return torch.from_numpy(log_probs)
@@ -19,17 +19,30 @@
 
 import argparse
 import logging
-from collections import defaultdict
+import math
+import struct
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import BinaryIO, Dict, Iterator, List, Optional, TextIO, Tuple, Union
 
 import k2
+import numpy as np
 import sentencepiece as spm
 import torch
 import torch.nn as nn
 from asr_datamodule import MultiVENTAsrDataModule
 from conformer import Conformer
+from detokenizer import Detokenizer
 from gigaspeech_scoring import asr_text_post_processing
+from kaldialign import align
+from nnet_output_cache import NnetOutputCache, NnetOutputCacheWriter
+from otc_graph_cache import (
+    OtcGraphArchive,
+    OtcGraphCache,
+    otc_graph_settings,
+    otc_lang_settings,
+)
 
 from icefall.otc_graph_compiler import OtcTrainingGraphCompiler
 from icefall.checkpoint import load_checkpoint
@@ -48,8 +61,6 @@ from icefall.utils import (
     AttributeDict,
     get_texts,
     setup_logger,
-    store_transcripts,
-    write_error_stats,
     str2bool,
 )
 
@@ -169,6 +180,168 @@ def get_parser():
         help="Weight associated with self-loop arc",
     )
 
+    parser.add_argument(
+        "--otc-configs",
+        type=str,
+        default=None,
+        help="""Optional comma-separated list of OTC configurations, each in
+        the form bypass_weight:self_loop_weight, e.g. "0.0:0.0,-1.0:-0.5".
+        The network is run once per batch and its output is aligned against
+        the graph of every configuration, producing one output file per
+        configuration. If not given, --bypass-weight and --self-loop-weight
+        are used.""",
+    )
+
+    parser.add_argument(
+        "--graph-cache-max-arcs",
+        type=int,
+        default=10000000,
+        help="""Maximum total number of arcs of the compiled OTC alignment
+        graphs kept in the in-memory LRU cache. Set it to 0 to disable
+        the cache.""",
+    )
+
+    parser.add_argument(
+        "--graph-archive",
+        type=str,
+        default=None,
+        help="""Optional directory of OTC alignment graphs precompiled with
+        ./conformer_ctc/compile_otc_graphs.py. Graphs are loaded from it by
+        cut ID. Cuts that are missing or whose transcript has changed are
+        compiled on the fly, and so are the chunks of supervisions split by
+        --chunk-frames, whose transcripts are only known at alignment
+        time.""",
+    )
+
+    parser.add_argument(
+        "--nnet-output-cache-dir",
+        type=str,
+        default=None,
+        help="""Optional directory for caching the network output (including
+        the OTC token column) of each cut. See --load-nnet-output.""",
+    )
+
+    parser.add_argument(
+        "--load-nnet-output",
+        type=str2bool,
+        default=False,
+        help="""Used only when --nnet-output-cache-dir is given.
+        If False, the network output is written to the cache; with --resume,
+        a cache left by an interrupted run is continued.
+        If True, the network output is read from the cache and the model is
+        not run at all, which is useful for sweeping --bypass-weight,
+        --self-loop-weight and the search beam.""",
+    )
+
+    parser.add_argument(
+        "--resume",
+        type=str2bool,
+        default=False,
+        help="""Results are written to the output files as soon as each batch
+        is done, and the IDs of the finished cuts are recorded in
+        otc-alignment-${event}_${language}.done. If True, cuts listed there
+        are skipped and new results are appended to the existing output.""",
+    )
+
+    parser.add_argument(
+        "--confidence",
+        type=str2bool,
+        default=False,
+        help="""If True, compute arc posteriors on the alignment lattice and
+        write, for each token of the alignment, its confidence (the posterior
+        of the arc emitting it) and the posterior of the OTC token on the
+        same frame to a binary sidecar file next to the text output, with the
+        suffix .conf. See write_confidence() for the format.""",
+    )
+
+    parser.add_argument(
+        "--ctm",
+        type=str2bool,
+        default=False,
+        help="""If True, also write the start time and duration of each word
+        of the alignment to a CTM file with the suffix .ctm next to the text
+        output. Each line is
+        "<cut_id> 1 <start> <duration> <word> [<confidence>]", with times in
+        seconds relative to the start of the supervision. The confidence is
+        written only when --confidence is True.""",
+    )
+
+    parser.add_argument(
+        "--chunk-frames",
+        type=int,
+        default=0,
+        help="""If positive, supervisions longer than this number of frames
+        (after subsampling) are split into chunks of about this length, which
+        are aligned independently and stitched together. This bounds the
+        memory used by k2.intersect_dense for long recordings.
+        The chunk boundaries are placed at the frames with the highest blank
+        probability, and the transcript is split according to the greedy CTC
+        output of the network.""",
+    )
+
+    parser.add_argument(
+        "--chunk-overlap-frames",
+        type=int,
+        default=25,
+        help="""Used only when --chunk-frames is positive. Number of frames
+        added on each side of a chunk as context. OTC tokens emitted within
+        these frames are dropped when stitching.""",
+    )
+
+    parser.add_argument(
+        "--chunk-search-frames",
+        type=int,
+        default=100,
+        help="""Used only when --chunk-frames is positive. A chunk boundary
+        is searched within this number of frames before the nominal chunk
+        end.""",
+    )
+
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=1,
+        help="""Number of intra-op threads used by the network forward pass
+        when running on CPU.""",
+    )
+
+    parser.add_argument(
+        "--overlap-search",
+        type=str2bool,
+        default=False,
+        help="""If True, the lattice intersection and best-path extraction
+        of each batch run on a separate thread while the network output of
+        the next batch is computed. Useful on CPU, where the search would
+        otherwise leave the intra-op threads idle.""",
+    )
+
+    parser.add_argument(
+        "--adaptive-beam",
+        type=str2bool,
+        default=False,
+        help="""If True, use k2.intersect_dense_pruned with the first search
+        beam in --search-beams instead of k2.intersect_dense. Segments whose
+        lattice is empty are retried with the next, wider beam.""",
+    )
+
+    parser.add_argument(
+        "--search-beams",
+        type=str,
+        default="10,20,40",
+        help="""Used only when --adaptive-beam is True. Comma-separated list
+        of increasing search beams. The output beam is --beam-size.""",
+    )
+
+    parser.add_argument(
+        "--onnx-model",
+        type=str,
+        default=None,
+        help="""If given, the network output is computed on CPU with ONNX
+        Runtime from this model, exported by ./conformer_ctc/export.py,
+        instead of with pretrained.pt. --num-threads sets the number of
+        intra-op threads of ONNX Runtime.""",
+    )
+
     return parser
 
 
@@ -177,6 +350,7 @@ def get_params() -> AttributeDict:
         {
             # parameters for conformer
             "subsampling_factor": 4,
+            "frame_shift_ms": 10,
             "vgg_frontend": False,
             "use_feat_batchnorm": True,
             "feature_dim": 80,
@@ -194,62 +368,143 @@ def get_params() -> AttributeDict:
     return params
 
 
-def align_one_batch(
-    texts: List[str],   
+def get_otc_configs(params: AttributeDict) -> Dict[str, Dict]:
+    """Return the OTC configurations to align with.
+
+    Returns:
+      Return a dict mapping the name of each configuration, e.g.
+      `bypass_-1.0_self_loop_0.0`, to the keyword arguments of
+      :meth:`OtcGraphCache.compile`.
+    """
+    if params.otc_configs is None:
+        weights = [(params.bypass_weight, params.self_loop_weight)]
+    else:
+        weights = []
+        for config in params.otc_configs.split(","):
+            bypass_weight, self_loop_weight = config.split(":")
+            weights.append((float(bypass_weight), float(self_loop_weight)))
+
+    otc_configs = {}
+    for bypass_weight, self_loop_weight in weights:
+        name = f"bypass_{bypass_weight}_self_loop_{self_loop_weight}"
+        otc_configs[name] = otc_graph_settings(
+            allow_bypass_arc=params.allow_bypass_arc,
+            allow_self_loop_arc=params.allow_self_loop_arc,
+            bypass_weight=bypass_weight,
+            self_loop_weight=self_loop_weight,
+        )
+    return otc_configs
+
+
+class NnetOutputBuffer(object):
+    """A buffer for the network output with the OTC token column appended,
+    which is reused across batches to avoid allocating a new (N, T, C + 1)
+    tensor for every batch.
+
+    Caution: The tensor returned by :meth:`get` is overwritten by the next
+    call, so it must not be kept beyond the batch it was created for.
+    """
+
+    def __init__(self):
+        self.data = None
+
+    def get(
+        self, N: int, T: int, C: int, dtype: torch.dtype, device: torch.device
+    ) -> torch.Tensor:
+        """Return an uninitialized tensor of shape (N, T, C)."""
+        numel = N * T * C
+        if (
+            self.data is None
+            or self.data.numel() < numel
+            or self.data.dtype != dtype
+            or self.data.device != device
+        ):
+            self.data = torch.empty(numel, dtype=dtype, device=device)
+        return self.data[:numel].view(N, T, C)
+
+
+def append_otc_log_prob(
+    nnet_output: torch.Tensor,
+    buffer: Optional[NnetOutputBuffer] = None,
+) -> torch.Tensor:
+    """Append the OTC token log-prob to the network output.
+
+    The OTC token log-prob is the log of the average probability of all
+    non-blank tokens, i.e., `logsumexp(nnet_output[:, :, 1:]) - log(V - 1)`.
+    It is written into the last column of the result with `out=`, so that
+    no (N, T, V + 1) tensor is created by `torch.cat`.
+
+    Caution: This does not make the computation allocation-free. `nnet_output`
+    is still copied into the first V columns of the result, and
+    `torch.logsumexp` allocates an (N, T, V - 1) temporary internally.
+    Writing the log-softmax of the model directly into the result would not
+    avoid the copy either, since the first V columns are not contiguous and
+    an `out=` argument with a non-contiguous layout is computed into a
+    temporary and copied.
+
+    Args:
+      nnet_output:
+        A 3-D tensor of shape (N, T, V), the output of log-softmax.
+      buffer:
+        If not None, the result is written to a tensor taken from it.
+    Returns:
+      Return a 3-D tensor of shape (N, T, V + 1).
+    """
+    N, T, V = nnet_output.shape
+    if buffer is None:
+        ans = torch.empty(
+            N, T, V + 1, dtype=nnet_output.dtype, device=nnet_output.device
+        )
+    else:
+        ans = buffer.get(N, T, V + 1, nnet_output.dtype, nnet_output.device)
+
+    ans[:, :, :V].copy_(nnet_output)
+
+    otc_token_log_prob = ans[:, :, V]
+    torch.logsumexp(nnet_output[:, :, 1:], dim=-1, out=otc_token_log_prob)
+    otc_token_log_prob.sub_(math.log(V - 1))
+
+    return ans
+
+
+def compute_nnet_output(
     params: AttributeDict,
     model: nn.Module,
     batch: dict,
-    graph_compiler: OtcTrainingGraphCompiler,
-) -> Dict[str, List[List[str]]]:
-    """Decode one batch and return the result in a dict. The dict has the
-    following format:
-
-        - key: It indicates the setting used for decoding. For example,
-               if no rescoring is used, the key is the string `no_rescore`.
-               If LM rescoring is used, the key is the string `lm_scale_xxx`,
-               where `xxx` is the value of `lm_scale`. An example key is
-               `lm_scale_0.7`
-        - value: It contains the decoding result. `len(value)` equals to
-                 batch size. `value[i]` is the decoding result for the i-th
-                 utterance in the given batch.
-    Args:
-      params:
-        It's the return value of :func:`get_params`.
-
-        - params.method is "1best", it uses 1best alignment without LM rescoring.
+    buffer: Optional[NnetOutputBuffer] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Run the model on one batch and append the OTC token log-prob to its
+    output.
 
+    Args:
       model:
-        The neural model.
-      batch:
-        It is the return value from iterating
-        `lhotse.dataset.K2SpeechRecognitionDataset`. See its documentation
-        for the format of the `batch`.
-      grpah_compiler:
-        OTC graph compiler for OTC alignment.
+        The neural model, or an :class:`OnnxCtcModel`.
+      buffer:
+        Optional buffer for the returned network output. See
+        :class:`NnetOutputBuffer`.
+
     Returns:
-      Return the decoding result. See above description for the format of
-      the returned dict. Note: If it decodes to nothing, then return None.
+      Return a tuple containing:
+        - nnet_output, a 3-D tensor of shape (N, T, C + 1)
+        - supervision_segments, a 2-D int32 tensor of shape (num_segments, 3),
+          as expected by :class:`k2.DenseFsaVec`
     """
-    device = next(model.parameters()).device
-
     feature = batch["inputs"]
     assert feature.ndim == 3
-    feature = feature.to(device)
     # at entry, feature is (N, T, C)
 
     supervisions = batch["supervisions"]
 
-    nnet_output, memory, memory_key_padding_mask = model(feature, supervisions)
+    if isinstance(model, nn.Module):
+        device = next(model.parameters()).device
+        feature = feature.to(device)
+        nnet_output, memory, memory_key_padding_mask = model(feature, supervisions)
+    else:
+        nnet_output = model(feature, supervisions)
     # nnet_output is (N, T, C)
 
     # append OTC log-prob to the end of nnet_output
-    _, _, V = nnet_output.shape
-
-    otc_token_log_prob = torch.logsumexp(
-        nnet_output[:, :, 1:], dim=-1, keepdim=True
-    ) - torch.log(torch.tensor([V - 1])).to(device)
-
-    nnet_output = torch.cat([nnet_output, otc_token_log_prob], dim=-1)
+    nnet_output = append_otc_log_prob(nnet_output, buffer=buffer)
 
     supervision_segments = torch.stack(
         (
@@ -260,38 +515,688 @@ def align_one_batch(
         1,
     ).to(torch.int32)
 
-    alignment_graph = graph_compiler.compile(
-        texts=texts,
-        allow_bypass_arc=params.allow_bypass_arc,
-        allow_self_loop_arc=params.allow_self_loop_arc,
-        bypass_weight=params.bypass_weight,
-        self_loop_weight=params.self_loop_weight,
+    return nnet_output, supervision_segments
+
+
+def get_token_frames(
+    best_path: k2.Fsa,
+    frame_otc_posteriors: Optional[torch.Tensor] = None,
+) -> List[List[Tuple]]:
+    """Extract the emitted tokens and their frame indexes from best paths.
+
+    Args:
+      best_path:
+        An FsaVec of linear FSAs, e.g., the return value of
+        :func:`one_best_decoding`. Its `aux_labels` must be a tensor.
+      frame_otc_posteriors:
+        Optional return value of :func:`get_frame_otc_posteriors`. If given,
+        `best_path` must have the attribute `arc_post` containing the log
+        posterior of each arc, see :func:`align_one_batch`.
+    Returns:
+      Return a list of lists. ans[i] contains a tuple
+      (token_id, frame, num_frames) for each token on the i-th path, where
+      frame is the index of the frame, within the supervision segment, on
+      which the token is emitted, and num_frames is the number of
+      consecutive frames on which the token is repeated, starting from frame.
+      If `frame_otc_posteriors` is given, the tuple is
+      (token_id, frame, num_frames, confidence, otc_prob), where confidence
+      is the posterior of the arc emitting the token and otc_prob is the
+      posterior of the OTC token on that frame.
+    """
+    shape = best_path.arcs.shape()
+    arc_offsets = shape.row_splits(2)[shape.row_splits(1).long()].tolist()
+    labels = best_path.labels.tolist()
+    aux_labels = best_path.aux_labels.tolist()
+
+    def num_frames(a: int, end: int) -> int:
+        n = 1
+        while a + n < end and labels[a + n] == labels[a] and aux_labels[a + n] == 0:
+            n += 1
+        return n
+
+    if frame_otc_posteriors is not None:
+        confidences = best_path.arc_post.exp().tolist()
+        otc_probs = frame_otc_posteriors.tolist()
+
+    ans = []
+    for i in range(len(arc_offsets) - 1):
+        begin, end = arc_offsets[i], arc_offsets[i + 1]
+        arcs = [a for a in range(begin, end) if aux_labels[a] > 0]
+        if frame_otc_posteriors is None:
+            ans.append([(aux_labels[a], a - begin, num_frames(a, end)) for a in arcs])
+        else:
+            ans.append(
+                [
+                    (
+                        aux_labels[a],
+                        a - begin,
+                        num_frames(a, end),
+                        confidences[a],
+                        otc_probs[i][a - begin],
+                    )
+                    for a in arcs
+                ]
+            )
+    return ans
+
+
+def get_frame_otc_posteriors(
+    lattice: k2.Fsa,
+    arc_post: torch.Tensor,
+    otc_token_id: int,
+) -> torch.Tensor:
+    """Compute the posterior of the OTC token on each frame.
+
+    Args:
+      lattice:
+        The lattice returned by :func:`k2.intersect_dense` called with
+        `frame_idx_name="frame_idx"`.
+      arc_post:
+        The log posterior of each arc of the lattice.
+      otc_token_id:
+        ID of the OTC token.
+    Returns:
+      Return a 2-D tensor of shape (num_fsas, T).
+    """
+    shape = lattice.arcs.shape()
+    fsa_idx = shape.row_ids(1)[shape.row_ids(2).long()].long()
+    frame_idx = lattice.frame_idx.long()
+    num_fsas = lattice.shape[0]
+    T = int(frame_idx.max()) + 1 if frame_idx.numel() > 0 else 1
+
+    is_otc = lattice.labels == otc_token_id
+    ans = torch.zeros(num_fsas * T, dtype=arc_post.dtype, device=arc_post.device)
+    ans.index_add_(0, (fsa_idx * T + frame_idx)[is_otc], arc_post[is_otc].exp())
+    return ans.view(num_fsas, T)
+
+
+def get_empty_fsas(fsa_vec: k2.Fsa) -> torch.Tensor:
+    """Return a 1-D bool tensor on CPU telling which FSAs in `fsa_vec` have
+    no states, i.e., which segments failed to align."""
+    row_splits = fsa_vec.arcs.shape().row_splits(1)
+    num_states = row_splits[1:] - row_splits[:-1]
+    return (num_states == 0).cpu()
+
+
+def intersect_with_adaptive_beam(
+    params: AttributeDict,
+    alignment_graph: k2.Fsa,
+    dense_fsa_vec: k2.DenseFsaVec,
+    nnet_output: torch.Tensor,
+    supervision_segments: torch.Tensor,
+    frame_idx_name: Optional[str] = None,
+) -> Tuple[k2.Fsa, int]:
+    """Intersect with :func:`k2.intersect_dense_pruned`, starting with the
+    narrowest beam in `params.search_beams`. Segments whose lattice is empty
+    are intersected again with the next beam, and their new lattices replace
+    the empty ones.
+
+    Args:
+      params:
+        It's the return value of :func:`get_params`.
+      alignment_graph:
+        The alignment graphs, one per segment.
+      dense_fsa_vec:
+        The DenseFsaVec of all segments, built from `nnet_output` and
+        `supervision_segments`.
+      nnet_output:
+        A 3-D tensor of shape (N, T, C).
+      supervision_segments:
+        A 2-D int32 tensor of shape (num_segments, 3).
+      frame_idx_name:
+        Passed to :func:`k2.intersect_dense_pruned`.
+    Returns:
+      Return a tuple containing the lattice, with one FSA per segment in the
+      original order, and the number of retried segments.
+    """
+    search_beams = [float(b) for b in params.search_beams.split(",")]
+    device = alignment_graph.device
+
+    num_retried = 0
+    remaining = torch.arange(supervision_segments.size(0), dtype=torch.int32)
+    parts = []
+    part_indexes = []
+    graphs = alignment_graph
+    for i, search_beam in enumerate(search_beams):
+        if i > 0:
+            num_retried += remaining.numel()
+            graphs = k2.index_fsa(alignment_graph, remaining.to(device))
+            dense_fsa_vec = k2.DenseFsaVec(
+                nnet_output,
+                supervision_segments[remaining.long()],
+                allow_truncate=3,
+            )
+
+        lattice = k2.intersect_dense_pruned(
+            graphs,
+            dense_fsa_vec,
+            search_beam=search_beam,
+            output_beam=params.beam_size,
+            min_active_states=params.min_active_states,
+            max_active_states=params.max_active_states,
+            frame_idx_name=frame_idx_name,
+        )
+
+        is_empty = get_empty_fsas(lattice)
+        if not is_empty.any() or i == len(search_beams) - 1:
+            if i == 0:
+                return lattice, num_retried
+            parts.append(lattice)
+            part_indexes.append(remaining)
+            break
+
+        ok = torch.nonzero(~is_empty).squeeze(1).to(torch.int32)
+        if ok.numel() > 0:
+            parts.append(k2.index_fsa(lattice, ok.to(device)))
+            part_indexes.append(remaining[ok.long()])
+        remaining = remaining[is_empty]
+
+    # Put the lattices back in the original order of the segments
+    order = torch.cat(part_indexes).long()
+    inverse = torch.empty_like(order)
+    inverse[order] = torch.arange(order.numel())
+    lattice = k2.index_fsa(k2.cat(parts), inverse.to(torch.int32).to(device))
+    return lattice, num_retried
+
+
+class AlignmentStats(object):
+    """Per OTC configuration counts of the aligned segments, of the segments
+    retried with a wider beam and of the segments whose lattice is empty.
+    With --chunk-frames, each chunk counts as a segment."""
+
+    def __init__(self):
+        self.num_segments = defaultdict(int)
+        self.num_retried = defaultdict(int)
+        self.num_empty = defaultdict(int)
+
+    def log_stats(self) -> None:
+        for name, num_segments in self.num_segments.items():
+            num_empty = self.num_empty[name]
+            empty_rate = num_empty / num_segments if num_segments > 0 else 0.0
+            logging.info(
+                f"{name}: {num_segments} segments, "
+                f"retried: {self.num_retried[name]}, "
+                f"empty lattices: {num_empty} ({empty_rate:.2%})"
+            )
+
+
+def find_chunk_boundaries(
+    blank_log_probs: torch.Tensor,
+    chunk_frames: int,
+    search_frames: int,
+) -> List[int]:
+    """Return the frames at which a supervision is split into chunks.
+
+    Each boundary is placed at the frame with the highest blank log-prob
+    within the last `search_frames` frames of a chunk.
+
+    Args:
+      blank_log_probs:
+        A 1-D tensor of shape (T,), the blank log-prob of each frame.
+      chunk_frames:
+        Maximum number of frames of a chunk.
+      search_frames:
+        Number of frames searched for a boundary.
+    """
+    T = blank_log_probs.size(0)
+    boundaries = []
+    pos = 0
+    while T - pos > chunk_frames:
+        lo = max(pos + 1, pos + chunk_frames - search_frames)
+        hi = pos + chunk_frames
+        pos = lo + int(blank_log_probs[lo:hi].argmax())
+        boundaries.append(pos)
+    return boundaries
+
+
+def split_text_at_frames(
+    text: str,
+    frame_tokens: List[int],
+    boundaries: List[int],
+    token_table: k2.SymbolTable,
+) -> List[str]:
+    """Split a transcript into len(boundaries) + 1 pieces, according to
+    where the words of the greedy CTC output fall relative to the chunk
+    boundaries.
+
+    Args:
+      text:
+        The transcript.
+      frame_tokens:
+        The token with the highest probability on each frame.
+      boundaries:
+        The chunk boundaries, see :func:`find_chunk_boundaries`.
+      token_table:
+        The token symbol table.
+    """
+    hyp_words = []
+    hyp_word_frames = []
+    prev = 0
+    for t, token in enumerate(frame_tokens):
+        if token != 0 and token != prev:
+            piece = token_table[token]
+            if piece.startswith("▁") or len(hyp_words) == 0:
+                hyp_words.append(piece.lstrip("▁"))
+                hyp_word_frames.append(t)
+            else:
+                hyp_words[-1] += piece
+        prev = token
+
+    ref_words = text.split()
+
+    # ref_index[k] is the number of reference words aligned to or before
+    # the first k words of the greedy output.
+    ref_index = [0]
+    num_ref = 0
+    eps = "<eps>"
+    for ref_word, hyp_word in align(
+        [w.upper() for w in ref_words], [w.upper() for w in hyp_words], eps
+    ):
+        if ref_word != eps:
+            num_ref += 1
+        if hyp_word != eps:
+            ref_index.append(num_ref)
+
+    splits = [0]
+    for b in boundaries:
+        k = sum(1 for t in hyp_word_frames if t < b)
+        splits.append(max(splits[-1], ref_index[k]))
+    splits.append(len(ref_words))
+
+    return [
+        " ".join(ref_words[splits[j] : splits[j + 1]])
+        for j in range(len(splits) - 1)
+    ]
+
+
+def split_into_chunks(
+    params: AttributeDict,
+    nnet_output: torch.Tensor,
+    supervision_segments: torch.Tensor,
+    texts: List[str],
+    cut_ids: List[str],
+    token_table: k2.SymbolTable,
+) -> Tuple[torch.Tensor, List[str], List[str], List[Tuple[int, int, int, int, int]]]:
+    """Split long supervision segments into overlapping chunks.
+
+    Returns:
+      Return a tuple containing:
+        - The supervision segments of the chunks, sorted by duration in
+          decreasing order.
+        - The transcript of each chunk.
+        - The cut ID of each chunk.
+        - For each chunk, a tuple
+          (supervision_index, chunk_index, begin, left_context, num_frames),
+          where chunk_index is the position of the chunk within its
+          supervision, begin is its first frame relative to the supervision,
+          left_context is the number of overlapping frames before the
+          chunk and num_frames is the number of frames the chunk is
+          responsible for.
+    """
+    T = nnet_output.size(1)
+    # exclude the OTC token column
+    V = nnet_output.size(2) - 1
+
+    chunks = []
+    for i, (seq, start, duration) in enumerate(supervision_segments.tolist()):
+        # Same as allow_truncate in k2.DenseFsaVec
+        duration = min(duration, T - start)
+        if duration <= params.chunk_frames:
+            chunks.append(((seq, start, duration), texts[i], (i, 0, 0, 0, duration)))
+            continue
+
+        segment_output = nnet_output[seq, start : start + duration, :V]
+        boundaries = find_chunk_boundaries(
+            segment_output[:, 0],
+            chunk_frames=params.chunk_frames,
+            search_frames=params.chunk_search_frames,
+        )
+        chunk_texts = split_text_at_frames(
+            texts[i],
+            segment_output.argmax(dim=-1).tolist(),
+            boundaries,
+            token_table,
+        )
+
+        edges = [0] + boundaries + [duration]
+        for j, chunk_text in enumerate(chunk_texts):
+            begin = max(0, edges[j] - params.chunk_overlap_frames)
+            end = min(duration, edges[j + 1] + params.chunk_overlap_frames)
+            chunks.append(
+                (
+                    (seq, start + begin, end - begin),
+                    chunk_text,
+                    (i, j, begin, edges[j] - begin, edges[j + 1] - edges[j]),
+                )
+            )
+
+    chunks.sort(key=lambda c: c[0][2], reverse=True)
+
+    chunk_segments = torch.tensor([c[0] for c in chunks], dtype=torch.int32)
+    chunk_texts = [c[1] for c in chunks]
+    chunk_cut_ids = [cut_ids[c[2][0]] for c in chunks]
+    chunk_info = [c[2] for c in chunks]
+    return chunk_segments, chunk_texts, chunk_cut_ids, chunk_info
+
+
+def stitch_chunks(
+    token_frames: List[List[Tuple]],
+    chunk_info: List[Tuple[int, int, int, int, int]],
+    num_supervisions: int,
+    otc_token_id: int,
+) -> List[List[Tuple]]:
+    """Concatenate the tokens of the chunks of each supervision.
+
+    Since the transcripts of the chunks do not overlap, all transcript tokens
+    are kept. OTC tokens emitted on the overlapping frames of a chunk only
+    cover audio that belongs to its neighbours and are dropped.
+
+    Args:
+      token_frames:
+        The return value of :func:`get_token_frames` for the chunks.
+      chunk_info:
+        The last return value of :func:`split_into_chunks`.
+      num_supervisions:
+        Number of supervisions before splitting.
+      otc_token_id:
+        ID of the OTC token.
+    Returns:
+      Return the tokens of each supervision, in the same format as
+      :func:`get_token_frames`, with frames relative to the supervision.
+    """
+    ans = [[] for _ in range(num_supervisions)]
+    for c in sorted(range(len(chunk_info)), key=lambda c: chunk_info[c][:2]):
+        i, _, begin, left_context, num_frames = chunk_info[c]
+        for token in token_frames[c]:
+            t = token[1]
+            if token[0] == otc_token_id and not (
+                left_context <= t < left_context + num_frames
+            ):
+                continue
+            ans[i].append((token[0], begin + t) + token[2:])
+    return ans
+
+
+def prepare_one_batch(
+    texts: List[str],
+    params: AttributeDict,
+    model: nn.Module,
+    batch: dict,
+    graph_compiler: OtcTrainingGraphCompiler,
+    nnet_output_cache: Optional[
+        Union[NnetOutputCache, NnetOutputCacheWriter]
+    ] = None,
+    nnet_output_buffer: Optional[NnetOutputBuffer] = None,
+) -> AttributeDict:
+    """The first stage of :func:`align_one_batch`: compute (or read) the
+    network output and split long supervisions into chunks if needed.
+
+    See :func:`align_one_batch` for the arguments.
+
+    Returns:
+      Return an AttributeDict, which is passed to :func:`search_one_batch`.
+    """
+    supervisions = batch["supervisions"]
+    cut_ids = [cut.id for cut in supervisions["cut"]]
+
+    if isinstance(nnet_output_cache, NnetOutputCache):
+        nnet_output, supervision_segments = nnet_output_cache.read(
+            cut_ids, device=graph_compiler.device
+        )
+    else:
+        nnet_output, supervision_segments = compute_nnet_output(
+            params=params,
+            model=model,
+            batch=batch,
+            buffer=nnet_output_buffer,
+        )
+        if nnet_output_cache is not None:
+            nnet_output_cache.write(cut_ids, nnet_output, supervision_segments)
+
+    chunk_info = None
+    segment_texts = texts
+    segment_cut_ids = cut_ids
+    graph_cut_ids = cut_ids
+    if params.chunk_frames > 0:
+        (
+            supervision_segments,
+            segment_texts,
+            segment_cut_ids,
+            chunk_info,
+        ) = split_into_chunks(
+            params=params,
+            nnet_output=nnet_output,
+            supervision_segments=supervision_segments,
+            texts=texts,
+            cut_ids=cut_ids,
+            token_table=graph_compiler.token_table,
+        )
+        # The transcript of a chunk depends on the network output, so the
+        # graphs of split supervisions cannot be in the graph archive, which
+        # is indexed by cut ID. They are only looked up in the LRU cache.
+        num_chunks = Counter(info[0] for info in chunk_info)
+        graph_cut_ids = [
+            cut_id if num_chunks[info[0]] == 1 else None
+            for cut_id, info in zip(segment_cut_ids, chunk_info)
+        ]
+
+    return AttributeDict(
+        {
+            "texts": texts,
+            "nnet_output": nnet_output,
+            "supervision_segments": supervision_segments,
+            "segment_texts": segment_texts,
+            "segment_cut_ids": segment_cut_ids,
+            "graph_cut_ids": graph_cut_ids,
+            "chunk_info": chunk_info,
+        }
     )
 
+
+def search_one_batch(
+    params: AttributeDict,
+    prepared: AttributeDict,
+    graph_compiler: OtcTrainingGraphCompiler,
+    graph_cache: OtcGraphCache,
+    stats: Optional[AlignmentStats] = None,
+    detokenizer: Optional[Detokenizer] = None,
+) -> Tuple[Dict[str, List[str]], Dict[str, List[List[Tuple]]]]:
+    """The second stage of :func:`align_one_batch`: intersect the network
+    output with the alignment graphs and extract the best paths.
+
+    It does not use the model, so it can run in a different thread than
+    :func:`prepare_one_batch`.
+
+    Args:
+      params:
+        It's the return value of :func:`get_params`.
+      prepared:
+        The return value of :func:`prepare_one_batch`.
+      graph_compiler:
+        OTC graph compiler for OTC alignment.
+      graph_cache:
+        Cache of the compiled OTC alignment graphs.
+      stats:
+        If not None, the segment and empty-lattice counts are added to it.
+      detokenizer:
+        Converts token IDs to text. If None, it is built from the token
+        table of `graph_compiler`.
+    Returns:
+      See :func:`align_one_batch`.
+    """
+    texts = prepared.texts
+    nnet_output = prepared.nnet_output
+    supervision_segments = prepared.supervision_segments
+    segment_texts = prepared.segment_texts
+    segment_cut_ids = prepared.segment_cut_ids
+    chunk_info = prepared.chunk_info
+
     dense_fsa_vec = k2.DenseFsaVec(
         nnet_output,
         supervision_segments,
         allow_truncate=3,
     )
 
-    lattice = k2.intersect_dense(
-        alignment_graph,
-        dense_fsa_vec,
-        params.beam_size,
-    )
+    otc_token_id = graph_compiler.token_table[params.otc_token]
+    if detokenizer is None:
+        detokenizer = Detokenizer.from_symbol_table(graph_compiler.token_table)
+
+    ans = dict()
+    tokens_dict = dict()
+    for name, otc_config in params.otc_configs.items():
+        alignment_graph = graph_cache.compile(
+            texts=segment_texts,
+            cut_ids=prepared.graph_cut_ids,
+            **otc_config,
+        )
 
-    best_path = one_best_decoding(
-        lattice=lattice,
-        use_double_scores=params.use_double_scores,
-    )
+        frame_idx_name = "frame_idx" if params.confidence else None
+        num_retried = 0
+        if params.adaptive_beam:
+            lattice, num_retried = intersect_with_adaptive_beam(
+                params=params,
+                alignment_graph=alignment_graph,
+                dense_fsa_vec=dense_fsa_vec,
+                nnet_output=nnet_output,
+                supervision_segments=supervision_segments,
+                frame_idx_name=frame_idx_name,
+            )
+        else:
+            lattice = k2.intersect_dense(
+                alignment_graph,
+                dense_fsa_vec,
+                params.beam_size,
+                frame_idx_name=frame_idx_name,
+            )
+
+        is_empty = get_empty_fsas(lattice)
+        if is_empty.any():
+            empty_cut_ids = [
+                cut_id
+                for cut_id, empty in zip(segment_cut_ids, is_empty.tolist())
+                if empty
+            ]
+            logging.warning(f"{name}: empty lattice for {empty_cut_ids}")
+        if stats is not None:
+            stats.num_segments[name] += is_empty.numel()
+            stats.num_retried[name] += num_retried
+            stats.num_empty[name] += int(is_empty.sum())
+
+        frame_otc_posteriors = None
+        if params.confidence:
+            arc_post = lattice.get_arc_post(
+                use_double_scores=params.use_double_scores,
+                log_semiring=True,
+            )
+            # Set it before extracting the best path, so that the posteriors
+            # of the arcs on the best path are propagated to it.
+            lattice.arc_post = arc_post
+            frame_otc_posteriors = get_frame_otc_posteriors(
+                lattice, arc_post, otc_token_id
+            )
+
+        best_path = one_best_decoding(
+            lattice=lattice,
+            use_double_scores=params.use_double_scores,
+        )
 
-    hyp = get_texts(best_path)
-    hyp_texts_list = [
-        [graph_compiler.token_table[i] for i in hyp_ids] for hyp_ids in hyp
-    ]
-    hyp_texts = ["".join(text_list).replace("▁", " ") for text_list in hyp_texts_list]
+        if chunk_info is None and not (params.confidence or params.ctm):
+            hyp = get_texts(best_path)
+        else:
+            tokens = get_token_frames(best_path, frame_otc_posteriors)
+            if chunk_info is not None:
+                tokens = stitch_chunks(
+                    token_frames=tokens,
+                    chunk_info=chunk_info,
+                    num_supervisions=len(texts),
+                    otc_token_id=otc_token_id,
+                )
+            if params.confidence or params.ctm:
+                tokens_dict[name] = tokens
+            hyp = [[token[0] for token in utt_tokens] for utt_tokens in tokens]
 
-    return {"otc-alignment": hyp_texts}
+        ans[name] = detokenizer.decode(hyp)
+
+    return ans, tokens_dict
+
+
+def align_one_batch(
+    texts: List[str],   
+    params: AttributeDict,
+    model: nn.Module,
+    batch: dict,
+    graph_compiler: OtcTrainingGraphCompiler,
+    graph_cache: OtcGraphCache,
+    nnet_output_cache: Optional[
+        Union[NnetOutputCache, NnetOutputCacheWriter]
+    ] = None,
+    nnet_output_buffer: Optional[NnetOutputBuffer] = None,
+    stats: Optional[AlignmentStats] = None,
+    detokenizer: Optional[Detokenizer] = None,
+) -> Tuple[Dict[str, List[str]], Dict[str, List[List[Tuple]]]]:
+    """Decode one batch and return the result in two dicts. The first dict
+    has the following format:
+
+        - key: It indicates the OTC configuration used for alignment,
+               i.e., a key of `params.otc_configs`, e.g.
+               `bypass_-1.0_self_loop_0.0`.
+        - value: It contains the decoding result. `len(value)` equals to
+                 batch size. `value[i]` is the decoding result for the i-th
+                 utterance in the given batch.
+
+    The second dict is empty unless params.confidence or params.ctm is True.
+    It has the same keys, and `value[i]` contains the tokens of the i-th
+    utterance in the format of :func:`get_token_frames`, with frames
+    relative to the supervision segment.
+    Args:
+      params:
+        It's the return value of :func:`get_params`.
+
+        - params.method is "1best", it uses 1best alignment without LM rescoring.
+        - params.otc_configs is the return value of :func:`get_otc_configs`.
+          The network is run only once for all configurations.
+
+      model:
+        The neural model.
+      batch:
+        It is the return value from iterating
+        `lhotse.dataset.K2SpeechRecognitionDataset`. See its documentation
+        for the format of the `batch`.
+      grpah_compiler:
+        OTC graph compiler for OTC alignment.
+      graph_cache:
+        Cache of the compiled OTC alignment graphs.
+      nnet_output_cache:
+        If it is a :class:`NnetOutputCache`, the network output is read from
+        it and `model` is not used. If it is a :class:`NnetOutputCacheWriter`,
+        the network output is written to it.
+      nnet_output_buffer:
+        Optional buffer for the network output, reused across batches.
+      stats:
+        Optional :class:`AlignmentStats` to update.
+      detokenizer:
+        Optional :class:`Detokenizer` for the token table of `graph_compiler`.
+    Returns:
+      Return the decoding result. See above description for the format of
+      the returned dicts.
+    """
+    prepared = prepare_one_batch(
+        texts=texts,
+        params=params,
+        model=model,
+        batch=batch,
+        graph_compiler=graph_compiler,
+        nnet_output_cache=nnet_output_cache,
+        nnet_output_buffer=nnet_output_buffer,
+    )
+    return search_one_batch(
+        params=params,
+        prepared=prepared,
+        graph_compiler=graph_compiler,
+        graph_cache=graph_cache,
+        stats=stats,
+        detokenizer=detokenizer,
+    )
 
 
 def align_dataset(
@@ -299,8 +1204,13 @@ def align_dataset(
     params: AttributeDict,
     model: nn.Module,
     graph_compiler: OtcTrainingGraphCompiler,
-) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
-    """Decode dataset.
+    graph_cache: OtcGraphCache,
+    writer: "AlignmentWriter",
+    nnet_output_cache: Optional[
+        Union[NnetOutputCache, NnetOutputCacheWriter]
+    ] = None,
+) -> None:
+    """Decode dataset. Results are written to `writer` after each batch.
 
     Args:
       dl:
@@ -311,12 +1221,12 @@ def align_dataset(
         The neural model.
       graph_compiler:
         The OTC graph compiler for OTC alignment
-    Returns:
-      Return a dict, whose key may be "no-rescore" if no LM rescoring
-      is used, or it may be "lm_scale_0.7" if LM rescoring is used.
-      Its value is a list of tuples. Each tuple contains two elements:
-      The first is the reference transcript, and the second is the
-      predicted result.
+      graph_cache:
+        Cache of the compiled OTC alignment graphs.
+      writer:
+        The writer of the alignment results.
+      nnet_output_cache:
+        Optional cache of the network output. See :func:`align_one_batch`.
     """
     num_cuts = 0
 
@@ -325,26 +1235,56 @@ def align_dataset(
     except TypeError:
         num_batches = "?"
 
-    results = defaultdict(list)
+    # With --overlap-search, the search of batch k runs on `executor` while
+    # the network output of batch k+1 is computed on the main thread. The
+    # network output of batch k must stay valid until its search is done,
+    # so two buffers are used in turn.
+    executor = None
+    if params.overlap_search:
+        executor = ThreadPoolExecutor(max_workers=1)
+    nnet_output_buffers = [NnetOutputBuffer(), NnetOutputBuffer()]
+    pending = None
+    stats = AlignmentStats()
+    detokenizer = Detokenizer.from_symbol_table(graph_compiler.token_table)
+
     for batch_idx, batch in enumerate(dl):
         texts = batch["supervisions"]["text"]
         cut_ids = [cut.id for cut in batch["supervisions"]["cut"]]
 
-        hyps_dict = align_one_batch(
+        prepared = prepare_one_batch(
             texts=texts,
             params=params,
             model=model,
             batch=batch,
             graph_compiler=graph_compiler,
+            nnet_output_cache=nnet_output_cache,
+            nnet_output_buffer=nnet_output_buffers[batch_idx % 2],
         )
 
-        for key, hyps in hyps_dict.items():
-            this_batch = []
-            assert len(hyps) == len(texts)
-            for cut_id, hyp_words in zip(cut_ids, hyps):
-                this_batch.append((cut_id, hyp_words))
-
-            results[key].extend(this_batch)
+        if executor is None:
+            hyps_dict, tokens_dict = search_one_batch(
+                params=params,
+                prepared=prepared,
+                graph_compiler=graph_compiler,
+                graph_cache=graph_cache,
+                stats=stats,
+                detokenizer=detokenizer,
+            )
+            writer.write(cut_ids, hyps_dict, tokens_dict)
+        else:
+            if pending is not None:
+                pending_cut_ids, future = pending
+                writer.write(pending_cut_ids, *future.result())
+            future = executor.submit(
+                search_one_batch,
+                params=params,
+                prepared=prepared,
+                graph_compiler=graph_compiler,
+                graph_cache=graph_cache,
+                stats=stats,
+                detokenizer=detokenizer,
+            )
+            pending = (cut_ids, future)
 
         num_cuts += len(texts)
 
@@ -352,19 +1292,299 @@ def align_dataset(
             batch_str = f"{batch_idx}/{num_batches}"
 
             logging.info(f"batch {batch_str}, cuts processed until now is {num_cuts}")
-    return results
+
+    if pending is not None:
+        pending_cut_ids, future = pending
+        writer.write(pending_cut_ids, *future.result())
+    if executor is not None:
+        executor.shutdown()
+
+    graph_cache.log_stats()
+    stats.log_stats()
+
+
+class AlignmentWriter(object):
+    """Write alignment results to the output files as soon as a batch is done.
+
+    There is one output file per OTC configuration. The IDs of the cuts whose
+    results have been written to all output files are appended to a sidecar
+    file otc-alignment-${test_set_name}.done, which is used to resume an
+    interrupted run.
+
+    If params.confidence is True, token confidences are written to a binary
+    file with the suffix .conf next to each output file, see
+    :func:`write_confidence`. If params.ctm is True, word timestamps are
+    written to a file with the suffix .ctm, see :func:`write_ctm`.
+    """
+
+    def __init__(
+        self,
+        params: AttributeDict,
+        test_set_name: str,
+        resume: bool = False,
+        token_table: Optional[k2.SymbolTable] = None,
+    ):
+        """
+        Args:
+          params:
+            It is returned by :func:`get_params`. params.otc_configs decides
+            the output files.
+          test_set_name:
+            Name of the test set, e.g. emergency_data_en.
+          resume:
+            If True, the cut IDs in the sidecar file are loaded into
+            `self.done` and new results are appended. Lines of cuts that
+            are not in the sidecar file, i.e., written by a run that was
+            interrupted in the middle of a batch, are removed.
+            If False, existing output files are overwritten.
+          token_table:
+            The token symbol table. Required if params.ctm is True.
+        """
+        self.params = params
+        self.token_table = token_table
+        self.done_path = params.exp_dir / f"otc-alignment-{test_set_name}.done"
+        self.paths = {
+            key: get_alignment_path(params, test_set_name, key)
+            for key in params.otc_configs
+        }
+
+        self.done = set()
+        if resume and self.done_path.is_file():
+            with open(self.done_path, encoding="utf-8") as f:
+                self.done = set(line.strip() for line in f)
+            logging.info(f"Resuming: {len(self.done)} cuts are already aligned")
+
+        self.files = {
+            key: self._open_text(path, resume) for key, path in self.paths.items()
+        }
+
+        self.ctm_files = dict()
+        if params.ctm:
+            assert token_table is not None
+            self.ctm_files = {
+                key: self._open_text(path.with_suffix(".ctm"), resume)
+                for key, path in self.paths.items()
+            }
+
+        self.conf_files = dict()
+        if params.confidence:
+            for key, path in self.paths.items():
+                conf_path = path.with_suffix(".conf")
+                records = []
+                if resume and conf_path.is_file():
+                    records = [
+                        r for r in read_confidence(conf_path) if r[0] in self.done
+                    ]
+                self.conf_files[key] = open(conf_path, "wb")
+                for record in records:
+                    write_confidence(self.conf_files[key], *record)
+
+        self.done_f = open(self.done_path, "a" if resume else "w", encoding="utf-8")
+
+    def _open_text(self, path: Path, resume: bool) -> TextIO:
+        """Open a text file whose lines start with a cut ID for writing.
+        If `resume` is True, lines of cuts in `self.done` are kept."""
+        lines = []
+        if resume and path.is_file():
+            with open(path, encoding="utf-8") as f:
+                lines = [line for line in f if line.split(maxsplit=1)[0] in self.done]
+        f = open(path, "w", encoding="utf-8")
+        f.writelines(lines)
+        return f
+
+    def write(
+        self,
+        cut_ids: List[str],
+        hyps_dict: Dict[str, List[str]],
+        tokens_dict: Optional[Dict[str, List[List[Tuple]]]] = None,
+    ) -> None:
+        for key, hyps in hyps_dict.items():
+            assert len(hyps) == len(cut_ids)
+            f = self.files[key]
+            for cut_id, hyp_words in zip(cut_ids, hyps):
+                f.write(f"{cut_id} {hyp_words}\n")
+            f.flush()
+
+        for key, f in self.conf_files.items():
+            tokens = tokens_dict[key]
+            assert len(tokens) == len(cut_ids)
+            for cut_id, utt_tokens in zip(cut_ids, tokens):
+                write_confidence(
+                    f,
+                    cut_id,
+                    np.array([t[0] for t in utt_tokens], dtype=np.int32),
+                    np.array([t[3] for t in utt_tokens], dtype=np.float16),
+                    np.array([t[4] for t in utt_tokens], dtype=np.float16),
+                )
+            f.flush()
+
+        frame_duration = (
+            self.params.subsampling_factor * self.params.frame_shift_ms / 1000
+        )
+        for key, f in self.ctm_files.items():
+            tokens = tokens_dict[key]
+            assert len(tokens) == len(cut_ids)
+            for cut_id, utt_tokens in zip(cut_ids, tokens):
+                write_ctm(f, cut_id, utt_tokens, self.token_table, frame_duration)
+            f.flush()
+
+        for cut_id in cut_ids:
+            self.done_f.write(f"{cut_id}\n")
+        self.done_f.flush()
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+        for f in self.conf_files.values():
+            f.close()
+        for f in self.ctm_files.values():
+            f.close()
+        self.done_f.close()
+
+
+def write_ctm(
+    f: TextIO,
+    cut_id: str,
+    tokens: List[Tuple],
+    token_table: k2.SymbolTable,
+    frame_duration: float,
+) -> None:
+    """Write the words of one cut in CTM format.
+
+    A word starts at a token beginning with "▁" and spans from the first
+    frame of its first token to the last frame of its last token. If the
+    tokens have confidences, the confidence of a word is the minimum of the
+    confidences of its tokens.
+
+    Args:
+      f:
+        The CTM file.
+      cut_id:
+        The cut ID.
+      tokens:
+        The tokens of the cut in the format of :func:`get_token_frames`.
+      token_table:
+        The token symbol table.
+      frame_duration:
+        Duration of a frame of the network output in seconds.
+    """
+    words = []
+    for token in tokens:
+        piece = token_table[token[0]]
+        end = token[1] + token[2]
+        confidence = token[3] if len(token) > 3 else None
+        if piece.startswith("▁") or len(words) == 0:
+            words.append([piece.lstrip("▁"), token[1], end, confidence])
+        else:
+            word = words[-1]
+            word[0] += piece
+            word[2] = end
+            if confidence is not None:
+                word[3] = min(word[3], confidence)
+
+    for word, start, end, confidence in words:
+        line = (
+            f"{cut_id} 1 {start * frame_duration:.2f} "
+            f"{(end - start) * frame_duration:.2f} {word}"
+        )
+        if confidence is not None:
+            line += f" {confidence:.3f}"
+        f.write(line + "\n")
+
+
+def write_confidence(
+    f: BinaryIO,
+    cut_id: str,
+    token_ids: np.ndarray,
+    confidences: np.ndarray,
+    otc_probs: np.ndarray,
+) -> None:
+    """Write the token confidences of one cut to a binary file.
+
+    Each cut is stored as:
+
+        - uint16: number of bytes of the UTF-8 encoded cut ID
+        - the UTF-8 encoded cut ID
+        - uint32: number of tokens, N
+        - int32[N]: token IDs
+        - float16[N]: confidence of each token
+        - float16[N]: posterior of the OTC token on the frame of each token
+
+    All numbers are little-endian.
+    """
+    cut_id = cut_id.encode("utf-8")
+    f.write(struct.pack("<H", len(cut_id)))
+    f.write(cut_id)
+    f.write(struct.pack("<I", len(token_ids)))
+    f.write(token_ids.astype("<i4").tobytes())
+    f.write(confidences.astype("<f2").tobytes())
+    f.write(otc_probs.astype("<f2").tobytes())
+
+
+def read_confidence(
+    path: Path,
+) -> Iterator[Tuple[str, np.ndarray, np.ndarray, np.ndarray]]:
+    """Read a file written by :func:`write_confidence`.
+
+    A file left by a run that was killed while writing may end with an
+    incomplete record, which is skipped with a warning.
+
+    Returns:
+      Yield a tuple (cut_id, token_ids, confidences, otc_probs) for each cut.
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(2)
+            if len(header) == 0:
+                break
+            record = _read_confidence_record(f, header)
+            if record is None:
+                logging.warning(f"Skipping an incomplete record at the end of {path}")
+                break
+            yield record
+
+
+def _read_confidence_record(
+    f: BinaryIO, header: bytes
+) -> Optional[Tuple[str, np.ndarray, np.ndarray, np.ndarray]]:
+    """Read the rest of a record whose first bytes are `header`. Return None
+    if the file ends before the record is complete."""
+
+    def read(num_bytes: int) -> Optional[bytes]:
+        data = f.read(num_bytes)
+        return data if len(data) == num_bytes else None
+
+    if len(header) < 2:
+        return None
+    (cut_id_len,) = struct.unpack("<H", header)
+    cut_id = read(cut_id_len)
+    num_tokens = read(4)
+    if cut_id is None or num_tokens is None:
+        return None
+    (num_tokens,) = struct.unpack("<I", num_tokens)
+    data = read(8 * num_tokens)
+    if data is None:
+        return None
+    token_ids = np.frombuffer(data, dtype="<i4", count=num_tokens)
+    confidences = np.frombuffer(
+        data, dtype="<f2", count=num_tokens, offset=4 * num_tokens
+    )
+    otc_probs = np.frombuffer(
+        data, dtype="<f2", count=num_tokens, offset=6 * num_tokens
+    )
+    return cut_id.decode("utf-8"), token_ids, confidences, otc_probs
 
 
-def save_results(
+def get_alignment_path(
     params: AttributeDict,
     test_set_name: str,
-    results_dict: Dict[str, List[Tuple[str, List[str], List[str]]]],
-):
-    for _, results in results_dict.items():
-        align_path = params.exp_dir / f"otc-alignment-{test_set_name}.txt"
-        with open(align_path, "w", encoding="utf-8") as ali_p:
-            for cut_id, hyp_words in results:
-                ali_p.write(f"{cut_id} {hyp_words}\n")
+    key: str,
+) -> Path:
+    # Keep the original file name if there is only one OTC configuration
+    if len(params.otc_configs) == 1:
+        return params.exp_dir / f"otc-alignment-{test_set_name}.txt"
+    else:
+        return params.exp_dir / f"otc-alignment-{test_set_name}-{key}.txt"
 
 
 @torch.no_grad()
@@ -378,14 +1598,17 @@ def main():
 
     params = get_params()
     params.update(vars(args))
+    params.otc_configs = get_otc_configs(params)
 
     setup_logger(f"{params.exp_dir}/log-{params.method}/log-alignment")
     logging.info("OTC alignment started")
     logging.info(params)
 
     device = torch.device("cpu")
-    if torch.cuda.is_available():
+    if torch.cuda.is_available() and params.onnx_model is None:
         device = torch.device("cuda", 0)
+    else:
+        torch.set_num_threads(params.num_threads)
 
     graph_compiler = OtcTrainingGraphCompiler(
         params.lang_dir,
@@ -393,6 +1616,26 @@ def main():
         device=device,
     )
 
+    graph_archive = None
+    if params.graph_archive is not None:
+        graph_archive = OtcGraphArchive(
+            params.graph_archive,
+            lang_settings=otc_lang_settings(params.lang_dir, params.otc_token),
+            device=device,
+        )
+        if params.chunk_frames > 0:
+            logging.warning(
+                "Supervisions longer than --chunk-frames are split into chunks "
+                "whose graphs are compiled on the fly; --graph-archive is used "
+                "only for the other supervisions"
+            )
+
+    graph_cache = OtcGraphCache(
+        graph_compiler,
+        max_num_arcs=params.graph_cache_max_arcs,
+        archive=graph_archive,
+    )
+
     # remove OTC token as it is actually a fake token (the average of all non-blank tokens)
     max_token_id = graph_compiler.get_max_token_id() - 1
     # +1 for the blank
@@ -400,45 +1643,75 @@ def main():
 
     logging.info(f"device: {device}")
 
-    model = Conformer(
-        num_features=params.feature_dim,
-        nhead=params.nhead,
-        d_model=params.attention_dim,
-        num_classes=num_classes,
-        subsampling_factor=params.subsampling_factor,
-        num_decoder_layers=params.num_decoder_layers,
-        vgg_frontend=params.vgg_frontend,
-        use_feat_batchnorm=params.use_feat_batchnorm,
-    )
+    nnet_output_cache = None
+    if params.nnet_output_cache_dir is not None:
+        if params.load_nnet_output:
+            nnet_output_cache = NnetOutputCache(params.nnet_output_cache_dir)
+        else:
+            nnet_output_cache = NnetOutputCacheWriter(
+                params.nnet_output_cache_dir, resume=params.resume
+            )
+
+    model = None
+    if isinstance(nnet_output_cache, NnetOutputCache):
+        pass
+    elif params.onnx_model is not None:
+        # Imported here so that onnxruntime is needed only for this mode
+        from onnx_ctc_model import OnnxCtcModel
+
+        model = OnnxCtcModel(params.onnx_model, num_threads=params.num_threads)
+    else:
+        model = Conformer(
+            num_features=params.feature_dim,
+            nhead=params.nhead,
+            d_model=params.attention_dim,
+            num_classes=num_classes,
+            subsampling_factor=params.subsampling_factor,
+            num_decoder_layers=params.num_decoder_layers,
+            vgg_frontend=params.vgg_frontend,
+            use_feat_batchnorm=params.use_feat_batchnorm,
+        )
 
-    # load pretrained model
-    load_checkpoint(f"{params.exp_dir}/pretrained.pt", model)
+        # load pretrained model
+        load_checkpoint(f"{params.exp_dir}/pretrained.pt", model)
 
-    model.to(device)
-    model.eval()
-    num_param = sum([p.numel() for p in model.parameters()])
-    logging.info(f"Number of model parameters: {num_param}")
+        model.to(device)
+        model.eval()
+        num_param = sum([p.numel() for p in model.parameters()])
+        logging.info(f"Number of model parameters: {num_param}")
 
     # we need cut ids to display recognition results.
     args.return_cuts = True
     multivent = MultiVENTAsrDataModule(args)
 
+    test_set = f"{params.event}_{params.language}"
+    writer = AlignmentWriter(
+        params,
+        test_set_name=test_set,
+        resume=params.resume,
+        token_table=graph_compiler.token_table,
+    )
+
     multivent_cuts = multivent.multivent_cuts()
+    if len(writer.done) > 0:
+        done = writer.done
+        multivent_cuts = multivent_cuts.filter(lambda c: c.id not in done)
 
     multivent_dl = multivent.test_dataloaders(multivent_cuts)
 
-    test_sets = [f"{params.event}_{params.language}"]
-    test_dls = [multivent_dl]
-
-    for test_set, test_dl in zip(test_sets, test_dls):
-        results_dict = align_dataset(
-            dl=test_dl,
-            params=params,
-            model=model,
-            graph_compiler=graph_compiler,
-        )
+    align_dataset(
+        dl=multivent_dl,
+        params=params,
+        model=model,
+        graph_compiler=graph_compiler,
+        graph_cache=graph_cache,
+        writer=writer,
+        nnet_output_cache=nnet_output_cache,
+    )
+    writer.close()
 
-        save_results(params=params, test_set_name=test_set, results_dict=results_dict)
+    if isinstance(nnet_output_cache, NnetOutputCacheWriter):
+        nnet_output_cache.close()
 
     logging.info("Done!")
 
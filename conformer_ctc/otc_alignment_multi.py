@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This script runs OTC alignment for several events and languages at once.
+
+The model is loaded only once. Batches of all events are put into a shared
+work queue, which is consumed by --num-jobs worker processes. Each worker
+either runs on CPU, sharing the model weights with the main process, or on
+its own GPU (worker i uses cuda:(i % num_gpus)). The output of each event is
+written to ${exp_dir}/otc-alignment-${event}_${language}.txt as soon as each
+batch is done, and --resume works as with ./conformer_ctc/otc_alignment.py.
+If a worker process dies, the other workers are stopped and the script
+fails.
+
+--graph-archive is supported; cuts that are not in the archive, e.g., those
+of other events, are compiled on the fly. --nnet-output-cache-dir and
+--overlap-search are not supported.
+
+Usage:
+
+./conformer_ctc/otc_alignment_multi.py \
+  --events emergency_data,political_data,social_data,technology_data \
+  --languages en \
+  --num-jobs 8 \
+  --threads-per-job 2 \
+  --exp-dir conformer_ctc/exp \
+  --lang-dir data/lang_bpe_500
+"""
+
+import argparse
+import copy
+import logging
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+import torch.multiprocessing as mp
+from asr_datamodule import MultiVENTAsrDataModule
+from conformer import Conformer
+from detokenizer import Detokenizer
+from otc_alignment import (
+    AlignmentStats,
+    AlignmentWriter,
+    NnetOutputBuffer,
+    align_one_batch,
+    get_otc_configs,
+    get_params,
+    get_parser,
+)
+from otc_graph_cache import OtcGraphArchive, OtcGraphCache, otc_lang_settings
+
+from icefall.checkpoint import load_checkpoint
+from icefall.otc_graph_compiler import OtcTrainingGraphCompiler
+from icefall.utils import AttributeDict, setup_logger
+
+# Seconds to wait on a queue before checking that the workers are alive
+QUEUE_TIMEOUT = 10
+
+
+def str2bool_or_auto(v: str):
+    if v == "auto":
+        return torch.cuda.is_available()
+    if v.lower() in ("yes", "true", "t", "y", "1"):
+        return True
+    if v.lower() in ("no", "false", "f", "n", "0"):
+        return False
+    raise argparse.ArgumentTypeError("Boolean value or 'auto' expected.")
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--events",
+        type=str,
+        required=True,
+        help="Comma-separated list of events to align.",
+    )
+
+    parser.add_argument(
+        "--languages",
+        type=str,
+        default="en",
+        help="Comma-separated list of languages to align.",
+    )
+
+    parser.add_argument(
+        "--num-jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes.",
+    )
+
+    parser.add_argument(
+        "--threads-per-job",
+        type=int,
+        default=1,
+        help="Number of intra-op threads of each worker when running on CPU.",
+    )
+
+    parser.add_argument(
+        "--use-gpu",
+        type=str2bool_or_auto,
+        default="auto",
+        help="""Whether the workers run on GPUs. If "auto", GPUs are used
+        when available.""",
+    )
+
+
+@torch.no_grad()
+def align_worker(
+    rank: int,
+    params: AttributeDict,
+    model: torch.nn.Module,
+    work_queue: mp.Queue,
+    result_queue: mp.Queue,
+):
+    """Consume (test_set, batch) pairs from `work_queue` until a None is
+    received and put (test_set, cut_ids, hyps_dict, tokens_dict) to
+    `result_queue`.
+    A None is put to `result_queue` when the worker is done."""
+    if params.use_gpu:
+        device = torch.device("cuda", rank % torch.cuda.device_count())
+        model = copy.deepcopy(model).to(device)
+    else:
+        # The weights live in shared memory, so the model is not copied.
+        device = torch.device("cpu")
+        torch.set_num_threads(params.threads_per_job)
+    model.eval()
+
+    graph_compiler = OtcTrainingGraphCompiler(
+        params.lang_dir,
+        otc_token=params.otc_token,
+        device=device,
+    )
+    graph_archive = None
+    if params.graph_archive is not None:
+        graph_archive = OtcGraphArchive(
+            params.graph_archive,
+            lang_settings=otc_lang_settings(params.lang_dir, params.otc_token),
+            device=device,
+        )
+    graph_cache = OtcGraphCache(
+        graph_compiler,
+        max_num_arcs=params.graph_cache_max_arcs,
+        archive=graph_archive,
+    )
+    nnet_output_buffer = NnetOutputBuffer()
+    stats = AlignmentStats()
+    detokenizer = Detokenizer.from_symbol_table(graph_compiler.token_table)
+
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        test_set, batch = item
+
+        hyps_dict, tokens_dict = align_one_batch(
+            texts=batch["supervisions"]["text"],
+            params=params,
+            model=model,
+            batch=batch,
+            graph_compiler=graph_compiler,
+            graph_cache=graph_cache,
+            nnet_output_buffer=nnet_output_buffer,
+            stats=stats,
+            detokenizer=detokenizer,
+        )
+        cut_ids = [cut.id for cut in batch["supervisions"]["cut"]]
+        result_queue.put((test_set, cut_ids, hyps_dict, tokens_dict))
+
+    graph_cache.log_stats()
+    stats.log_stats()
+    result_queue.put(None)
+
+
+def check_workers(workers: List[mp.Process]) -> None:
+    """Raise a RuntimeError if a worker process has failed."""
+    for rank, p in enumerate(workers):
+        if p.exitcode is not None and p.exitcode != 0:
+            raise RuntimeError(
+                f"Worker {rank} (pid {p.pid}) exited with code {p.exitcode}"
+            )
+
+
+def put_work(
+    work_queue: mp.Queue,
+    item: Any,
+    workers: List[mp.Process],
+    writer_future: Future,
+) -> None:
+    """Put `item` to `work_queue`, failing instead of blocking forever if a
+    worker or the writer thread has failed."""
+    while True:
+        try:
+            work_queue.put(item, timeout=QUEUE_TIMEOUT)
+            break
+        except queue.Full:
+            check_workers(workers)
+            if writer_future.done():
+                # Raises the exception of the writer thread
+                writer_future.result()
+    if writer_future.done():
+        writer_future.result()
+
+
+def write_results(
+    result_queue: mp.Queue,
+    writers: Dict[str, AlignmentWriter],
+    workers: List[mp.Process],
+):
+    """Write the results of all workers until each of them has put a None
+    to `result_queue`. Raise a RuntimeError if a worker dies before."""
+    num_finished = 0
+    num_batches = 0
+    while num_finished < len(workers):
+        try:
+            item = result_queue.get(timeout=QUEUE_TIMEOUT)
+        except queue.Empty:
+            check_workers(workers)
+            continue
+        if item is None:
+            num_finished += 1
+            continue
+        test_set, cut_ids, hyps_dict, tokens_dict = item
+        writers[test_set].write(cut_ids, hyps_dict, tokens_dict)
+
+        if num_batches % 100 == 0:
+            logging.info(f"{num_batches} batches done")
+        num_batches += 1
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    MultiVENTAsrDataModule.add_arguments(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    args.exp_dir = Path(args.exp_dir)
+    args.lang_dir = Path(args.lang_dir)
+    args.lm_dir = Path(args.lm_dir)
+
+    params = get_params()
+    params.update(vars(args))
+    params.otc_configs = get_otc_configs(params)
+
+    setup_logger(f"{params.exp_dir}/log-{params.method}/log-alignment-multi")
+    logging.info("OTC alignment started")
+    logging.info(params)
+
+    assert (
+        params.nnet_output_cache_dir is None
+    ), "--nnet-output-cache-dir is not supported by this script"
+    assert not params.overlap_search, (
+        "--overlap-search is not supported by this script; "
+        "use --num-jobs to overlap the work of several batches"
+    )
+    if params.use_gpu:
+        assert torch.cuda.is_available(), (
+            "--use-gpu True was given but no GPU is available; "
+            "use --use-gpu False or auto"
+        )
+    if params.graph_archive is not None:
+        # Fail before starting the workers if the archive does not match
+        OtcGraphArchive(
+            params.graph_archive,
+            lang_settings=otc_lang_settings(params.lang_dir, params.otc_token),
+        )
+
+    graph_compiler = OtcTrainingGraphCompiler(
+        params.lang_dir,
+        otc_token=params.otc_token,
+        device=torch.device("cpu"),
+    )
+    # remove OTC token as it is actually a fake token (the average of all non-blank tokens)
+    num_classes = graph_compiler.get_max_token_id()
+    token_table = graph_compiler.token_table
+    del graph_compiler
+
+    model = Conformer(
+        num_features=params.feature_dim,
+        nhead=params.nhead,
+        d_model=params.attention_dim,
+        num_classes=num_classes,
+        subsampling_factor=params.subsampling_factor,
+        num_decoder_layers=params.num_decoder_layers,
+        vgg_frontend=params.vgg_frontend,
+        use_feat_batchnorm=params.use_feat_batchnorm,
+    )
+    load_checkpoint(f"{params.exp_dir}/pretrained.pt", model)
+    model.eval()
+    model.share_memory()
+
+    # we need cut ids to display recognition results.
+    args.return_cuts = True
+
+    # Pairs without a manifest are skipped before the workers are started
+    test_sets = []
+    for event in params.events.split(","):
+        for language in params.languages.split(","):
+            args.event = event
+            args.language = language
+            path = MultiVENTAsrDataModule(args).multivent_cuts_path()
+            if path.is_file():
+                test_sets.append((event, language))
+            else:
+                logging.warning(f"Skipping {event}_{language}: {path} does not exist")
+    assert len(test_sets) > 0, "No manifest found for --events and --languages"
+
+    ctx = mp.get_context("spawn")
+    work_queue = ctx.Queue(maxsize=2 * params.num_jobs)
+    result_queue = ctx.Queue()
+
+    workers = []
+    for rank in range(params.num_jobs):
+        p = ctx.Process(
+            target=align_worker,
+            args=(rank, params, model, work_queue, result_queue),
+        )
+        p.start()
+        workers.append(p)
+
+    writers = {
+        f"{event}_{language}": AlignmentWriter(
+            params,
+            test_set_name=f"{event}_{language}",
+            resume=params.resume,
+            token_table=token_table,
+        )
+        for event, language in test_sets
+    }
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        writer_future = executor.submit(write_results, result_queue, writers, workers)
+        try:
+            for event, language in test_sets:
+                test_set = f"{event}_{language}"
+                args.event = event
+                args.language = language
+                multivent = MultiVENTAsrDataModule(args)
+
+                cuts = multivent.multivent_cuts()
+                done = writers[test_set].done
+                if len(done) > 0:
+                    cuts = cuts.filter(lambda c: c.id not in done)
+                test_dl = multivent.test_dataloaders(cuts)
+
+                logging.info(f"Queueing {test_set}")
+                for batch in test_dl:
+                    put_work(work_queue, (test_set, batch), workers, writer_future)
+
+            for _ in workers:
+                put_work(work_queue, None, workers, writer_future)
+
+            writer_future.result()
+        except BaseException:
+            # Stop the remaining workers so that the writer thread (which
+            # checks them) and the calls to join() below return.
+            for p in workers:
+                p.terminate()
+            raise
+        finally:
+            for p in workers:
+                p.join()
+
+    for writer in writers.values():
+        writer.close()
+
+    logging.info("Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import k2
+import numpy as np
+import torch
+
+from icefall.otc_graph_compiler import OtcTrainingGraphCompiler
+
+
+def text_hash(text: str) -> str:
+    """Return a short digest of a transcript, used to detect graphs that were
+    compiled from an outdated version of the transcript."""
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+def otc_graph_settings(
+    allow_bypass_arc: bool,
+    allow_self_loop_arc: bool,
+    bypass_weight: float,
+    self_loop_weight: float,
+) -> Dict:
+    return {
+        "allow_bypass_arc": bool(allow_bypass_arc),
+        "allow_self_loop_arc": bool(allow_self_loop_arc),
+        "bypass_weight": float(bypass_weight),
+        "self_loop_weight": float(self_loop_weight),
+    }
+
+
+def otc_lang_settings(lang_dir: Path, otc_token: str) -> Dict:
+    """Return the OTC token and a digest of the token table of `lang_dir`,
+    which determine the token IDs of the compiled graphs."""
+    with open(Path(lang_dir) / "tokens.txt", "rb") as f:
+        tokens_hash = hashlib.md5(f.read()).hexdigest()
+    return {"otc_token": otc_token, "tokens_hash": tokens_hash}
+
+
+class OtcGraphArchiveWriter(object):
+    """Write compiled OTC alignment graphs to an on-disk archive.
+
+    An archive is a directory with three files:
+
+        - arcs.bin: int32 array of shape (num_arcs, 4) holding the arcs of
+          all graphs back to back, in the format of `fsa.arcs.values()`
+        - aux_labels.bin: int32 array of shape (num_arcs,)
+        - index.json: the graph settings, the lang settings (see
+          :func:`otc_lang_settings`) and, for each cut ID, the arc offset,
+          the number of arcs and the hash of the transcript
+
+    The two binary files are raw arrays so that the archive can be opened
+    with `np.memmap` without reading it into memory.
+    """
+
+    def __init__(self, archive_dir: Path, settings: Dict, lang_settings: Dict):
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.settings = settings
+        self.lang_settings = lang_settings
+
+        self.arcs_f = open(self.archive_dir / "arcs.bin", "wb")
+        self.aux_labels_f = open(self.archive_dir / "aux_labels.bin", "wb")
+        self.graphs = {}
+        self.num_arcs = 0
+
+    def write(
+        self,
+        cut_id: str,
+        text: str,
+        arcs: np.ndarray,
+        aux_labels: np.ndarray,
+    ) -> None:
+        assert cut_id not in self.graphs, cut_id
+        assert arcs.dtype == np.int32 and arcs.shape[1] == 4, arcs.shape
+        assert aux_labels.shape == (arcs.shape[0],), aux_labels.shape
+
+        self.arcs_f.write(arcs.tobytes())
+        self.aux_labels_f.write(aux_labels.astype(np.int32).tobytes())
+        self.graphs[cut_id] = [self.num_arcs, arcs.shape[0], text_hash(text)]
+        self.num_arcs += arcs.shape[0]
+
+    def close(self) -> None:
+        self.arcs_f.close()
+        self.aux_labels_f.close()
+        with open(self.archive_dir / "index.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "settings": self.settings,
+                    "lang_settings": self.lang_settings,
+                    "num_arcs": self.num_arcs,
+                    "graphs": self.graphs,
+                },
+                f,
+            )
+
+    def __enter__(self) -> "OtcGraphArchiveWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class OtcGraphArchive(object):
+    """Read-only, memory-mapped view of an archive written by
+    :class:`OtcGraphArchiveWriter`."""
+
+    def __init__(
+        self,
+        archive_dir: Path,
+        lang_settings: Dict,
+        device: torch.device = "cpu",
+    ):
+        """
+        Args:
+          archive_dir:
+            The archive directory.
+          lang_settings:
+            The return value of :func:`otc_lang_settings` for the lang dir
+            and OTC token used for alignment. A ValueError is raised if the
+            archive was compiled with different ones, since the token IDs
+            of its graphs would be wrong.
+          device:
+            The device of the returned graphs.
+        """
+        archive_dir = Path(archive_dir)
+        with open(archive_dir / "index.json", encoding="utf-8") as f:
+            index = json.load(f)
+
+        if index.get("lang_settings") != lang_settings:
+            raise ValueError(
+                f"The OTC graphs in {archive_dir} were compiled with "
+                f"{index.get('lang_settings')}, but {lang_settings} is used "
+                "now. Please compile them again with "
+                "./conformer_ctc/compile_otc_graphs.py"
+            )
+
+        self.settings = index["settings"]
+        self.graphs = index["graphs"]
+        self.device = device
+
+        num_arcs = index["num_arcs"]
+        self.arcs = np.memmap(
+            archive_dir / "arcs.bin",
+            dtype=np.int32,
+            mode="r",
+            shape=(num_arcs, 4),
+        )
+        self.aux_labels = np.memmap(
+            archive_dir / "aux_labels.bin",
+            dtype=np.int32,
+            mode="r",
+            shape=(num_arcs,),
+        )
+        logging.info(f"Loaded {len(self.graphs)} OTC graphs from {archive_dir}")
+
+    def __len__(self) -> int:
+        return len(self.graphs)
+
+    def matches(self, settings: Dict) -> bool:
+        return self.settings == settings
+
+    def get(self, cut_id: str, text: str) -> Optional[k2.Fsa]:
+        """Return the graph of the given cut, or None if the cut is not in
+        the archive or its transcript changed since the archive was built."""
+        entry = self.graphs.get(cut_id)
+        if entry is None:
+            return None
+        offset, num_arcs, digest = entry
+        if digest != text_hash(text):
+            return None
+
+        arcs = torch.from_numpy(np.array(self.arcs[offset : offset + num_arcs]))
+        aux_labels = torch.from_numpy(
+            np.array(self.aux_labels[offset : offset + num_arcs])
+        )
+        return k2.Fsa(arcs, aux_labels=aux_labels).to(self.device)
+
+
+class OtcGraphCache(object):
+    """LRU cache of compiled OTC alignment graphs.
+
+    Each entry is a single (non-vector) FSA compiled for one transcript with
+    one set of bypass/self-loop settings. Graphs for a batch are looked up
+    one by one, the missing ones are compiled together in a single call to
+    :meth:`OtcTrainingGraphCompiler.compile`, and the result is assembled
+    with :func:`k2.create_fsa_vec`.
+
+    The cache size is bounded by the total number of arcs of the cached
+    graphs, which is what dominates their memory footprint. The least
+    recently used graphs are evicted first.
+
+    If an :class:`OtcGraphArchive` built with the same settings is given,
+    graphs are first looked up in it by cut ID.
+    """
+
+    def __init__(
+        self,
+        graph_compiler: OtcTrainingGraphCompiler,
+        max_num_arcs: int = 10000000,
+        archive: Optional[OtcGraphArchive] = None,
+    ):
+        """
+        Args:
+          graph_compiler:
+            The OTC graph compiler used to compile the graphs that are not
+            in the cache.
+          max_num_arcs:
+            Upper bound on the total number of arcs of the cached graphs.
+            If it is not positive, nothing is cached.
+          archive:
+            Optional archive of precompiled graphs.
+        """
+        self.graph_compiler = graph_compiler
+        self.max_num_arcs = max_num_arcs
+        self.archive = archive
+        self.num_archive_hits = 0
+
+        self.graphs = OrderedDict()
+        self.num_arcs = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self) -> int:
+        return len(self.graphs)
+
+    def compile(
+        self,
+        texts: List[str],
+        allow_bypass_arc: bool = True,
+        allow_self_loop_arc: bool = True,
+        bypass_weight: float = 0.0,
+        self_loop_weight: float = 0.0,
+        cut_ids: Optional[List[str]] = None,
+    ) -> k2.Fsa:
+        """Same as :meth:`OtcTrainingGraphCompiler.compile`, but graphs are
+        taken from the archive or the cache whenever possible.
+
+        Args:
+          cut_ids:
+            Cut IDs of the texts. Required to look up graphs in the archive.
+            Texts whose cut ID is None are not looked up in the archive.
+        Returns:
+          Return an FsaVec, whose i-th FSA is the alignment graph of texts[i].
+        """
+        use_archive = False
+        if self.archive is not None and cut_ids is not None:
+            settings = otc_graph_settings(
+                allow_bypass_arc,
+                allow_self_loop_arc,
+                bypass_weight,
+                self_loop_weight,
+            )
+            use_archive = self.archive.matches(settings)
+
+        keys = [
+            (
+                text,
+                allow_bypass_arc,
+                allow_self_loop_arc,
+                bypass_weight,
+                self_loop_weight,
+            )
+            for text in texts
+        ]
+
+        graphs = {}
+        missing_keys = []
+        for i, key in enumerate(keys):
+            if key in graphs:
+                continue
+            if use_archive and cut_ids[i] is not None:
+                graph = self.archive.get(cut_ids[i], key[0])
+                if graph is not None:
+                    graphs[key] = graph
+                    self.num_archive_hits += 1
+                    continue
+            graph = self.graphs.get(key)
+            if graph is None:
+                graphs[key] = None
+                missing_keys.append(key)
+            else:
+                self.graphs.move_to_end(key)
+                graphs[key] = graph
+                self.num_hits += 1
+
+        if len(missing_keys) > 0:
+            self.num_misses += len(missing_keys)
+            compiled = self.graph_compiler.compile(
+                texts=[key[0] for key in missing_keys],
+                allow_bypass_arc=allow_bypass_arc,
+                allow_self_loop_arc=allow_self_loop_arc,
+                bypass_weight=bypass_weight,
+                self_loop_weight=self_loop_weight,
+            )
+            for i, key in enumerate(missing_keys):
+                graph = compiled[i]
+                graphs[key] = graph
+                self._add(key, graph)
+
+        return k2.create_fsa_vec([graphs[key] for key in keys])
+
+    def _add(self, key: Tuple, graph: k2.Fsa) -> None:
+        num_arcs = graph.num_arcs
+        if num_arcs > self.max_num_arcs:
+            return
+
+        self.graphs[key] = graph
+        self.num_arcs += num_arcs
+
+        while self.num_arcs > self.max_num_arcs:
+            _, evicted = self.graphs.popitem(last=False)
+            self.num_arcs -= evicted.num_arcs
+
+    def log_stats(self) -> None:
+        total = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / total if total > 0 else 0.0
+        logging.info(
+            f"OTC graph cache: {len(self.graphs)} graphs, {self.num_arcs} arcs, "
+            f"hits: {self.num_hits}, misses: {self.num_misses}, "
+            f"hit rate: {hit_rate:.2%}, archive hits: {self.num_archive_hits}"
+        )
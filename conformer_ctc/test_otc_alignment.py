@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    python ./conformer_ctc/test_otc_alignment.py
+"""
+
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from otc_alignment import read_confidence, write_confidence
+
+
+def get_records():
+    rng = np.random.default_rng(0)
+    records = []
+    for i, num_tokens in enumerate([3, 0, 7, 1]):
+        records.append(
+            (
+                f"cut-{i}",
+                rng.integers(0, 500, num_tokens).astype(np.int32),
+                rng.random(num_tokens).astype(np.float16),
+                rng.random(num_tokens).astype(np.float16),
+            )
+        )
+    return records
+
+
+def assert_records_equal(actual, expected):
+    assert len(actual) == len(expected), (len(actual), len(expected))
+    for a, e in zip(actual, expected):
+        assert a[0] == e[0], (a[0], e[0])
+        for x, y in zip(a[1:], e[1:]):
+            np.testing.assert_array_equal(x, y)
+
+
+def test_confidence_round_trip():
+    records = get_records()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "otc-alignment.conf"
+        with open(path, "wb") as f:
+            for record in records:
+                write_confidence(f, *record)
+        assert_records_equal(list(read_confidence(path)), records)
+
+
+def test_confidence_truncated():
+    records = get_records()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "otc-alignment.conf"
+        with open(path, "wb") as f:
+            for record in records[:-1]:
+                write_confidence(f, *record)
+            num_complete_bytes = f.tell()
+            write_confidence(f, *records[-1])
+        data = path.read_bytes()
+
+        # Cut the last record at every possible position, as a run killed
+        # while writing it would
+        for end in range(num_complete_bytes, len(data)):
+            path.write_bytes(data[:end])
+            assert_records_equal(list(read_confidence(path)), records[:-1])
+
+
+def main():
+    test_confidence_round_trip()
+    test_confidence_truncated()
+
+
+if __name__ == "__main__":
+    main()
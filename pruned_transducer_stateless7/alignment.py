@@ -21,7 +21,12 @@ from typing import List
 import k2
 import torch
 
-from beam_search import Hypothesis, HypothesisList, get_hyps_shape
+from beam_search import (
+    Hypothesis,
+    HypothesisList,
+    compute_decoder_out,
+    get_hyps_shape,
+)
 
 # The force alignment problem can be formulated as finding
 # a path in a rectangular lattice, where the path starts
@@ -133,14 +138,10 @@ def batch_force_alignment(
             [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
         )  # (num_hyps, 1)
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
-
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(
+            model,
+            [hyp.context(context_size) for hyps in A for hyp in hyps],
+        ).unsqueeze(1)
         # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
 
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
@@ -171,14 +172,14 @@ def batch_force_alignment(
 
         for i in range(batch_size):
             for h, hyp in enumerate(A[i]):
-                pos_u = len(hyp.timestamp)
+                # The first context_size tokens are blanks
+                pos_u = hyp.num_tokens - context_size
                 idx_offset = h * vocab_size
                 if (sorted_encoder_out_lens[i] - 1 - t) >= (sorted_ys_lens[i] - pos_u):
                     # emit blank token
                     new_hyp = Hypothesis(
                         log_prob=ragged_log_probs[i][idx_offset + blank_id],
-                        ys=hyp.ys[:],
-                        timestamp=hyp.timestamp[:],
+                        node=hyp.node,
                     )
                     B[i].add(new_hyp)
                 if pos_u < sorted_ys_lens[i]:
@@ -186,8 +187,7 @@ def batch_force_alignment(
                     new_token = sorted_ys_list[i][pos_u]
                     new_hyp = Hypothesis(
                         log_prob=ragged_log_probs[i][idx_offset + new_token],
-                        ys=hyp.ys + [new_token],
-                        timestamp=hyp.timestamp + [t],
+                        node=hyp.node.append(new_token, t),
                     )
                     B[i].add(new_hyp)
 
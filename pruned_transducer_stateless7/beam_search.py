@@ -16,12 +16,12 @@
 # limitations under the License.
 
 import warnings
-from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple, Union
 
 import k2
 import sentencepiece as spm
 import torch
+from decoder_cache import DecoderOutputCache, DecoderOutputTable
 from torch import nn
 
 from icefall import ContextGraph, ContextState, NgramLm, NgramLmStateCost
@@ -495,67 +495,124 @@ def fast_beam_search(
     individual_streams = []
     for i in range(B):
         individual_streams.append(k2.RnntDecodingStream(decoding_graph))
-    decoding_streams = k2.RnntDecodingStreams(individual_streams, config)
 
     encoder_out = model.joiner.encoder_proj(encoder_out)
 
-    for t in range(T):
-        # shape is a RaggedShape of shape (B, context)
-        # contexts is a Tensor of shape (shape.NumElements(), context_size)
-        shape, contexts = decoding_streams.get_contexts()
-        # `nn.Embedding()` in torch below v1.7.1 supports only torch.int64
-        contexts = contexts.to(torch.int64)
-        # decoder_out is of shape (shape.NumElements(), 1, decoder_out_dim)
-        decoder_out = model.decoder(contexts, need_pad=False)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
-        # current_encoder_out is of shape
-        # (shape.NumElements(), 1, joiner_dim)
-        # fmt: off
-        current_encoder_out = torch.index_select(
-            encoder_out[:, t:t + 1, :], 0, shape.row_ids(1).to(torch.int64)
-        )
-        # fmt: on
-        logits = model.joiner(
-            current_encoder_out.unsqueeze(2),
-            decoder_out.unsqueeze(1),
-            project_input=False,
+    # A stream is advanced only on its own frames, not on padding. The time
+    # axis is split at each distinct length in encoder_out_lens, and within
+    # a segment only the streams that are still active are advanced. At the
+    # end of a segment, they are flushed to the individual streams, which
+    # keep the lattice of all previous segments.
+    lens = encoder_out_lens.tolist()
+    boundaries = sorted(set(lens) | {0})
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        active = [i for i in range(B) if lens[i] >= end]
+        decoding_streams = k2.RnntDecodingStreams(
+            [individual_streams[i] for i in active], config
         )
-        logits = logits.squeeze(1).squeeze(1)
-
-        if blank_penalty != 0:
-            logits[:, 0] -= blank_penalty
-
-        log_probs = (logits / temperature).log_softmax(dim=-1)
-
-        if ilme_scale != 0:
-            ilme_logits = model.joiner(
-                torch.zeros_like(
-                    current_encoder_out, device=current_encoder_out.device
-                ).unsqueeze(2),
+        if len(active) < B:
+            active_encoder_out = encoder_out[
+                torch.tensor(active, device=encoder_out.device)
+            ]
+        else:
+            active_encoder_out = encoder_out
+
+        for t in range(start, end):
+            # shape is a RaggedShape of shape (len(active), context)
+            # contexts is a Tensor of shape (shape.NumElements(), context_size)
+            shape, contexts = decoding_streams.get_contexts()
+            # `nn.Embedding()` in torch below v1.7.1 supports only torch.int64
+            contexts = contexts.to(torch.int64)
+            # decoder_out is of shape (shape.NumElements(), 1, decoder_out_dim)
+            decoder_out = model.decoder(contexts, need_pad=False)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
+            # current_encoder_out is of shape
+            # (shape.NumElements(), 1, joiner_dim)
+            # fmt: off
+            current_encoder_out = torch.index_select(
+                active_encoder_out[:, t:t + 1, :], 0,
+                shape.row_ids(1).to(torch.int64),
+            )
+            # fmt: on
+            logits = model.joiner(
+                current_encoder_out.unsqueeze(2),
                 decoder_out.unsqueeze(1),
                 project_input=False,
             )
-            ilme_logits = ilme_logits.squeeze(1).squeeze(1)
+            logits = logits.squeeze(1).squeeze(1)
+
             if blank_penalty != 0:
-                ilme_logits[:, 0] -= blank_penalty
-            ilme_log_probs = (ilme_logits / temperature).log_softmax(dim=-1)
-            log_probs -= ilme_scale * ilme_log_probs
+                logits[:, 0] -= blank_penalty
+
+            log_probs = (logits / temperature).log_softmax(dim=-1)
+
+            if ilme_scale != 0:
+                ilme_logits = model.joiner(
+                    torch.zeros_like(
+                        current_encoder_out, device=current_encoder_out.device
+                    ).unsqueeze(2),
+                    decoder_out.unsqueeze(1),
+                    project_input=False,
+                )
+                ilme_logits = ilme_logits.squeeze(1).squeeze(1)
+                if blank_penalty != 0:
+                    ilme_logits[:, 0] -= blank_penalty
+                ilme_log_probs = (ilme_logits / temperature).log_softmax(dim=-1)
+                log_probs -= ilme_scale * ilme_log_probs
 
-        decoding_streams.advance(log_probs)
+            decoding_streams.advance(log_probs)
+        decoding_streams.terminate_and_flush_to_streams()
+
+    decoding_streams = k2.RnntDecodingStreams(individual_streams, config)
     decoding_streams.terminate_and_flush_to_streams()
-    lattice = decoding_streams.format_output(
-        encoder_out_lens.tolist(), allow_partial=allow_partial
-    )
+    lattice = decoding_streams.format_output(lens, allow_partial=allow_partial)
 
     return lattice
 
 
+def compute_decoder_out(
+    model: nn.Module,
+    contexts: Union[List[List[int]], torch.Tensor],
+    decoder_cache: Optional[DecoderOutputCache] = None,
+) -> torch.Tensor:
+    """Run the decoder and the decoder projection of the joiner.
+
+    Args:
+      model:
+        The transducer model.
+      contexts:
+        contexts[i] contains the last `context_size` tokens of the i-th
+        hypothesis. It can also be a 2-D int64 tensor on the device of the
+        model, which is looked up in a :class:`DecoderOutputTable` without
+        copying it to the host.
+      decoder_cache:
+        If not None, the decoder output is looked up in it. A
+        :class:`DecoderOutputCache` is used only if `contexts` is a list,
+        since looking up tensor contexts in it would copy them to the host.
+    Returns:
+      Return a tensor of shape (len(contexts), 1, joiner_dim).
+    """
+    if isinstance(contexts, torch.Tensor):
+        if isinstance(decoder_cache, DecoderOutputTable):
+            return decoder_cache.lookup(contexts)
+        decoder_input = contexts
+    else:
+        if decoder_cache is not None:
+            return decoder_cache(contexts)
+        device = next(model.parameters()).device
+        decoder_input = torch.tensor(contexts, device=device, dtype=torch.int64)
+
+    decoder_out = model.decoder(decoder_input, need_pad=False)
+    return model.joiner.decoder_proj(decoder_out)
+
+
 def greedy_search(
     model: nn.Module,
     encoder_out: torch.Tensor,
     max_sym_per_frame: int,
     blank_penalty: float = 0.0,
     return_timestamps: bool = False,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> Union[List[int], DecodingResults]:
     """Greedy search for a single utterance.
     Args:
@@ -568,6 +625,9 @@ def greedy_search(
         would be 100%.
       return_timestamps:
         Whether to return timestamps.
+      decoder_cache:
+        If not None, it is used to look up the decoder output instead of
+        running the decoder.
     Returns:
       If return_timestamps is False, return the decoded result.
       Else, return a DecodingResults object containing
@@ -582,14 +642,9 @@ def greedy_search(
     context_size = model.decoder.context_size
     unk_id = getattr(model, "unk_id", blank_id)
 
-    device = next(model.parameters()).device
-
-    decoder_input = torch.tensor(
-        [-1] * (context_size - 1) + [blank_id], device=device, dtype=torch.int64
-    ).reshape(1, context_size)
-
-    decoder_out = model.decoder(decoder_input, need_pad=False)
-    decoder_out = model.joiner.decoder_proj(decoder_out)
+    decoder_out = compute_decoder_out(
+        model, [[-1] * (context_size - 1) + [blank_id]], decoder_cache
+    )
 
     encoder_out = model.joiner.encoder_proj(encoder_out)
 
@@ -631,13 +686,10 @@ def greedy_search(
         if y not in (blank_id, unk_id):
             hyp.append(y)
             timestamp.append(t)
-            decoder_input = torch.tensor([hyp[-context_size:]], device=device).reshape(
-                1, context_size
+            decoder_out = compute_decoder_out(
+                model, [hyp[-context_size:]], decoder_cache
             )
 
-            decoder_out = model.decoder(decoder_input, need_pad=False)
-            decoder_out = model.joiner.decoder_proj(decoder_out)
-
             sym_per_utt += 1
             sym_per_frame += 1
         else:
@@ -660,8 +712,16 @@ def greedy_search_batch(
     encoder_out_lens: torch.Tensor,
     blank_penalty: float = 0,
     return_timestamps: bool = False,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> Union[List[List[int]], DecodingResults]:
     """Greedy search in batch mode. It hardcodes --max-sym-per-frame=1.
+
+    The emitted tokens, their scores and the decoder contexts are kept in
+    tensors on the device of the model and updated with tensor ops, so
+    that there is no synchronization with the host until all frames are
+    processed. The decoder is run for every frame, since checking whether
+    any token is emitted would require a synchronization.
+
     Args:
       model:
         The transducer model.
@@ -672,6 +732,11 @@ def greedy_search_batch(
         encoder_out before padding.
       return_timestamps:
         Whether to return timestamps.
+      decoder_cache:
+        If it is a :class:`DecoderOutputTable`, the decoder output of each
+        utterance is looked up in it instead of running the decoder. A
+        :class:`DecoderOutputCache` is ignored, since it would copy the
+        contexts to the host on every frame.
     Returns:
       If return_timestamps is False, return the decoded result.
       Else, return a DecodingResults object containing
@@ -695,27 +760,23 @@ def greedy_search_batch(
 
     batch_size_list = packed_encoder_out.batch_sizes.tolist()
     N = encoder_out.size(0)
+    T = len(batch_size_list)
     assert torch.all(encoder_out_lens > 0), encoder_out_lens
     assert N == batch_size_list[0], (N, batch_size_list)
 
-    hyps = [[-1] * (context_size - 1) + [blank_id] for _ in range(N)]
-
-    # timestamp[n][i] is the frame index after subsampling
-    # on which hyp[n][i] is decoded
-    timestamps = [[] for _ in range(N)]
-    # scores[n][i] is the logits on which hyp[n][i] is decoded
-    scores = [[] for _ in range(N)]
-
-    decoder_input = torch.tensor(
-        hyps,
-        device=device,
-        dtype=torch.int64,
-    )  # (N, context_size)
+    contexts = torch.tensor(
+        [-1] * (context_size - 1) + [blank_id], device=device, dtype=torch.int64
+    ).repeat(N, 1)
+    # contexts: (N, context_size)
 
-    decoder_out = model.decoder(decoder_input, need_pad=False)
-    decoder_out = model.joiner.decoder_proj(decoder_out)
+    decoder_out = compute_decoder_out(model, contexts, decoder_cache)
     # decoder_out: (N, 1, decoder_out_dim)
 
+    # tokens[n, t] is the token emitted by the n-th utterance on frame t,
+    # or -1 if it emits nothing. scores[n, t] is the logit of that token.
+    tokens = torch.full((N, T), -1, device=device, dtype=torch.int64)
+    scores = torch.zeros(N, T, device=device)
+
     encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
 
     offset = 0
@@ -728,6 +789,7 @@ def greedy_search_batch(
         offset = end
 
         decoder_out = decoder_out[:batch_size]
+        contexts = contexts[:batch_size]
 
         logits = model.joiner(
             current_encoder_out, decoder_out.unsqueeze(1), project_input=False
@@ -740,34 +802,33 @@ def greedy_search_batch(
         if blank_penalty != 0:
             logits[:, 0] -= blank_penalty
 
-        y = logits.argmax(dim=1).tolist()
-        emitted = False
-        for i, v in enumerate(y):
-            if v not in (blank_id, unk_id):
-                hyps[i].append(v)
-                timestamps[i].append(t)
-                scores[i].append(logits[i, v].item())
-                emitted = True
-        if emitted:
-            # update decoder output
-            decoder_input = [h[-context_size:] for h in hyps[:batch_size]]
-            decoder_input = torch.tensor(
-                decoder_input,
-                device=device,
-                dtype=torch.int64,
-            )
-            decoder_out = model.decoder(decoder_input, need_pad=False)
-            decoder_out = model.joiner.decoder_proj(decoder_out)
+        y = logits.argmax(dim=1)
+        emitted = (y != blank_id) & (y != unk_id)
+        tokens[:batch_size, t] = y.masked_fill(~emitted, -1)
+        scores[:batch_size, t] = logits.gather(1, y.unsqueeze(1)).squeeze(1)
+
+        # update decoder output
+        new_contexts = torch.cat([contexts[:, 1:], y.unsqueeze(1)], dim=1)
+        contexts = torch.where(emitted.unsqueeze(1), new_contexts, contexts)
+        decoder_out = compute_decoder_out(model, contexts, decoder_cache)
+
+    # Copy the results to the host at once
+    tokens = tokens.cpu()
+    scores = scores.cpu()
+    mask = tokens >= 0
+    num_tokens = mask.sum(dim=1).tolist()
+    sorted_ans = tokens[mask].split(num_tokens)
+    sorted_timestamps = mask.nonzero()[:, 1].split(num_tokens)
+    sorted_scores = scores[mask].split(num_tokens)
 
-    sorted_ans = [h[context_size:] for h in hyps]
     ans = []
     ans_timestamps = []
     ans_scores = []
     unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
     for i in range(N):
-        ans.append(sorted_ans[unsorted_indices[i]])
-        ans_timestamps.append(timestamps[unsorted_indices[i]])
-        ans_scores.append(scores[unsorted_indices[i]])
+        ans.append(sorted_ans[unsorted_indices[i]].tolist())
+        ans_timestamps.append(sorted_timestamps[unsorted_indices[i]].tolist())
+        ans_scores.append(sorted_scores[unsorted_indices[i]].tolist())
 
     if not return_timestamps:
         return ans
@@ -779,44 +840,365 @@ def greedy_search_batch(
         )
 
 
-@dataclass
-class Hypothesis:
-    # The predicted tokens so far.
-    # Newly predicted tokens are appended to `ys`.
-    ys: List[int]
+def greedy_search_batch_multi_sym(
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    max_sym_per_frame: int,
+    blank_penalty: float = 0.0,
+    return_timestamps: bool = False,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    check_interval: int = 8,
+    initial_contexts: Optional[torch.Tensor] = None,
+) -> Union[List[List[int]], DecodingResults]:
+    """Greedy search in batch mode with up to `max_sym_per_frame` symbols
+    per frame. It gives the same result as :func:`greedy_search` on each
+    utterance.
+
+    Each utterance has its own frame pointer. At each step, the joiner is
+    run on the current frame of every utterance. An utterance that emits a
+    token stays on its frame, unless it has already emitted
+    `max_sym_per_frame` tokens on it; otherwise it moves to the next frame.
+    All of this is done with tensor ops on the device of the model. Since
+    checking whether all utterances are done requires a synchronization
+    with the host, it is done only every `check_interval` steps, after the
+    minimum number of steps, i.e., the number of frames of the longest
+    utterance.
 
-    # The log prob of ys.
-    # It contains only one entry.
-    log_prob: torch.Tensor
+    Args:
+      model:
+        The transducer model.
+      encoder_out:
+        Output from the encoder. Its shape is (N, T, C), where N >= 1.
+      encoder_out_lens:
+        A 1-D tensor of shape (N,), containing number of valid frames in
+        encoder_out before padding.
+      max_sym_per_frame:
+        Maximum number of symbols per frame.
+      return_timestamps:
+        Whether to return timestamps.
+      decoder_cache:
+        If it is a :class:`DecoderOutputTable`, the decoder output of each
+        utterance is looked up in it instead of running the decoder. A
+        :class:`DecoderOutputCache` is ignored, since it would copy the
+        contexts to the host on every step.
+      check_interval:
+        Number of steps between two checks for termination.
+      initial_contexts:
+        If not None, a 2-D int64 tensor of shape (N, context_size) with the
+        last tokens decoded before `encoder_out`, e.g., in the previous
+        chunk of a stream. Otherwise, decoding starts from blanks.
+    Returns:
+      If return_timestamps is False, return the decoded result.
+      Else, return a DecodingResults object containing
+      decoded result and corresponding timestamps.
+    """
+    assert encoder_out.ndim == 3
+    assert encoder_out.size(0) >= 1, encoder_out.size(0)
+    assert max_sym_per_frame >= 1, max_sym_per_frame
+
+    device = next(model.parameters()).device
+
+    blank_id = model.decoder.blank_id
+    unk_id = getattr(model, "unk_id", blank_id)
+    context_size = model.decoder.context_size
+
+    N, T = encoder_out.size(0), encoder_out.size(1)
+    assert torch.all(encoder_out_lens > 0), encoder_out_lens
+    encoder_out_lens = encoder_out_lens.to(device)
+
+    # Same as greedy_search()
+    max_sym_per_utt = 1000
+    max_num_tokens = min(T * max_sym_per_frame, max_sym_per_utt)
+    max_num_steps = T + max_num_tokens
+    min_num_steps = int(encoder_out_lens.max())
+
+    encoder_out = model.joiner.encoder_proj(encoder_out)
+    # encoder_out: (N, T, joiner_dim)
+
+    if initial_contexts is None:
+        contexts = torch.tensor(
+            [-1] * (context_size - 1) + [blank_id], device=device, dtype=torch.int64
+        ).repeat(N, 1)
+    else:
+        assert initial_contexts.shape == (N, context_size), initial_contexts.shape
+        contexts = initial_contexts.to(device=device, dtype=torch.int64)
+    decoder_out = compute_decoder_out(model, contexts, decoder_cache)
+    # decoder_out: (N, 1, joiner_dim)
+
+    # The i-th token of the n-th utterance is tokens[n, i], decoded on frame
+    # timestamps[n, i] with logit scores[n, i]. The extra last column
+    # receives the writes of the utterances that emit nothing.
+    tokens = torch.zeros(N, max_num_tokens + 1, device=device, dtype=torch.int64)
+    timestamps = torch.zeros_like(tokens)
+    scores = torch.zeros(N, max_num_tokens + 1, device=device)
+    num_tokens = torch.zeros(N, device=device, dtype=torch.int64)
+
+    # Frame pointer and number of symbols emitted on it
+    t = torch.zeros(N, device=device, dtype=torch.int64)
+    sym_per_frame = torch.zeros(N, device=device, dtype=torch.int64)
+    utt_index = torch.arange(N, device=device)
+
+    for step in range(max_num_steps):
+        active = (t < encoder_out_lens) & (num_tokens < max_sym_per_utt)
+        if (
+            step >= min_num_steps
+            and (step - min_num_steps) % check_interval == 0
+            and not active.any()
+        ):
+            break
+
+        current_encoder_out = encoder_out[utt_index, t.clamp(max=T - 1)]
+        logits = model.joiner(
+            current_encoder_out.unsqueeze(1).unsqueeze(1),
+            decoder_out.unsqueeze(1),
+            project_input=False,
+        )
+        logits = logits.squeeze(1).squeeze(1)  # (N, vocab_size)
+
+        if blank_penalty != 0:
+            logits[:, 0] -= blank_penalty
+
+        y = logits.argmax(dim=1)
+        emitted = (
+            active
+            & (sym_per_frame < max_sym_per_frame)
+            & (y != blank_id)
+            & (y != unk_id)
+        )
+
+        index = torch.where(emitted, num_tokens, max_num_tokens).unsqueeze(1)
+        tokens.scatter_(1, index, y.unsqueeze(1))
+        timestamps.scatter_(1, index, t.unsqueeze(1))
+        scores.scatter_(1, index, logits.gather(1, y.unsqueeze(1)))
+        num_tokens += emitted
+
+        # Utterances that emit nothing move to the next frame
+        t += active & ~emitted
+        sym_per_frame = torch.where(emitted, sym_per_frame + 1, 0)
+
+        new_contexts = torch.cat([contexts[:, 1:], y.unsqueeze(1)], dim=1)
+        contexts = torch.where(emitted.unsqueeze(1), new_contexts, contexts)
+        decoder_out = compute_decoder_out(model, contexts, decoder_cache)
+
+    # Copy the results to the host at once
+    num_tokens = num_tokens.tolist()
+    tokens = tokens.tolist()
+    timestamps = timestamps.tolist()
+    scores = scores.tolist()
+
+    ans = [tokens[n][: num_tokens[n]] for n in range(N)]
+    if not return_timestamps:
+        return ans
+    else:
+        return DecodingResults(
+            hyps=ans,
+            timestamps=[timestamps[n][: num_tokens[n]] for n in range(N)],
+            scores=[scores[n][: num_tokens[n]] for n in range(N)],
+        )
+
+
+# Multiplier of the rolling hash of token sequences. Hashes are 64-bit
+# and wrap around on overflow.
+_HASH_MULTIPLIER = 1000003
+_HASH_MASK = (1 << 64) - 1
+
+
+class TokenNode(object):
+    """A node in a trie of token sequences.
+
+    A hypothesis points to the node of its last token. Appending a token
+    creates a child node, so that hypotheses sharing a prefix share its
+    nodes and no list is copied when a hypothesis is extended. Each node also
+    keeps the length of its sequence and a rolling hash of it, which together
+    are the key of the hypothesis. As different sequences may have the same
+    key, :meth:`same_tokens` is used to tell them apart.
+    """
+
+    __slots__ = ("token", "timestamp", "parent", "length", "hash")
+
+    def __init__(
+        self,
+        token: int,
+        timestamp: Optional[int] = None,
+        parent: Optional["TokenNode"] = None,
+    ):
+        """
+        Args:
+          token:
+            The token of this node.
+          timestamp:
+            The frame index after subsampling on which `token` is decoded,
+            or None for the initial context.
+          parent:
+            The node of the previous token, or None for the first token.
+        """
+        self.token = token
+        self.timestamp = timestamp
+        self.parent = parent
+        if parent is None:
+            self.length = 1
+            self.hash = token + 1
+        else:
+            self.length = parent.length + 1
+            self.hash = (parent.hash * _HASH_MULTIPLIER + token + 1) & _HASH_MASK
+
+    def append(self, token: int, timestamp: Optional[int] = None) -> "TokenNode":
+        """Return the node of the sequence extended with `token`."""
+        return TokenNode(token, timestamp, self)
+
+    @staticmethod
+    def from_list(ys: List[int], timestamp: Optional[List[int]] = None) -> "TokenNode":
+        """Build a chain of nodes from a list of tokens. `timestamp`, if
+        given, contains the timestamps of the last len(timestamp) tokens."""
+        assert len(ys) > 0
+        if timestamp is None:
+            timestamp = []
+        num_untimed = len(ys) - len(timestamp)
+        assert num_untimed >= 0, (len(ys), len(timestamp))
+
+        node = None
+        for i, token in enumerate(ys):
+            t = timestamp[i - num_untimed] if i >= num_untimed else None
+            node = TokenNode(token, t, node)
+        return node
+
+    def same_tokens(self, other: "TokenNode") -> bool:
+        """Return True if the token sequences ending at `self` and `other`
+        are equal. The chains are walked back only until they meet, which is
+        immediately for hypotheses that share their last node."""
+        if self.length != other.length or self.hash != other.hash:
+            return False
+        a, b = self, other
+        while a is not b:
+            if a.token != b.token:
+                return False
+            a, b = a.parent, b.parent
+        return True
+
+    def tokens(self) -> List[int]:
+        """Return the token sequence ending at this node."""
+        ans = []
+        node = self
+        while node is not None:
+            ans.append(node.token)
+            node = node.parent
+        ans.reverse()
+        return ans
+
+    def timestamps(self) -> List[int]:
+        """Return the timestamps of the tokens that have one."""
+        ans = []
+        node = self
+        while node is not None:
+            if node.timestamp is not None:
+                ans.append(node.timestamp)
+            node = node.parent
+        ans.reverse()
+        return ans
+
+    def context(self, context_size: int) -> List[int]:
+        """Return the last `context_size` tokens."""
+        ans = []
+        node = self
+        while node is not None and len(ans) < context_size:
+            ans.append(node.token)
+            node = node.parent
+        ans.reverse()
+        return ans
 
-    # timestamp[i] is the frame index after subsampling
-    # on which ys[i] is decoded
-    timestamp: List[int] = field(default_factory=list)
 
-    # the lm score for next token given the current ys
-    lm_score: Optional[torch.Tensor] = None
+class Hypothesis(object):
+    """A hypothesis of the beam search.
 
-    # the RNNLM states (h and c in LSTM)
-    state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+    The tokens are stored in a :class:`TokenNode` trie. `ys` and `timestamp`
+    are built from it on access, which costs time linear in the length of the
+    hypothesis. Code that runs once per hypothesis and frame should use
+    `node`, `context()`, `num_tokens` and `key` instead.
+    """
+
+    __slots__ = (
+        "node",
+        "log_prob",
+        "lm_score",
+        "state",
+        "state_cost",
+        "context_state",
+    )
+
+    def __init__(
+        self,
+        ys: Optional[List[int]] = None,
+        log_prob: Optional[torch.Tensor] = None,
+        timestamp: Optional[List[int]] = None,
+        lm_score: Optional[torch.Tensor] = None,
+        state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        state_cost: Optional[NgramLmStateCost] = None,
+        context_state: Optional[ContextState] = None,
+        node: Optional[TokenNode] = None,
+    ):
+        """
+        Args:
+          ys:
+            The predicted tokens so far. Ignored if `node` is given.
+          log_prob:
+            The log prob of ys. It contains only one entry.
+          timestamp:
+            timestamp[i] is the frame index after subsampling on which the
+            i-th non-context token of ys is decoded. Ignored if `node` is
+            given.
+          lm_score:
+            The lm score for next token given the current ys.
+          state:
+            The RNNLM states (h and c in LSTM).
+          state_cost:
+            N-gram LM state.
+          context_state:
+            Context graph state.
+          node:
+            The trie node of the last token.
+        """
+        if node is None:
+            node = TokenNode.from_list(ys, timestamp)
+        self.node = node
+        self.log_prob = log_prob
+        self.lm_score = lm_score
+        self.state = state
+        self.state_cost = state_cost
+        self.context_state = context_state
 
-    # N-gram LM state
-    state_cost: Optional[NgramLmStateCost] = None
+    @property
+    def ys(self) -> List[int]:
+        return self.node.tokens()
 
-    # Context graph state
-    context_state: Optional[ContextState] = None
+    @property
+    def timestamp(self) -> List[int]:
+        return self.node.timestamps()
 
     @property
-    def key(self) -> str:
-        """Return a string representation of self.ys"""
-        return "_".join(map(str, self.ys))
+    def num_tokens(self) -> int:
+        """Return len(self.ys)."""
+        return self.node.length
+
+    def context(self, context_size: int) -> List[int]:
+        """Return self.ys[-context_size:]."""
+        return self.node.context(context_size)
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        """Return the length and a hash of self.ys. Different sequences
+        may have the same key, see :meth:`TokenNode.same_tokens`."""
+        return self.node.length, self.node.hash
 
 
 class HypothesisList(object):
-    def __init__(self, data: Optional[Dict[str, Hypothesis]] = None) -> None:
+    def __init__(self, data: Optional[Dict[tuple, Hypothesis]] = None) -> None:
         """
         Args:
           data:
-            A dict of Hypotheses. Its key is its `value.key`.
+            A dict of Hypotheses. Its key is its `value.key`, followed by
+            a probe number if another hypothesis with a different `ys` has
+            the same `value.key`.
         """
         if data is None:
             self._data = {}
@@ -824,9 +1206,20 @@ class HypothesisList(object):
             self._data = data
 
     @property
-    def data(self) -> Dict[str, Hypothesis]:
+    def data(self) -> Dict[tuple, Hypothesis]:
         return self._data
 
+    def _find_key(self, hyp: Hypothesis) -> tuple:
+        """Return the key under which `hyp`, or a hypothesis with the same
+        `ys`, is stored in `self`, or the first free key for it if there is
+        no such hypothesis."""
+        key = hyp.key
+        probe = 0
+        while key in self._data and not self._data[key].node.same_tokens(hyp.node):
+            probe += 1
+            key = hyp.key + (probe,)
+        return key
+
     def add(self, hyp: Hypothesis) -> None:
         """Add a Hypothesis to `self`.
 
@@ -837,7 +1230,7 @@ class HypothesisList(object):
           hyp:
             The hypothesis to be added.
         """
-        key = hyp.key
+        key = self._find_key(hyp)
         if key in self:
             old_hyp = self._data[key]  # shallow copy
             torch.logaddexp(old_hyp.log_prob, hyp.log_prob, out=old_hyp.log_prob)
@@ -856,7 +1249,9 @@ class HypothesisList(object):
           Return the hypothesis that has the largest `log_prob`.
         """
         if length_norm:
-            return max(self._data.values(), key=lambda hyp: hyp.log_prob / len(hyp.ys))
+            return max(
+                self._data.values(), key=lambda hyp: hyp.log_prob / hyp.num_tokens
+            )
         else:
             return max(self._data.values(), key=lambda hyp: hyp.log_prob)
 
@@ -872,10 +1267,20 @@ class HypothesisList(object):
             Note: It must be contained in `self`. Otherwise,
             an exception is raised.
         """
-        key = hyp.key
-        assert key in self, f"{key} does not exist"
+        key = self._find_key(hyp)
+        assert key in self, f"{hyp.ys} does not exist"
         del self._data[key]
 
+        # Move the hypotheses probed after `hyp` one step back, so that the
+        # probe numbers of a key stay contiguous for _find_key()
+        probe = key[2] if len(key) > 2 else 0
+        next_key = hyp.key + (probe + 1,)
+        while next_key in self._data:
+            self._data[key] = self._data.pop(next_key)
+            key = next_key
+            probe += 1
+            next_key = hyp.key + (probe + 1,)
+
     def filter(self, threshold: torch.Tensor) -> "HypothesisList":
         """Remove all Hypotheses whose log_prob is less than threshold.
 
@@ -904,15 +1309,19 @@ class HypothesisList(object):
 
         if length_norm:
             hyps = sorted(
-                hyps, key=lambda h: h[1].log_prob / len(h[1].ys), reverse=True
+                hyps, key=lambda h: h[1].log_prob / h[1].num_tokens, reverse=True
             )[:k]
         else:
             hyps = sorted(hyps, key=lambda h: h[1].log_prob, reverse=True)[:k]
 
-        ans = HypothesisList(dict(hyps))
+        # Added one by one, as dropped hypotheses may leave gaps in the
+        # probe numbers
+        ans = HypothesisList()
+        for _, hyp in hyps:
+            ans.add(hyp)  # shallow copy
         return ans
 
-    def __contains__(self, key: str):
+    def __contains__(self, key: tuple):
         return key in self._data
 
     def __iter__(self):
@@ -923,8 +1332,8 @@ class HypothesisList(object):
 
     def __str__(self) -> str:
         s = []
-        for key in self:
-            s.append(key)
+        for hyp in self:
+            s.append("_".join(map(str, hyp.ys)))
         return ", ".join(s)
 
 
@@ -962,6 +1371,7 @@ def modified_beam_search(
     temperature: float = 1.0,
     blank_penalty: float = 0.0,
     return_timestamps: bool = False,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> Union[List[List[int]], DecodingResults]:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
 
@@ -979,6 +1389,9 @@ def modified_beam_search(
         Softmax temperature.
       return_timestamps:
         Whether to return timestamps.
+      decoder_cache:
+        If not None, it is used to look up the decoder output of each
+        hypothesis instead of running the decoder.
     Returns:
       If return_timestamps is False, return the decoded result.
       Else, return a DecodingResults object containing
@@ -1040,14 +1453,11 @@ def modified_beam_search(
             [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
         )  # (num_hyps, 1)
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
-
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(
+            model,
+            [hyp.context(context_size) for hyps in A for hyp in hyps],
+            decoder_cache,
+        ).unsqueeze(1)
         # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
 
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
@@ -1094,14 +1504,12 @@ def modified_beam_search(
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
-                new_ys = hyp.ys[:]
+                new_node = hyp.node
                 new_token = topk_token_indexes[k]
-                new_timestamp = hyp.timestamp[:]
                 context_score = 0
                 new_context_state = None if context_graph is None else hyp.context_state
                 if new_token not in (blank_id, unk_id):
-                    new_ys.append(new_token)
-                    new_timestamp.append(t)
+                    new_node = new_node.append(new_token, t)
                     if context_graph is not None:
                         (
                             context_score,
@@ -1111,9 +1519,8 @@ def modified_beam_search(
                 new_log_prob = topk_log_probs[k] + context_score
 
                 new_hyp = Hypothesis(
-                    ys=new_ys,
+                    node=new_node,
                     log_prob=new_log_prob,
-                    timestamp=new_timestamp,
                     context_state=new_context_state,
                 )
                 B[i].add(new_hyp)
@@ -1131,9 +1538,8 @@ def modified_beam_search(
                 )
                 finalized_B[i].add(
                     Hypothesis(
-                        ys=hyp.ys,
+                        node=hyp.node,
                         log_prob=hyp.log_prob + context_score,
-                        timestamp=hyp.timestamp,
                         context_state=new_context_state,
                     )
                 )
@@ -1159,6 +1565,205 @@ def modified_beam_search(
         )
 
 
+def modified_beam_search_tensorized(
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    beam: int = 4,
+    temperature: float = 1.0,
+    blank_penalty: float = 0.0,
+    return_timestamps: bool = False,
+    decoder_table: Optional[DecoderOutputTable] = None,
+) -> Union[List[List[int]], DecodingResults]:
+    """Same as :func:`modified_beam_search` without context graph, but the
+    beams are kept in fixed-size tensors instead of :class:`HypothesisList`,
+    so that each frame is processed by a handful of batched ops with no
+    Python loop over utterances or hypotheses.
+
+    Each utterance has exactly `beam` slots. For each slot, we keep its
+    score, its last `context_size` tokens (the decoder input), its number of
+    tokens and a rolling hash of its tokens. Hypotheses with the same tokens
+    are detected by comparing the numbers of tokens and the hashes, and
+    merged with log-sum-exp. Unlike :class:`HypothesisList`, the tokens are
+    not compared, so two different sequences of the same length are merged
+    if their 64-bit hashes collide. The
+    token sequences are not stored; instead, for each frame, we store the
+    slot each hypothesis comes from and the token it emits, and the best
+    hypotheses are recovered by backtracking after the last frame.
+
+    Args:
+      model:
+        The transducer model.
+      encoder_out:
+        Output from the encoder. Its shape is (N, T, C).
+      encoder_out_lens:
+        A 1-D tensor of shape (N,), containing number of valid frames in
+        encoder_out before padding.
+      beam:
+        Number of active paths during the beam search.
+      temperature:
+        Softmax temperature.
+      return_timestamps:
+        Whether to return timestamps.
+      decoder_table:
+        If not None, the decoder output of each slot is gathered from it
+        instead of running the decoder.
+    Returns:
+      If return_timestamps is False, return the decoded result.
+      Else, return a DecodingResults object containing
+      decoded result and corresponding timestamps.
+    """
+    assert encoder_out.ndim == 3, encoder_out.shape
+    assert encoder_out.size(0) >= 1, encoder_out.size(0)
+
+    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
+        input=encoder_out,
+        lengths=encoder_out_lens.cpu(),
+        batch_first=True,
+        enforce_sorted=False,
+    )
+
+    blank_id = model.decoder.blank_id
+    unk_id = getattr(model, "unk_id", blank_id)
+    context_size = model.decoder.context_size
+    device = next(model.parameters()).device
+
+    batch_size_list = packed_encoder_out.batch_sizes.tolist()
+    N = encoder_out.size(0)
+    T = len(batch_size_list)
+    K = beam
+    assert torch.all(encoder_out_lens > 0), encoder_out_lens
+    assert N == batch_size_list[0], (N, batch_size_list)
+
+    # Only the first slot of each utterance is active at the beginning
+    scores = torch.full((N, K), float("-inf"), device=device)
+    scores[:, 0] = 0
+    contexts = torch.tensor(
+        [-1] * (context_size - 1) + [blank_id], device=device, dtype=torch.int64
+    ).repeat(N, K, 1)
+    num_tokens = torch.zeros(N, K, device=device, dtype=torch.int64)
+    hashes = torch.zeros(N, K, device=device, dtype=torch.int64)
+
+    # For frame t, parents[t, n, k] is the slot of the previous frame that
+    # hypothesis k of utterance n comes from, and tokens[t, n, k] is the
+    # token it emits on frame t, or -1 if it emits nothing.
+    parents = torch.arange(K, device=device).expand(T, N, K).clone()
+    tokens = torch.full((T, N, K), -1, device=device, dtype=torch.int64)
+
+    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+
+    offset = 0
+    for (t, batch_size) in enumerate(batch_size_list):
+        start = offset
+        end = offset + batch_size
+        current_encoder_out = encoder_out.data[start:end]
+        # current_encoder_out's shape is (batch_size, encoder_out_dim)
+        offset = end
+
+        decoder_input = contexts[:batch_size].reshape(-1, context_size)
+        if decoder_table is not None:
+            decoder_out = decoder_table.lookup(decoder_input)
+        else:
+            decoder_out = model.decoder(decoder_input, need_pad=False)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
+        # decoder_out is of shape (batch_size * K, 1, joiner_dim)
+
+        current_encoder_out = current_encoder_out.repeat_interleave(K, dim=0)
+        logits = model.joiner(
+            current_encoder_out.unsqueeze(1).unsqueeze(1),
+            decoder_out.unsqueeze(1),
+            project_input=False,
+        )  # (batch_size * K, 1, 1, vocab_size)
+
+        logits = logits.squeeze(1).squeeze(1)  # (batch_size * K, vocab_size)
+
+        if blank_penalty != 0:
+            logits[:, 0] -= blank_penalty
+
+        log_probs = (logits / temperature).log_softmax(dim=-1)
+        vocab_size = log_probs.size(-1)
+        log_probs = log_probs.reshape(batch_size, K, vocab_size)
+        log_probs.add_(scores[:batch_size].unsqueeze(2))
+
+        topk_scores, topk_indexes = log_probs.reshape(batch_size, -1).topk(K)
+        parent = torch.div(topk_indexes, vocab_size, rounding_mode="floor")
+        token = topk_indexes % vocab_size
+        emitted = (token != blank_id) & (token != unk_id)
+
+        # Follow the parent pointers and append the emitted tokens
+        new_contexts = contexts[:batch_size].gather(
+            1, parent.unsqueeze(2).expand(batch_size, K, context_size)
+        )
+        new_contexts = torch.where(
+            emitted.unsqueeze(2),
+            torch.cat([new_contexts[:, :, 1:], token.unsqueeze(2)], dim=2),
+            new_contexts,
+        )
+        new_hashes = hashes[:batch_size].gather(1, parent)
+        new_hashes = torch.where(
+            emitted, new_hashes * _HASH_MULTIPLIER + token + 1, new_hashes
+        )
+        new_num_tokens = num_tokens[:batch_size].gather(1, parent) + emitted
+
+        # Merge hypotheses with the same tokens into the first of them
+        valid = topk_scores > float("-inf")
+        same = (
+            (new_hashes.unsqueeze(2) == new_hashes.unsqueeze(1))
+            & (new_num_tokens.unsqueeze(2) == new_num_tokens.unsqueeze(1))
+            & (valid.unsqueeze(2) & valid.unsqueeze(1))
+        )  # (batch_size, K, K)
+        merged_scores = (
+            topk_scores.unsqueeze(1)
+            .expand(batch_size, K, K)
+            .masked_fill(~same, float("-inf"))
+            .logsumexp(dim=2)
+        )
+        # argmax() returns the index of the first maximal value
+        is_first = same.long().argmax(dim=2) == torch.arange(K, device=device)
+        merged_scores.masked_fill_(~(is_first & valid), float("-inf"))
+
+        scores[:batch_size] = merged_scores
+        contexts[:batch_size] = new_contexts
+        hashes[:batch_size] = new_hashes
+        num_tokens[:batch_size] = new_num_tokens
+        parents[t, :batch_size] = parent
+        tokens[t, :batch_size] = token.masked_fill(~emitted, -1)
+
+    # Same as get_most_probable(length_norm=True), where the length includes
+    # the initial context
+    best = (scores / (num_tokens + context_size)).argmax(dim=1, keepdim=True)
+
+    # Backtrack from the best hypotheses
+    best_tokens = torch.empty(T, N, device=device, dtype=torch.int64)
+    k = best
+    for t in range(T - 1, -1, -1):
+        best_tokens[t] = tokens[t].gather(1, k).squeeze(1)
+        k = parents[t].gather(1, k)
+
+    best_tokens = best_tokens.t().tolist()
+
+    sorted_ans = []
+    sorted_timestamps = []
+    for utt_tokens in best_tokens:
+        sorted_ans.append([v for v in utt_tokens if v >= 0])
+        sorted_timestamps.append([t for t, v in enumerate(utt_tokens) if v >= 0])
+
+    ans = []
+    ans_timestamps = []
+    unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
+    for i in range(N):
+        ans.append(sorted_ans[unsorted_indices[i]])
+        ans_timestamps.append(sorted_timestamps[unsorted_indices[i]])
+
+    if not return_timestamps:
+        return ans
+    else:
+        return DecodingResults(
+            hyps=ans,
+            timestamps=ans_timestamps,
+        )
+
+
 def modified_beam_search_lm_rescore(
     model: nn.Module,
     encoder_out: torch.Tensor,
@@ -1248,7 +1853,7 @@ def modified_beam_search_lm_rescore(
         )  # (num_hyps, 1)
 
         decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+            [hyp.context(context_size) for hyps in A for hyp in hyps],
             device=device,
             dtype=torch.int64,
         )  # (num_hyps, context_size)
@@ -1299,17 +1904,13 @@ def modified_beam_search_lm_rescore(
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
 
-                new_ys = hyp.ys[:]
+                new_node = hyp.node
                 new_token = topk_token_indexes[k]
-                new_timestamp = hyp.timestamp[:]
                 if new_token not in (blank_id, unk_id):
-                    new_ys.append(new_token)
-                    new_timestamp.append(t)
+                    new_node = new_node.append(new_token, t)
 
                 new_log_prob = topk_log_probs[k]
-                new_hyp = Hypothesis(
-                    ys=new_ys, log_prob=new_log_prob, timestamp=new_timestamp
-                )
+                new_hyp = Hypothesis(node=new_node, log_prob=new_log_prob)
                 B[i].add(new_hyp)
 
     B = B + finalized_B
@@ -1448,7 +2049,7 @@ def modified_beam_search_lm_rescore_LODR(
         )  # (num_hyps, 1)
 
         decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+            [hyp.context(context_size) for hyps in A for hyp in hyps],
             device=device,
             dtype=torch.int64,
         )  # (num_hyps, context_size)
@@ -1499,17 +2100,13 @@ def modified_beam_search_lm_rescore_LODR(
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
 
-                new_ys = hyp.ys[:]
+                new_node = hyp.node
                 new_token = topk_token_indexes[k]
-                new_timestamp = hyp.timestamp[:]
                 if new_token not in (blank_id, unk_id):
-                    new_ys.append(new_token)
-                    new_timestamp.append(t)
+                    new_node = new_node.append(new_token, t)
 
                 new_log_prob = topk_log_probs[k]
-                new_hyp = Hypothesis(
-                    ys=new_ys, log_prob=new_log_prob, timestamp=new_timestamp
-                )
+                new_hyp = Hypothesis(node=new_node, log_prob=new_log_prob)
                 B[i].add(new_hyp)
 
     B = B + finalized_B
@@ -1636,7 +2233,7 @@ def _deprecated_modified_beam_search(
         # ys_log_probs is of shape (num_hyps, 1)
 
         decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyp in A],
+            [hyp.context(context_size) for hyp in A],
             device=device,
             dtype=torch.int64,
         )
@@ -1677,16 +2274,12 @@ def _deprecated_modified_beam_search(
 
         for i in range(len(topk_hyp_indexes)):
             hyp = A[topk_hyp_indexes[i]]
-            new_ys = hyp.ys[:]
-            new_timestamp = hyp.timestamp[:]
+            new_node = hyp.node
             new_token = topk_token_indexes[i]
             if new_token not in (blank_id, unk_id):
-                new_ys.append(new_token)
-                new_timestamp.append(t)
+                new_node = new_node.append(new_token, t)
             new_log_prob = topk_log_probs[i]
-            new_hyp = Hypothesis(
-                ys=new_ys, log_prob=new_log_prob, timestamp=new_timestamp
-            )
+            new_hyp = Hypothesis(node=new_node, log_prob=new_log_prob)
             B.add(new_hyp)
 
     best_hyp = B.get_most_probable(length_norm=True)
@@ -1763,7 +2356,7 @@ def beam_search(
 
     sym_per_utt = 0
 
-    decoder_cache: Dict[str, torch.Tensor] = {}
+    decoder_cache: Dict[tuple, torch.Tensor] = {}
 
     while t < T and sym_per_utt < max_sym_per_utt:
         # fmt: off
@@ -1772,7 +2365,7 @@ def beam_search(
         A = B
         B = HypothesisList()
 
-        joint_cache: Dict[str, torch.Tensor] = {}
+        joint_cache: Dict[tuple, torch.Tensor] = {}
 
         # TODO(fangjun): Implement prefix search to update the `log_prob`
         # of hypotheses in A
@@ -1781,11 +2374,11 @@ def beam_search(
             y_star = A.get_most_probable()
             A.remove(y_star)
 
-            cached_key = y_star.key
+            cached_key = tuple(y_star.context(context_size))
 
             if cached_key not in decoder_cache:
                 decoder_input = torch.tensor(
-                    [y_star.ys[-context_size:]],
+                    [y_star.context(context_size)],
                     device=device,
                     dtype=torch.int64,
                 ).reshape(1, context_size)
@@ -1796,7 +2389,7 @@ def beam_search(
             else:
                 decoder_out = decoder_cache[cached_key]
 
-            cached_key += f"-t-{t}"
+            cached_key = (cached_key, t)
             if cached_key not in joint_cache:
                 logits = model.joiner(
                     current_encoder_out,
@@ -1820,30 +2413,17 @@ def beam_search(
             skip_log_prob = log_prob[blank_id]
             new_y_star_log_prob = y_star.log_prob + skip_log_prob
 
-            # ys[:] returns a copy of ys
-            B.add(
-                Hypothesis(
-                    ys=y_star.ys[:],
-                    log_prob=new_y_star_log_prob,
-                    timestamp=y_star.timestamp[:],
-                )
-            )
+            # Nodes are immutable, so they can be shared without copying
+            B.add(Hypothesis(node=y_star.node, log_prob=new_y_star_log_prob))
 
             # Second, process other non-blank labels
             values, indices = log_prob.topk(beam + 1)
             for i, v in zip(indices.tolist(), values.tolist()):
                 if i in (blank_id, unk_id):
                     continue
-                new_ys = y_star.ys + [i]
+                new_node = y_star.node.append(i, t)
                 new_log_prob = y_star.log_prob + v
-                new_timestamp = y_star.timestamp + [t]
-                A.add(
-                    Hypothesis(
-                        ys=new_ys,
-                        log_prob=new_log_prob,
-                        timestamp=new_timestamp,
-                    )
-                )
+                A.add(Hypothesis(node=new_node, log_prob=new_log_prob))
 
             # Check whether B contains more than "beam" elements more probable
             # than the most probable in A
@@ -2304,7 +2884,7 @@ def modified_beam_search_ngram_rescoring(
         )  # (num_hyps, 1)
 
         decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+            [hyp.context(context_size) for hyps in A for hyp in hyps],
             device=device,
             dtype=torch.int64,
         )  # (num_hyps, context_size)
@@ -2353,10 +2933,10 @@ def modified_beam_search_ngram_rescoring(
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
 
-                new_ys = hyp.ys[:]
+                new_node = hyp.node
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
-                    new_ys.append(new_token)
+                    new_node = new_node.append(new_token)
                     state_cost = hyp.state_cost.forward_one_step(new_token)
                 else:
                     state_cost = hyp.state_cost
@@ -2365,7 +2945,7 @@ def modified_beam_search_ngram_rescoring(
                 new_log_prob = topk_log_probs[k] - hyp.state_cost.lm_score * lm_scale
 
                 new_hyp = Hypothesis(
-                    ys=new_ys, log_prob=new_log_prob, state_cost=state_cost
+                    node=new_node, log_prob=new_log_prob, state_cost=state_cost
                 )
                 B[i].add(new_hyp)
 
@@ -2390,6 +2970,7 @@ def modified_beam_search_LODR(
     LM: LmScorer,
     beam: int = 4,
     context_graph: Optional[ContextGraph] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> List[List[int]]:
     """This function implements LODR (https://arxiv.org/abs/2203.16776) with
     `modified_beam_search`. It uses a bi-gram language model as the estimate
@@ -2413,6 +2994,9 @@ def modified_beam_search_LODR(
             A neural net LM, e.g an RNNLM or transformer LM
         beam (int, optional):
             Beam size. Defaults to 4.
+        decoder_cache:
+            If not None, it is used to look up the decoder output of each
+            hypothesis instead of running the decoder.
 
     Returns:
       Return a list-of-list of token IDs. ans[i] is the decoding results
@@ -2486,14 +3070,11 @@ def modified_beam_search_LODR(
             [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
         )
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
-
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(
+            model,
+            [hyp.context(context_size) for hyps in A for hyp in hyps],
+            decoder_cache,
+        ).unsqueeze(1)
 
         current_encoder_out = torch.index_select(
             current_encoder_out,
@@ -2596,7 +3177,7 @@ def modified_beam_search_LODR(
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
 
-                ys = hyp.ys[:]
+                new_node = hyp.node
 
                 # current score of hyp
                 lm_score = hyp.lm_score
@@ -2615,7 +3196,7 @@ def modified_beam_search_LODR(
                             new_context_state,
                         ) = context_graph.forward_one_step(hyp.context_state, new_token)
 
-                    ys.append(new_token)
+                    new_node = new_node.append(new_token)
                     state_cost = hyp.state_cost.forward_one_step(new_token)
 
                     # calculate the score of the latest token
@@ -2644,7 +3225,7 @@ def modified_beam_search_LODR(
                     state_cost = hyp.state_cost
 
                 new_hyp = Hypothesis(
-                    ys=ys,
+                    node=new_node,
                     log_prob=hyp_log_prob,
                     state=state,
                     lm_score=lm_score,
@@ -2666,9 +3247,8 @@ def modified_beam_search_LODR(
                 )
                 finalized_B[i].add(
                     Hypothesis(
-                        ys=hyp.ys,
+                        node=hyp.node,
                         log_prob=hyp.log_prob + context_score,
-                        timestamp=hyp.timestamp,
                         context_state=new_context_state,
                     )
                 )
@@ -2692,6 +3272,7 @@ def modified_beam_search_lm_shallow_fusion(
     LM: LmScorer,
     beam: int = 4,
     return_timestamps: bool = False,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> List[List[int]]:
     """Modified_beam_search + NN LM shallow fusion
 
@@ -2709,6 +3290,9 @@ def modified_beam_search_lm_shallow_fusion(
             A neural net LM, e.g RNN or Transformer
         beam (int, optional):
             Beam size. Defaults to 4.
+        decoder_cache:
+            If not None, it is used to look up the decoder output of each
+            hypothesis instead of running the decoder.
 
     Returns:
       Return a list-of-list of token IDs. ans[i] is the decoding results
@@ -2782,14 +3366,11 @@ def modified_beam_search_lm_shallow_fusion(
             [hyp.lm_score.reshape(1, -1) for hyps in A for hyp in hyps]
         )
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
-
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(
+            model,
+            [hyp.context(context_size) for hyps in A for hyp in hyps],
+            decoder_cache,
+        ).unsqueeze(1)
 
         current_encoder_out = torch.index_select(
             current_encoder_out,
@@ -2891,18 +3472,16 @@ def modified_beam_search_lm_shallow_fusion(
                 hyp_idx = topk_hyp_indexes[k]
                 hyp = A[i][hyp_idx]
 
-                ys = hyp.ys[:]
+                new_node = hyp.node
 
                 lm_score = hyp.lm_score
                 state = hyp.state
 
                 hyp_log_prob = topk_log_probs[k]  # get score of current hyp
                 new_token = topk_token_indexes[k]
-                new_timestamp = hyp.timestamp[:]
                 if new_token not in (blank_id, unk_id):
 
-                    ys.append(new_token)
-                    new_timestamp.append(t)
+                    new_node = new_node.append(new_token, t)
 
                     hyp_log_prob += lm_score[new_token] * lm_scale  # add the lm score
 
@@ -2915,11 +3494,10 @@ def modified_beam_search_lm_shallow_fusion(
                     count += 1
 
                 new_hyp = Hypothesis(
-                    ys=ys,
+                    node=new_node,
                     log_prob=hyp_log_prob,
                     state=state,
                     lm_score=lm_score,
-                    timestamp=new_timestamp,
                 )
                 B[i].add(new_hyp)
 
@@ -127,13 +127,26 @@ Usage:
     --tokens-ngram 2 \
     --ngram-lm-scale -0.16 \
 
+(10) greedy search on whole recordings with 30 s windows overlapping by 5 s
+./pruned_transducer_stateless7/decode.py \
+    --epoch 28 \
+    --avg 15 \
+    --exp-dir ./pruned_transducer_stateless7/exp \
+    --max-duration 600 \
+    --decoding-method greedy_search \
+    --long-form 1 \
+    --window-duration 30 \
+    --window-overlap 5
 """
 
 
 import argparse
 import logging
 import math
-from collections import defaultdict
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
@@ -148,12 +161,21 @@ from beam_search import (
     fast_beam_search_nbest_LG,
     fast_beam_search_nbest_oracle,
     fast_beam_search_one_best,
-    greedy_search,
     greedy_search_batch,
+    greedy_search_batch_multi_sym,
     modified_beam_search,
     modified_beam_search_lm_shallow_fusion,
     modified_beam_search_LODR,
     modified_beam_search_ngram_rescoring,
+    modified_beam_search_tensorized,
+)
+from decoder_cache import DecoderOutputCache, DecoderOutputTable
+from detokenizer import Detokenizer
+from long_form import (
+    HypothesisStitcher,
+    cut_into_windows,
+    get_references,
+    stitched_results,
 )
 from train import add_model_arguments, get_params, get_transducer_model
 
@@ -167,6 +189,7 @@ from icefall.checkpoint import (
 from icefall.lexicon import Lexicon
 from icefall.utils import (
     AttributeDict,
+    DecodingResults,
     setup_logger,
     store_transcripts,
     str2bool,
@@ -249,6 +272,7 @@ def get_parser():
           - greedy_search
           - beam_search
           - modified_beam_search
+          - modified_beam_search_tensorized
           - fast_beam_search
           - fast_beam_search_nbest
           - fast_beam_search_nbest_oracle
@@ -387,6 +411,76 @@ def get_parser():
                 Used only when the decoding method is
                 modified_beam_search_ngram_rescoring""",
     )
+
+    parser.add_argument(
+        "--decoder-cache-size",
+        type=int,
+        default=0,
+        help="""If positive, maximum number of decoder outputs kept in an LRU
+        cache. The decoder output depends only on the last --context-size
+        tokens, so it is looked up instead of recomputed. It is used by
+        greedy_search, modified_beam_search,
+        modified_beam_search_lm_shallow_fusion and modified_beam_search_LODR.
+        Batched greedy_search keeps its contexts on the device and ignores
+        it; see --decoder-table instead. 0 disables the cache.""",
+    )
+
+    parser.add_argument(
+        "--decoder-table",
+        type=str2bool,
+        default=False,
+        help="""If True, the decoder output of all possible contexts is
+        computed once per checkpoint and saved to --exp-dir. Decoder calls
+        during greedy search and modified beam search are then replaced by
+        lookups in this memory-mapped table. It has (vocab_size + 1) **
+        context_size rows, so it is meant for --context-size 2. It replaces
+        --decoder-cache-size.""",
+    )
+
+    parser.add_argument(
+        "--num-search-workers",
+        type=int,
+        default=0,
+        help="""If positive, the search and detokenization run in this many
+        threads, while the main thread loads the next batches and runs the
+        encoder on them. The utilization of each stage is logged. If 0,
+        batches are decoded one after another. Not used with --long-form.""",
+    )
+
+    parser.add_argument(
+        "--search-queue-size",
+        type=int,
+        default=2,
+        help="""Maximum number of encoded batches waiting for a search worker.
+        Used only when --num-search-workers is positive.""",
+    )
+
+    parser.add_argument(
+        "--long-form",
+        type=str2bool,
+        default=False,
+        help="""If True, decode whole test recordings instead of the segmented
+        test cuts. Each recording is cut into overlapping windows, which are
+        decoded in batches, and the hypotheses of the windows are merged
+        using token timestamps. Supported by greedy_search,
+        modified_beam_search, modified_beam_search_tensorized and
+        fast_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--window-duration",
+        type=float,
+        default=30.0,
+        help="Duration of the windows in seconds. Used only with --long-form.",
+    )
+
+    parser.add_argument(
+        "--window-overlap",
+        type=float,
+        default=5.0,
+        help="""Overlap of consecutive windows in seconds. Used only with
+        --long-form.""",
+    )
     add_model_arguments(parser)
 
     return parser
@@ -402,6 +496,8 @@ def decode_one_batch(
     ngram_lm: Optional[NgramLm] = None,
     ngram_lm_scale: float = 1.0,
     LM: Optional[LmScorer] = None,
+    detokenizer: Optional[Detokenizer] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -437,10 +533,37 @@ def decode_one_batch(
         A ngram lm. Used in LODR decoding.
       ngram_lm_scale:
         The scale of the ngram language model.
+      detokenizer:
+        Converts token IDs to words. If None, it is built from `sp`.
+      decoder_cache:
+        If not None, it is used by greedy search and modified beam search
+        to look up decoder outputs.
     Returns:
       Return the decoding result. See above description for the format of
       the returned dict.
     """
+    encoder_out, encoder_out_lens = encode_batch(model, batch)
+    return search_batch(
+        params=params,
+        model=model,
+        sp=sp,
+        supervisions=batch["supervisions"],
+        encoder_out=encoder_out,
+        encoder_out_lens=encoder_out_lens,
+        word_table=word_table,
+        decoding_graph=decoding_graph,
+        ngram_lm=ngram_lm,
+        ngram_lm_scale=ngram_lm_scale,
+        LM=LM,
+        detokenizer=detokenizer,
+        decoder_cache=decoder_cache,
+    )
+
+
+def encode_batch(model: nn.Module, batch: dict) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Run the encoder on a batch from
+    `lhotse.dataset.K2SpeechRecognitionDataset` and return encoder_out of shape
+    (N, T, C) and encoder_out_lens of shape (N,)."""
     device = next(model.parameters()).device
     feature = batch["inputs"]
     assert feature.ndim == 3
@@ -448,10 +571,32 @@ def decode_one_batch(
     feature = feature.to(device)
     # at entry, feature is (N, T, C)
 
-    supervisions = batch["supervisions"]
-    feature_lens = supervisions["num_frames"].to(device)
+    feature_lens = batch["supervisions"]["num_frames"].to(device)
+
+    return model.encoder(x=feature, x_lens=feature_lens)
 
-    encoder_out, encoder_out_lens = model.encoder(x=feature, x_lens=feature_lens)
+
+def search_batch(
+    params: AttributeDict,
+    model: nn.Module,
+    sp: spm.SentencePieceProcessor,
+    supervisions: dict,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    word_table: Optional[k2.SymbolTable] = None,
+    decoding_graph: Optional[k2.Fsa] = None,
+    ngram_lm: Optional[NgramLm] = None,
+    ngram_lm_scale: float = 1.0,
+    LM: Optional[LmScorer] = None,
+    detokenizer: Optional[Detokenizer] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+) -> Dict[str, List[List[str]]]:
+    """Run the search selected by --decoding-method on the output of
+    :func:`encode_batch` and return the result in the same format as
+    :func:`decode_one_batch`. `supervisions` is batch["supervisions"]; the
+    other arguments are the same as in :func:`decode_one_batch`."""
+    if detokenizer is None:
+        detokenizer = Detokenizer.from_sentencepiece(sp)
 
     hyps = []
 
@@ -465,8 +610,7 @@ def decode_one_batch(
             max_contexts=params.max_contexts,
             max_states=params.max_states,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "fast_beam_search_nbest_LG":
         hyp_tokens = fast_beam_search_nbest_LG(
             model=model,
@@ -493,8 +637,7 @@ def decode_one_batch(
             num_paths=params.num_paths,
             nbest_scale=params.nbest_scale,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "fast_beam_search_nbest_oracle":
         hyp_tokens = fast_beam_search_nbest_oracle(
             model=model,
@@ -508,25 +651,46 @@ def decode_one_batch(
             ref_texts=sp.encode(supervisions["text"]),
             nbest_scale=params.nbest_scale,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "greedy_search" and params.max_sym_per_frame == 1:
         hyp_tokens = greedy_search_batch(
             model=model,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
+            decoder_cache=decoder_cache,
+        )
+        hyps = detokenizer.decode_words(hyp_tokens)
+    elif params.decoding_method == "greedy_search":
+        hyp_tokens = greedy_search_batch_multi_sym(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            max_sym_per_frame=params.max_sym_per_frame,
+            decoder_cache=decoder_cache,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search":
         hyp_tokens = modified_beam_search(
             model=model,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
             beam=params.beam_size,
+            decoder_cache=decoder_cache,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
+    elif params.decoding_method == "modified_beam_search_tensorized":
+        hyp_tokens = modified_beam_search_tensorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam_size,
+            decoder_table=(
+                decoder_cache
+                if isinstance(decoder_cache, DecoderOutputTable)
+                else None
+            ),
+        )
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search_lm_shallow_fusion":
         hyp_tokens = modified_beam_search_lm_shallow_fusion(
             model=model,
@@ -534,9 +698,9 @@ def decode_one_batch(
             encoder_out_lens=encoder_out_lens,
             beam=params.beam_size,
             LM=LM,
+            decoder_cache=decoder_cache,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search_LODR":
         hyp_tokens = modified_beam_search_LODR(
             model=model,
@@ -546,9 +710,9 @@ def decode_one_batch(
             LODR_lm=ngram_lm,
             LODR_lm_scale=ngram_lm_scale,
             LM=LM,
+            decoder_cache=decoder_cache,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     else:
         batch_size = encoder_out.size(0)
 
@@ -556,13 +720,7 @@ def decode_one_batch(
             # fmt: off
             encoder_out_i = encoder_out[i:i+1, :encoder_out_lens[i]]
             # fmt: on
-            if params.decoding_method == "greedy_search":
-                hyp = greedy_search(
-                    model=model,
-                    encoder_out=encoder_out_i,
-                    max_sym_per_frame=params.max_sym_per_frame,
-                )
-            elif params.decoding_method == "beam_search":
+            if params.decoding_method == "beam_search":
                 hyp = beam_search(
                     model=model,
                     encoder_out=encoder_out_i,
@@ -574,8 +732,14 @@ def decode_one_batch(
                 )
             hyps.append(sp.decode(hyp).split())
 
+    return {get_result_key(params): hyps}
+
+
+def get_result_key(params: AttributeDict) -> str:
+    """Return the setting used for decoding, which is the key of the dict
+    returned by :func:`decode_one_batch`."""
     if params.decoding_method == "greedy_search":
-        return {"greedy_search": hyps}
+        return "greedy_search"
     elif "fast_beam_search" in params.decoding_method:
         key = f"beam_{params.beam}_"
         key += f"max_contexts_{params.max_contexts}_"
@@ -585,10 +749,76 @@ def decode_one_batch(
             key += f"nbest_scale_{params.nbest_scale}"
             if "LG" in params.decoding_method:
                 key += f"_ngram_lm_scale_{params.ngram_lm_scale}"
+        return key
+    else:
+        return f"beam_size_{params.beam_size}"
+
 
-        return {key: hyps}
+def search_with_timestamps(
+    params: AttributeDict,
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    decoding_graph: Optional[k2.Fsa] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+) -> DecodingResults:
+    """Run the search selected by --decoding-method and return the token IDs
+    of each utterance with their timestamps. Used by long-form decoding."""
+    if params.decoding_method == "fast_beam_search":
+        return fast_beam_search_one_best(
+            model=model,
+            decoding_graph=decoding_graph,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam,
+            max_contexts=params.max_contexts,
+            max_states=params.max_states,
+            return_timestamps=True,
+        )
+    elif params.decoding_method == "greedy_search" and params.max_sym_per_frame == 1:
+        return greedy_search_batch(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            return_timestamps=True,
+            decoder_cache=decoder_cache,
+        )
+    elif params.decoding_method == "greedy_search":
+        return greedy_search_batch_multi_sym(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            max_sym_per_frame=params.max_sym_per_frame,
+            return_timestamps=True,
+            decoder_cache=decoder_cache,
+        )
+    elif params.decoding_method == "modified_beam_search":
+        return modified_beam_search(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam_size,
+            return_timestamps=True,
+            decoder_cache=decoder_cache,
+        )
+    elif params.decoding_method == "modified_beam_search_tensorized":
+        return modified_beam_search_tensorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam_size,
+            return_timestamps=True,
+            decoder_table=(
+                decoder_cache
+                if isinstance(decoder_cache, DecoderOutputTable)
+                else None
+            ),
+        )
     else:
-        return {f"beam_size_{params.beam_size}": hyps}
+        raise ValueError(
+            f"Unsupported decoding method for long-form decoding: "
+            f"{params.decoding_method}"
+        )
 
 
 def decode_dataset(
@@ -601,6 +831,8 @@ def decode_dataset(
     ngram_lm: Optional[NgramLm] = None,
     ngram_lm_scale: float = 1.0,
     LM: Optional[LmScorer] = None,
+    detokenizer: Optional[Detokenizer] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -621,6 +853,11 @@ def decode_dataset(
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
       LM:
         A neural network LM, used during shallow fusion
+      detokenizer:
+        Converts token IDs to words. If None, it is built from `sp`.
+      decoder_cache:
+        If not None, it is used by greedy search and modified beam search
+        to look up decoder outputs.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -640,21 +877,28 @@ def decode_dataset(
     else:
         log_interval = 20
 
+    num_frames = 0
+    num_padded_frames = 0
+
     results = defaultdict(list)
     for batch_idx, batch in enumerate(dl):
         texts = batch["supervisions"]["text"]
         cut_ids = [cut.id for cut in batch["supervisions"]["cut"]]
+        num_frames += batch["supervisions"]["num_frames"].sum().item()
+        num_padded_frames += batch["inputs"].size(0) * batch["inputs"].size(1)
 
         hyps_dict = decode_one_batch(
             params=params,
             model=model,
             sp=sp,
+            detokenizer=detokenizer,
             decoding_graph=decoding_graph,
             word_table=word_table,
             batch=batch,
             ngram_lm=ngram_lm,
             ngram_lm_scale=ngram_lm_scale,
             LM=LM,
+            decoder_cache=decoder_cache,
         )
 
         for name, hyps in hyps_dict.items():
@@ -672,9 +916,255 @@ def decode_dataset(
             batch_str = f"{batch_idx}/{num_batches}"
 
             logging.info(f"batch {batch_str}, cuts processed until now is {num_cuts}")
+
+    log_padding_efficiency(num_frames, num_padded_frames)
+    return results
+
+
+def decode_dataset_pipelined(
+    dl: torch.utils.data.DataLoader,
+    params: AttributeDict,
+    model: nn.Module,
+    sp: spm.SentencePieceProcessor,
+    word_table: Optional[k2.SymbolTable] = None,
+    decoding_graph: Optional[k2.Fsa] = None,
+    ngram_lm: Optional[NgramLm] = None,
+    ngram_lm_scale: float = 1.0,
+    LM: Optional[LmScorer] = None,
+    detokenizer: Optional[Detokenizer] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    num_workers: int = 2,
+    queue_size: int = 2,
+) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
+    """Same as :func:`decode_dataset`, but the encoder and the search run
+    concurrently.
+
+    This thread loads the batches and runs the encoder. The search and the
+    detokenization of each batch are done by a pool of `num_workers`
+    threads, so that the encoder runs on batch k+1 while the search runs on
+    batch k. At most `queue_size` encoded batches wait for a free worker;
+    when the queue is full, the encoder waits. Results are collected as
+    soon as they are ready, so that an error in a search worker stops the
+    decoding right away. The utilization of each stage is logged at the end.
+    On CUDA, the device is synchronized around each encoder call so that
+    the encoder time is not only the time to launch its kernels; since the
+    searches use the same device, it also includes the search kernels that
+    run at the same time.
+
+    Args:
+      num_workers:
+        Number of search threads.
+      queue_size:
+        Maximum number of encoded batches waiting to be searched.
+      The other arguments are the same as in :func:`decode_dataset`.
+    Returns:
+      Return a dict in the same format as :func:`decode_dataset`.
+    """
+    if detokenizer is None:
+        detokenizer = Detokenizer.from_sentencepiece(sp)
+
+    try:
+        num_batches = len(dl)
+    except TypeError:
+        num_batches = "?"
+
+    # Acquired before submitting a batch and released when its search is
+    # done, so that at most num_workers + queue_size batches are in flight.
+    slots = threading.BoundedSemaphore(num_workers + queue_size)
+
+    def search(supervisions: dict, encoder_out, encoder_out_lens):
+        try:
+            start = time.time()
+            # no_grad() is thread-local
+            with torch.no_grad():
+                hyps_dict = search_batch(
+                    params=params,
+                    model=model,
+                    sp=sp,
+                    supervisions=supervisions,
+                    encoder_out=encoder_out,
+                    encoder_out_lens=encoder_out_lens,
+                    word_table=word_table,
+                    decoding_graph=decoding_graph,
+                    ngram_lm=ngram_lm,
+                    ngram_lm_scale=ngram_lm_scale,
+                    LM=LM,
+                    detokenizer=detokenizer,
+                    decoder_cache=decoder_cache,
+                )
+            return hyps_dict, time.time() - start
+        finally:
+            slots.release()
+
+    device = next(model.parameters()).device
+    results = defaultdict(list)
+    search_time = 0.0
+    num_done = 0
+    pending = deque()
+
+    def collect(block: bool) -> None:
+        """Add the results of the finished batches at the front of `pending`
+        to `results`, waiting for all of them if `block` is True. The
+        exception of a failed search is raised."""
+        nonlocal search_time, num_done
+        for _, _, future in pending:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        while len(pending) > 0 and (block or pending[0][2].done()):
+            cut_ids, texts, future = pending.popleft()
+            hyps_dict, batch_search_time = future.result()
+            search_time += batch_search_time
+            num_done += 1
+            for name, hyps in hyps_dict.items():
+                assert len(hyps) == len(texts)
+                for cut_id, hyp_words, ref_text in zip(cut_ids, hyps, texts):
+                    results[name].append((cut_id, ref_text.split(), hyp_words))
+
+    load_time = 0.0
+    encoder_time = 0.0
+    wait_time = 0.0
+    num_frames = 0
+    num_padded_frames = 0
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        load_start = time.time()
+        for batch_idx, batch in enumerate(dl):
+            load_time += time.time() - load_start
+            num_frames += batch["supervisions"]["num_frames"].sum().item()
+            num_padded_frames += batch["inputs"].size(0) * batch["inputs"].size(1)
+
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            encoder_start = time.time()
+            encoder_out, encoder_out_lens = encode_batch(model, batch)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            encoder_time += time.time() - encoder_start
+
+            wait_start = time.time()
+            slots.acquire()
+            wait_time += time.time() - wait_start
+
+            supervisions = batch["supervisions"]
+            future = executor.submit(
+                search, supervisions, encoder_out, encoder_out_lens
+            )
+            pending.append(
+                (
+                    [cut.id for cut in supervisions["cut"]],
+                    supervisions["text"],
+                    future,
+                )
+            )
+
+            collect(block=False)
+
+            if batch_idx % 50 == 0:
+                logging.info(f"batch {batch_idx}/{num_batches} encoded")
+            load_start = time.time()
+        collect(block=True)
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    logging.info(
+        f"Decoded {num_done} batches in {elapsed:.2f} s. Utilization: "
+        f"data loading {load_time / elapsed:.1%}, "
+        f"encoder {encoder_time / elapsed:.1%}, "
+        f"search {search_time / (elapsed * num_workers):.1%} "
+        f"of {num_workers} workers. "
+        f"The encoder waited for a free search worker "
+        f"{wait_time / elapsed:.1%} of the time."
+    )
+    log_padding_efficiency(num_frames, num_padded_frames)
     return results
 
 
+def decode_long_form(
+    dl: torch.utils.data.DataLoader,
+    params: AttributeDict,
+    model: nn.Module,
+    detokenizer: Detokenizer,
+    references: Dict[str, str],
+    decoding_graph: Optional[k2.Fsa] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
+    """Decode the windows of whole recordings and merge their hypotheses.
+
+    Args:
+      dl:
+        PyTorch's dataloader containing the windows returned by
+        :func:`long_form.cut_into_windows`.
+      params:
+        It is returned by :func:`get_params`.
+      model:
+        The neural model.
+      detokenizer:
+        Converts token IDs to words.
+      references:
+        The transcript of each recording, indexed by recording id.
+      decoding_graph:
+        The decoding graph. Used only when --decoding_method is
+        fast_beam_search.
+      decoder_cache:
+        If not None, it is used by greedy search and modified beam search
+        to look up decoder outputs.
+    Returns:
+      Return a dict in the same format as :func:`decode_dataset`, with one
+      result per recording.
+    """
+    stitcher = HypothesisStitcher(
+        detokenizer,
+        frame_shift=params.subsampling_factor * params.frame_shift_ms / 1000,
+    )
+
+    try:
+        num_batches = len(dl)
+    except TypeError:
+        num_batches = "?"
+
+    num_windows = 0
+    num_frames = 0
+    num_padded_frames = 0
+    for batch_idx, batch in enumerate(dl):
+        num_frames += batch["supervisions"]["num_frames"].sum().item()
+        num_padded_frames += batch["inputs"].size(0) * batch["inputs"].size(1)
+        encoder_out, encoder_out_lens = encode_batch(model, batch)
+
+        res = search_with_timestamps(
+            params=params,
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            decoding_graph=decoding_graph,
+            decoder_cache=decoder_cache,
+        )
+        windows = batch["supervisions"]["cut"]
+        for window, hyp, timestamps in zip(windows, res.hyps, res.timestamps):
+            stitcher.add(window, hyp, timestamps)
+
+        num_windows += len(windows)
+        if batch_idx % 20 == 0:
+            logging.info(
+                f"batch {batch_idx}/{num_batches}, "
+                f"windows processed until now is {num_windows}"
+            )
+
+    log_padding_efficiency(num_frames, num_padded_frames)
+    return {
+        get_result_key(params): stitched_results(stitcher, detokenizer, references)
+    }
+
+
+def log_padding_efficiency(num_frames: int, num_padded_frames: int) -> None:
+    """Log the ratio of the number of input frames to the number of frames
+    the encoder processed including padding."""
+    efficiency = num_frames / num_padded_frames if num_padded_frames > 0 else 1.0
+    logging.info(
+        f"Padding efficiency: {efficiency:.2%} "
+        f"({num_frames} frames, {num_padded_frames} frames with padding)"
+    )
+
+
 def save_results(
     params: AttributeDict,
     test_set_name: str,
@@ -732,9 +1222,17 @@ def main():
         "fast_beam_search_nbest_LG",
         "fast_beam_search_nbest_oracle",
         "modified_beam_search",
+        "modified_beam_search_tensorized",
         "modified_beam_search_lm_shallow_fusion",
         "modified_beam_search_LODR",
     )
+    if params.long_form:
+        assert params.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+            "modified_beam_search_tensorized",
+            "fast_beam_search",
+        ), f"--long-form does not support {params.decoding_method}"
     params.res_dir = params.exp_dir / params.decoding_method
 
     if params.iter > 0:
@@ -773,6 +1271,10 @@ def main():
     if params.use_averaged_model:
         params.suffix += "-use-averaged-model"
 
+    if params.long_form:
+        params.suffix += f"-long-form-window-{params.window_duration}"
+        params.suffix += f"-overlap-{params.window_overlap}"
+
     setup_logger(f"{params.res_dir}/log-decode-{params.suffix}")
     logging.info("Decoding started")
 
@@ -784,6 +1286,7 @@ def main():
 
     sp = spm.SentencePieceProcessor()
     sp.load(params.bpe_model)
+    detokenizer = Detokenizer.from_sentencepiece(sp)
 
     # <blk> and <unk> are defined in local/train_bpe_model.py
     params.blank_id = sp.piece_to_id("<blk>")
@@ -920,6 +1423,21 @@ def main():
         decoding_graph = None
         word_table = None
 
+    if params.decoder_table:
+        if params.iter > 0:
+            table_name = f"decoder-table-iter-{params.iter}-avg-{params.avg}"
+        else:
+            table_name = f"decoder-table-epoch-{params.epoch}-avg-{params.avg}"
+        if params.use_averaged_model:
+            table_name += "-use-averaged-model"
+        decoder_cache = DecoderOutputTable.load_or_build(
+            model, params.exp_dir / f"{table_name}.npy"
+        )
+    elif params.decoder_cache_size > 0:
+        decoder_cache = DecoderOutputCache(model, max_size=params.decoder_cache_size)
+    else:
+        decoder_cache = None
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -927,7 +1445,16 @@ def main():
     args.return_cuts = True
     multivent = MultiVENTAsrDataModule(args)
 
-    test_cuts = multivent.test_cuts()
+    if params.long_form:
+        test_cuts = multivent.test_recording_cuts()
+        references = get_references(test_cuts)
+        test_cuts = cut_into_windows(
+            test_cuts,
+            window_duration=params.window_duration,
+            window_overlap=params.window_overlap,
+        )
+    else:
+        test_cuts = multivent.test_cuts()
 
     test_dl = multivent.test_dataloaders(test_cuts)
 
@@ -935,17 +1462,49 @@ def main():
     test_dl = [test_dl]
 
     for test_set, test_dl in zip(test_sets, test_dl):
-        results_dict = decode_dataset(
-            dl=test_dl,
-            params=params,
-            model=model,
-            sp=sp,
-            word_table=word_table,
-            decoding_graph=decoding_graph,
-            ngram_lm=ngram_lm,
-            ngram_lm_scale=ngram_lm_scale,
-            LM=LM,
-        )
+        if params.long_form:
+            results_dict = decode_long_form(
+                dl=test_dl,
+                params=params,
+                model=model,
+                detokenizer=detokenizer,
+                references=references,
+                decoding_graph=decoding_graph,
+                decoder_cache=decoder_cache,
+            )
+        elif params.num_search_workers > 0:
+            results_dict = decode_dataset_pipelined(
+                dl=test_dl,
+                params=params,
+                model=model,
+                sp=sp,
+                detokenizer=detokenizer,
+                word_table=word_table,
+                decoding_graph=decoding_graph,
+                ngram_lm=ngram_lm,
+                ngram_lm_scale=ngram_lm_scale,
+                LM=LM,
+                decoder_cache=decoder_cache,
+                num_workers=params.num_search_workers,
+                queue_size=params.search_queue_size,
+            )
+        else:
+            results_dict = decode_dataset(
+                dl=test_dl,
+                params=params,
+                model=model,
+                sp=sp,
+                detokenizer=detokenizer,
+                word_table=word_table,
+                decoding_graph=decoding_graph,
+                ngram_lm=ngram_lm,
+                ngram_lm_scale=ngram_lm_scale,
+                LM=LM,
+                decoder_cache=decoder_cache,
+            )
+
+        if decoder_cache is not None:
+            decoder_cache.log_stats()
 
         save_results(
             params=params,
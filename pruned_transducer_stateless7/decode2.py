@@ -121,6 +121,7 @@ from beam_search import (
     modified_beam_search_lm_shallow_fusion,
     modified_beam_search_LODR,
 )
+from detokenizer import Detokenizer
 from gigaspeech_scoring import asr_text_post_processing
 from finetune2 import add_model_arguments, get_model, get_params
 
@@ -398,6 +399,7 @@ def decode_one_batch(
     LM: Optional[LmScorer] = None,
     ngram_lm=None,
     ngram_lm_scale: float = 0.0,
+    detokenizer: Optional[Detokenizer] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -432,10 +434,15 @@ def decode_one_batch(
         A ngram language model
       ngram_lm_scale:
         The scale for the ngram language model.
+      detokenizer:
+        Converts token IDs to words. If None, it is built from `sp`.
     Returns:
       Return the decoding result. See above description for the format of
       the returned dict.
     """
+    if detokenizer is None:
+        detokenizer = Detokenizer.from_sentencepiece(sp)
+
     device = next(model.parameters()).device
     feature = batch["inputs"]
     assert feature.ndim == 3
@@ -470,8 +477,7 @@ def decode_one_batch(
             max_contexts=params.max_contexts,
             max_states=params.max_states,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "fast_beam_search_nbest_LG":
         hyp_tokens = fast_beam_search_nbest_LG(
             model=model,
@@ -498,8 +504,7 @@ def decode_one_batch(
             num_paths=params.num_paths,
             nbest_scale=params.nbest_scale,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "fast_beam_search_nbest_oracle":
         hyp_tokens = fast_beam_search_nbest_oracle(
             model=model,
@@ -513,16 +518,14 @@ def decode_one_batch(
             ref_texts=sp.encode(supervisions["text"]),
             nbest_scale=params.nbest_scale,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "greedy_search" and params.max_sym_per_frame == 1:
         hyp_tokens = greedy_search_batch(
             model=model,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search":
         hyp_tokens = modified_beam_search(
             model=model,
@@ -531,8 +534,7 @@ def decode_one_batch(
             beam=params.beam_size,
             context_graph=context_graph,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search_lm_shallow_fusion":
         hyp_tokens = modified_beam_search_lm_shallow_fusion(
             model=model,
@@ -541,8 +543,7 @@ def decode_one_batch(
             beam=params.beam_size,
             LM=LM,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search_LODR":
         hyp_tokens = modified_beam_search_LODR(
             model=model,
@@ -554,8 +555,7 @@ def decode_one_batch(
             LM=LM,
             context_graph=context_graph,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search_lm_rescore":
         lm_scale_list = [0.01 * i for i in range(10, 50)]
         ans_dict = modified_beam_search_lm_rescore(
@@ -625,7 +625,7 @@ def decode_one_batch(
             ans = dict()
             assert ans_dict is not None
             for key, hyps in ans_dict.items():
-                hyps = [sp.decode(hyp).split() for hyp in hyps]
+                hyps = detokenizer.decode_words(hyps)
                 ans[f"{prefix}_{key}"] = hyps
             return ans
         else:
@@ -647,6 +647,7 @@ def decode_dataset(
     LM: Optional[LmScorer] = None,
     ngram_lm=None,
     ngram_lm_scale: float = 0.0,
+    detokenizer: Optional[Detokenizer] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -665,6 +666,8 @@ def decode_dataset(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding-method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      detokenizer:
+        Converts token IDs to words. If None, it is built from `sp`.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -693,6 +696,7 @@ def decode_dataset(
             params=params,
             model=model,
             sp=sp,
+            detokenizer=detokenizer,
             decoding_graph=decoding_graph,
             context_graph=context_graph,
             word_table=word_table,
@@ -854,6 +858,7 @@ def main():
 
     sp = spm.SentencePieceProcessor()
     sp.load(params.bpe_model)
+    detokenizer = Detokenizer.from_sentencepiece(sp)
 
     # <blk> and <unk> are defined in local/train_bpe_model.py
     params.blank_id = sp.piece_to_id("<blk>")
@@ -1042,6 +1047,7 @@ def main():
             params=params,
             model=model,
             sp=sp,
+            detokenizer=detokenizer,
             word_table=word_table,
             decoding_graph=decoding_graph,
             context_graph=context_graph,
@@ -120,6 +120,7 @@ from beam_search import (
     greedy_search_batch,
     modified_beam_search,
 )
+from detokenizer import Detokenizer
 from gigaspeech_scoring import asr_text_post_processing
 from train import add_model_arguments, get_params, get_transducer_model
 
@@ -351,6 +352,7 @@ def decode_one_batch(
     batch: dict,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
+    detokenizer: Optional[Detokenizer] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -379,10 +381,15 @@ def decode_one_batch(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      detokenizer:
+        Converts token IDs to words. If None, it is built from `sp`.
     Returns:
       Return the decoding result. See above description for the format of
       the returned dict.
     """
+    if detokenizer is None:
+        detokenizer = Detokenizer.from_sentencepiece(sp)
+
     device = next(model.parameters()).device
     feature = batch["inputs"]
     assert feature.ndim == 3
@@ -422,8 +429,7 @@ def decode_one_batch(
             max_contexts=params.max_contexts,
             max_states=params.max_states,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "fast_beam_search_nbest_LG":
         hyp_tokens = fast_beam_search_nbest_LG(
             model=model,
@@ -450,8 +456,7 @@ def decode_one_batch(
             num_paths=params.num_paths,
             nbest_scale=params.nbest_scale,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "fast_beam_search_nbest_oracle":
         hyp_tokens = fast_beam_search_nbest_oracle(
             model=model,
@@ -465,16 +470,14 @@ def decode_one_batch(
             ref_texts=sp.encode(supervisions["text"]),
             nbest_scale=params.nbest_scale,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "greedy_search" and params.max_sym_per_frame == 1:
         hyp_tokens = greedy_search_batch(
             model=model,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     elif params.decoding_method == "modified_beam_search":
         hyp_tokens = modified_beam_search(
             model=model,
@@ -482,8 +485,7 @@ def decode_one_batch(
             encoder_out_lens=encoder_out_lens,
             beam=params.beam_size,
         )
-        for hyp in sp.decode(hyp_tokens):
-            hyps.append(hyp.split())
+        hyps = detokenizer.decode_words(hyp_tokens)
     else:
         batch_size = encoder_out.size(0)
 
@@ -533,6 +535,7 @@ def decode_dataset(
     sp: spm.SentencePieceProcessor,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
+    detokenizer: Optional[Detokenizer] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -551,6 +554,8 @@ def decode_dataset(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      detokenizer:
+        Converts token IDs to words. If None, it is built from `sp`.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -579,6 +584,7 @@ def decode_dataset(
             params=params,
             model=model,
             sp=sp,
+            detokenizer=detokenizer,
             decoding_graph=decoding_graph,
             word_table=word_table,
             batch=batch,
@@ -710,6 +716,7 @@ def main():
 
     sp = spm.SentencePieceProcessor()
     sp.load(params.bpe_model)
+    detokenizer = Detokenizer.from_sentencepiece(sp)
 
     # <blk> and <unk> are defined in local/train_bpe_model.py
     params.blank_id = sp.piece_to_id("<blk>")
@@ -845,6 +852,7 @@ def main():
             params=params,
             model=model,
             sp=sp,
+            detokenizer=detokenizer,
             word_table=word_table,
             decoding_graph=decoding_graph,
         )
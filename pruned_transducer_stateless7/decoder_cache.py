@@ -0,0 +1,280 @@
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import torch
+from torch import nn
+
+
+class DecoderOutputCache(object):
+    """LRU cache of projected decoder outputs.
+
+    The output of the stateless decoder depends only on its last
+    `context_size` input tokens, so `joiner.decoder_proj(decoder(context))`
+    is cached with the context tuple as key. Outputs for a batch of contexts
+    are looked up one by one, the missing ones are computed together in a
+    single call to the decoder, and the result is assembled with
+    `torch.stack`. The least recently used outputs are evicted first.
+    It can be shared by several search threads.
+    """
+
+    def __init__(self, model: nn.Module, max_size: int = 20000):
+        """
+        Args:
+          model:
+            The transducer model.
+          max_size:
+            Maximum number of cached decoder outputs. If it is not positive,
+            nothing is cached.
+        """
+        self.model = model
+        self.max_size = max_size
+        self.device = next(model.parameters()).device
+
+        self.outputs = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.outputs)
+
+    def __call__(self, contexts: List[List[int]]) -> torch.Tensor:
+        """
+        Args:
+          contexts:
+            contexts[i] contains the last `context_size` tokens of the i-th
+            hypothesis.
+        Returns:
+          Return a tensor of shape (len(contexts), 1, joiner_dim), the same
+          as `model.joiner.decoder_proj(model.decoder(contexts))`.
+        """
+        keys = [tuple(context) for context in contexts]
+        with self.lock:
+            return self._lookup(keys)
+
+    def _lookup(self, keys: List[tuple]) -> torch.Tensor:
+        outputs = {}
+        missing_keys = []
+        for key in keys:
+            if key in outputs:
+                continue
+            output = self.outputs.get(key)
+            if output is None:
+                outputs[key] = None
+                missing_keys.append(key)
+            else:
+                self.outputs.move_to_end(key)
+                outputs[key] = output
+                self.num_hits += 1
+
+        if len(missing_keys) > 0:
+            self.num_misses += len(missing_keys)
+            decoder_input = torch.tensor(
+                missing_keys, device=self.device, dtype=torch.int64
+            )
+            decoder_out = self.model.decoder(decoder_input, need_pad=False)
+            decoder_out = self.model.joiner.decoder_proj(decoder_out)
+            for key, output in zip(missing_keys, decoder_out.unbind(0)):
+                outputs[key] = output
+                self._add(key, output)
+
+        return torch.stack([outputs[key] for key in keys])
+
+    def _add(self, key: tuple, output: torch.Tensor) -> None:
+        if self.max_size <= 0:
+            return
+
+        # `output` is a row of the decoder output of a whole batch. It is
+        # cloned so that the cache does not keep the batch alive.
+        self.outputs[key] = output.clone()
+        while len(self.outputs) > self.max_size:
+            self.outputs.popitem(last=False)
+
+    def log_stats(self) -> None:
+        total = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / total if total > 0 else 0.0
+        logging.info(
+            f"Decoder output cache: {len(self.outputs)} outputs, "
+            f"hits: {self.num_hits}, misses: {self.num_misses}, "
+            f"hit rate: {hit_rate:.2%}"
+        )
+
+
+class DecoderOutputTable(DecoderOutputCache):
+    """Projected decoder outputs for all possible contexts.
+
+    With vocab_size V and context_size c, a context (y_1, ..., y_c) is
+    stored at row sum_k y_k * (V + 1)^(c - k) of a table with (V + 1)^c
+    rows, where the ID -1 used at the start of an utterance is mapped to V.
+    For V = 500 and c = 2, the table has about 250k rows, e.g., about
+    500 MB for joiner_dim = 512, so that a decoder call becomes a gather.
+
+    The table is saved as a .npy file by :meth:`build` and memory-mapped,
+    so that on CPU only the rows that are actually used are read from disk.
+    On GPU, it is copied to the device.
+    """
+
+    def __init__(self, model: nn.Module, filename: Path):
+        """
+        Args:
+          model:
+            The transducer model.
+          filename:
+            The .npy file written by :meth:`build` for this model.
+        """
+        super().__init__(model, max_size=0)
+        self.vocab_size = model.decoder.vocab_size
+        self.context_size = model.decoder.context_size
+
+        # mode "c" is copy-on-write, so that the array is writable, as
+        # required by torch.from_numpy(), but the file is never changed.
+        table = np.load(filename, mmap_mode="c")
+        assert table.ndim == 2, table.shape
+        self.table = torch.from_numpy(table).to(self.device)
+        self.strides = torch.tensor(
+            [
+                (self.vocab_size + 1) ** (self.context_size - 1 - k)
+                for k in range(self.context_size)
+            ],
+            device=self.device,
+        )
+        logging.info(f"Loaded decoder output table of shape {table.shape}")
+
+    def __len__(self) -> int:
+        return self.table.size(0)
+
+    def lookup(self, decoder_input: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+          decoder_input:
+            A 2-D int64 tensor of shape (N, context_size), on the same device
+            as the model.
+        Returns:
+          Return a tensor of shape (N, 1, joiner_dim), the same as
+          `model.joiner.decoder_proj(model.decoder(decoder_input))`.
+        """
+        index = torch.where(decoder_input < 0, self.vocab_size, decoder_input)
+        index = (index * self.strides).sum(dim=1)
+        self.num_hits += index.numel()
+        return self.table[index].unsqueeze(1)
+
+    def __call__(self, contexts: List[List[int]]) -> torch.Tensor:
+        decoder_input = torch.tensor(contexts, device=self.device, dtype=torch.int64)
+        return self.lookup(decoder_input)
+
+    @torch.no_grad()
+    def matches(self, num_rows: int = 16) -> bool:
+        """Return True if the table has the expected number of rows and
+        randomly chosen rows are equal to the output of the model, i.e., if
+        the table was built for this model. The rows are chosen with a fixed
+        seed, so that the global random state is not changed."""
+        if len(self) != (self.vocab_size + 1) ** self.context_size:
+            return False
+
+        generator = torch.Generator().manual_seed(0)
+        index = torch.randint(0, len(self), (num_rows,), generator=generator)
+        index = index.to(self.device)
+        decoder_input = self._index_to_contexts(
+            index, self.vocab_size, self.context_size
+        )
+        expected = self.model.joiner.decoder_proj(
+            self.model.decoder(decoder_input, need_pad=False)
+        )
+        actual = self.table[index].unsqueeze(1)
+        if actual.shape != expected.shape:
+            return False
+        return torch.allclose(actual, expected, atol=1e-4)
+
+    @staticmethod
+    def _index_to_contexts(
+        index: torch.Tensor, vocab_size: int, context_size: int
+    ) -> torch.Tensor:
+        """Inverse of the row index computed in :meth:`lookup`."""
+        contexts = torch.stack(
+            [
+                index // (vocab_size + 1) ** (context_size - 1 - k) % (vocab_size + 1)
+                for k in range(context_size)
+            ],
+            dim=1,
+        )
+        return torch.where(contexts == vocab_size, -1, contexts)
+
+    @staticmethod
+    @torch.no_grad()
+    def build(model: nn.Module, filename: Path, batch_size: int = 4096) -> None:
+        """Compute the decoder output of all contexts and save it to
+        `filename` as a .npy file."""
+        vocab_size = model.decoder.vocab_size
+        context_size = model.decoder.context_size
+        device = next(model.parameters()).device
+
+        num_rows = (vocab_size + 1) ** context_size
+        logging.info(f"Building decoder output table with {num_rows} rows")
+
+        filename = Path(filename)
+        tmp_filename = filename.with_suffix(".tmp.npy")
+        table = None
+        for start in range(0, num_rows, batch_size):
+            index = torch.arange(
+                start, min(start + batch_size, num_rows), device=device
+            )
+            decoder_input = DecoderOutputTable._index_to_contexts(
+                index, vocab_size, context_size
+            )
+            decoder_out = model.decoder(decoder_input, need_pad=False)
+            decoder_out = model.joiner.decoder_proj(decoder_out).squeeze(1)
+            if table is None:
+                table = np.lib.format.open_memmap(
+                    tmp_filename,
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(num_rows, decoder_out.size(1)),
+                )
+            table[start : start + index.numel()] = (
+                decoder_out.to(device="cpu", dtype=torch.float32).numpy()
+            )
+        table.flush()
+        del table
+        # So that an interrupted build never leaves a truncated table behind
+        os.replace(tmp_filename, filename)
+        logging.info(f"Saved decoder output table to {filename}")
+
+    @staticmethod
+    def load_or_build(model: nn.Module, filename: Path) -> "DecoderOutputTable":
+        """Load the table from `filename`, building it first if it does not
+        exist or was built for a different model."""
+        filename = Path(filename)
+        if filename.is_file():
+            table = DecoderOutputTable(model, filename)
+            if table.matches():
+                return table
+            logging.warning(f"{filename} does not match the model, rebuilding it")
+            del table
+
+        DecoderOutputTable.build(model, filename)
+        return DecoderOutputTable(model, filename)
+
+    def log_stats(self) -> None:
+        logging.info(f"Decoder output table: {self.num_hits} lookups")
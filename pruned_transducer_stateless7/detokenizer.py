@@ -0,0 +1,120 @@
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from typing import List
+
+import k2
+import numpy as np
+import sentencepiece as spm
+
+
+class Detokenizer(object):
+    """Convert batches of token IDs to text.
+
+    The UTF-8 bytes of all pieces, with "▁" already replaced by a space, are
+    stored back to back in one uint8 array, together with the byte offset of
+    each token. A batch is converted by gathering the bytes of all its tokens
+    at once with NumPy and splitting the result at the utterance boundaries,
+    so that there is no Python loop over tokens.
+    """
+
+    def __init__(self, pieces: List[bytes]):
+        """
+        Args:
+          pieces:
+            pieces[i] is the text of the token with ID i, encoded as UTF-8.
+        """
+        lengths = np.array([len(piece) for piece in pieces], dtype=np.int64)
+        self.data = np.frombuffer(b"".join(pieces), dtype=np.uint8)
+        self.lengths = lengths
+        self.offsets = np.cumsum(lengths) - lengths
+
+    @staticmethod
+    def from_symbol_table(token_table: k2.SymbolTable) -> "Detokenizer":
+        """Build a detokenizer from a token table, e.g., tokens.txt. Tokens
+        that are not in the table are mapped to an empty string."""
+        pieces = [b""] * (max(token_table.ids) + 1)
+        for i in token_table.ids:
+            pieces[i] = token_table[i].replace("▁", " ").encode("utf-8")
+        return Detokenizer(pieces)
+
+    @staticmethod
+    def from_sentencepiece(sp: spm.SentencePieceProcessor) -> "Detokenizer":
+        """Build a detokenizer that gives the same words as `sp.decode()`."""
+        pieces = []
+        for i in range(sp.get_piece_size()):
+            if sp.is_control(i):
+                pieces.append(b"")
+            elif sp.is_unknown(i):
+                pieces.append(" ⁇ ".encode("utf-8"))
+            elif sp.is_byte(i):
+                # Byte pieces are of the form <0xAB>
+                pieces.append(bytes([int(sp.id_to_piece(i)[3:-1], 16)]))
+            else:
+                pieces.append(sp.id_to_piece(i).replace("▁", " ").encode("utf-8"))
+        return Detokenizer(pieces)
+
+    def decode_ragged(self, values: np.ndarray, row_splits: np.ndarray) -> List[str]:
+        """
+        Args:
+          values:
+            A 1-D array with the token IDs of all utterances back to back.
+          row_splits:
+            A 1-D array of size num_utterances + 1. The tokens of the i-th
+            utterance are values[row_splits[i]:row_splits[i+1]].
+        Returns:
+          Return a list of strings, one per utterance.
+        """
+        values = np.asarray(values, dtype=np.int64)
+        row_splits = np.asarray(row_splits, dtype=np.int64)
+
+        lengths = self.lengths[values]
+        byte_ends = np.cumsum(lengths)
+        # For each output byte, its index in self.data
+        byte_idx = np.arange(byte_ends[-1] if len(byte_ends) > 0 else 0)
+        byte_idx += np.repeat(self.offsets[values] - (byte_ends - lengths), lengths)
+        text = self.data[byte_idx].tobytes()
+
+        byte_splits = np.concatenate([[0], byte_ends])[row_splits].tolist()
+        return [
+            text[begin:end].decode("utf-8", errors="replace")
+            for begin, end in zip(byte_splits[:-1], byte_splits[1:])
+        ]
+
+    def decode(self, token_ids: List[List[int]]) -> List[str]:
+        """Return the text of each utterance in `token_ids`."""
+        lengths = [len(ids) for ids in token_ids]
+        values = np.fromiter(
+            (i for ids in token_ids for i in ids),
+            dtype=np.int64,
+            count=sum(lengths),
+        )
+        row_splits = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        return self.decode_ragged(values, row_splits)
+
+    def decode_words(self, token_ids: List[List[int]]) -> List[List[str]]:
+        """Return the words of each utterance in `token_ids`."""
+        return [text.split() for text in self.decode(token_ids)]
+
+    def is_word_start(self, token_ids: List[int]) -> np.ndarray:
+        """Return a boolean array that is True for the tokens that start a new
+        word, i.e., whose text starts with a space."""
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        first_bytes = self.data[
+            np.minimum(self.offsets[token_ids], max(len(self.data) - 1, 0))
+        ]
+        return (self.lengths[token_ids] > 0) & (first_bytes == ord(" "))
@@ -0,0 +1,185 @@
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Decoding of whole recordings with overlapping windows.
+
+A recording is cut into windows of --window-duration seconds, each
+overlapping the previous one by --window-overlap seconds, except that the
+last window is moved back to end with the recording. The windows are
+decoded in batches like pre-segmented cuts, with token timestamps, and
+:class:`HypothesisStitcher` merges the hypotheses of each recording: the
+tokens in the overlap of two windows are taken from the first window before
+the middle of the overlap and from the second window after it, where the
+middle is moved to the next word boundary so that no word is split.
+"""
+
+from collections import defaultdict
+from typing import Dict, Iterator, List, Tuple
+
+from detokenizer import Detokenizer
+from lhotse import CutSet
+from lhotse.cut import Cut
+
+
+def cut_into_windows(
+    cuts: CutSet, window_duration: float, window_overlap: float
+) -> CutSet:
+    """Cut each recording into overlapping windows.
+
+    Args:
+      cuts:
+        Cuts of whole recordings, with features.
+      window_duration:
+        Duration of each window in seconds. Only a recording shorter than
+        that gives a shorter window.
+      window_overlap:
+        Overlap of consecutive windows in seconds. The last window of a
+        recording ends at the end of the recording, so that it is not
+        shorter than the others, and may overlap the previous one by more.
+    Returns:
+      Return the windows. Each of them has one supervision without text
+      covering the whole window, as required by K2SpeechRecognitionDataset.
+      Its id is the id of the recording cut with the window index appended.
+    """
+    assert 0 <= window_overlap < window_duration, (window_overlap, window_duration)
+    return CutSet.from_cuts(
+        window
+        for cut in cuts
+        for window in _cut_into_windows(cut, window_duration, window_overlap)
+    )
+
+
+def _cut_into_windows(
+    cut: Cut, window_duration: float, window_overlap: float
+) -> Iterator[Cut]:
+    cut = cut.drop_supervisions()
+    hop = window_duration - window_overlap
+    i = 0
+    offset = 0.0
+    while True:
+        is_last = offset + window_duration >= cut.duration
+        if is_last:
+            # Moved back so that it is not only a few milliseconds long
+            offset = max(0.0, cut.duration - window_duration)
+        duration = min(window_duration, cut.duration - offset)
+        window = cut.truncate(offset=offset, duration=duration)
+        yield window.with_id(f"{cut.id}-{i}").fill_supervision(add_empty=True)
+        if is_last:
+            break
+        offset += hop
+        i += 1
+
+
+def get_references(cuts: CutSet) -> Dict[str, str]:
+    """Return the transcript of each recording, i.e., the text of its
+    supervisions in time order, indexed by recording id."""
+    return {
+        cut.recording_id: " ".join(
+            s.text for s in sorted(cut.supervisions, key=lambda s: s.start)
+        )
+        for cut in cuts
+    }
+
+
+class HypothesisStitcher(object):
+    """Merge the hypotheses of the windows of each recording.
+
+    Usage:
+
+        stitcher = HypothesisStitcher(detokenizer, frame_shift=0.04)
+        for window, hyp, timestamps in ...:
+            stitcher.add(window, hyp, timestamps)
+        hyps = stitcher.stitch_all()
+    """
+
+    def __init__(self, detokenizer: Detokenizer, frame_shift: float):
+        """
+        Args:
+          detokenizer:
+            It tells which tokens start a word.
+          frame_shift:
+            Duration of one output frame of the encoder in seconds.
+        """
+        self.detokenizer = detokenizer
+        self.frame_shift = frame_shift
+        # recording_id -> list of (start, end, token IDs, token times), where
+        # the times are in seconds from the start of the recording
+        self.windows = defaultdict(list)
+
+    def add(self, window: Cut, hyp: List[int], timestamps: List[int]) -> None:
+        """
+        Args:
+          window:
+            A window returned by :func:`cut_into_windows`.
+          hyp:
+            Token IDs decoded from `window`.
+          timestamps:
+            timestamps[i] is the encoder frame on which hyp[i] is emitted,
+            counted from the start of `window`.
+        """
+        assert len(hyp) == len(timestamps), (len(hyp), len(timestamps))
+        times = [window.start + t * self.frame_shift for t in timestamps]
+        self.windows[window.recording_id].append(
+            (window.start, window.end, hyp, times)
+        )
+
+    def stitch(self, recording_id: str) -> List[int]:
+        """Return the token IDs of a whole recording."""
+        windows = sorted(self.windows[recording_id], key=lambda w: w[0])
+
+        ans = []
+        for i, (start, end, hyp, times) in enumerate(windows):
+            begin_idx = 0
+            end_idx = len(hyp)
+            if i > 0:
+                prev_end = windows[i - 1][1]
+                begin_idx = self._split_index(hyp, times, (start + prev_end) / 2)
+            if i + 1 < len(windows):
+                next_start = windows[i + 1][0]
+                end_idx = self._split_index(hyp, times, (next_start + end) / 2)
+            ans.extend(hyp[begin_idx:end_idx])
+        return ans
+
+    def stitch_all(self) -> Dict[str, List[int]]:
+        """Return the token IDs of all recordings, indexed by recording id."""
+        return {
+            recording_id: self.stitch(recording_id) for recording_id in self.windows
+        }
+
+    def _split_index(self, hyp: List[int], times: List[float], t: float) -> int:
+        """Return the index of the first token that starts a word at or after
+        time `t`, or len(hyp) if there is none."""
+        is_word_start = self.detokenizer.is_word_start(hyp)
+        for i, (word_start, time) in enumerate(zip(is_word_start, times)):
+            if word_start and time >= t:
+                return i
+        return len(hyp)
+
+
+def stitched_results(
+    stitcher: HypothesisStitcher,
+    detokenizer: Detokenizer,
+    references: Dict[str, str],
+) -> List[Tuple[str, List[str], List[str]]]:
+    """Return (recording_id, ref_words, hyp_words) for all recordings, in
+    the format of the results of decode_dataset() in ./decode.py."""
+    hyps = stitcher.stitch_all()
+    recording_ids = sorted(hyps)
+    hyp_words = detokenizer.decode_words([hyps[r] for r in recording_ids])
+    return [
+        (r, references[r].split(), words) for r, words in zip(recording_ids, hyp_words)
+    ]
@@ -20,7 +20,7 @@ import inspect
 import logging
 from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, Optional
 
 import torch
 from lhotse import CutSet, Fbank, FbankConfig, load_manifest, load_manifest_lazy
@@ -34,8 +34,8 @@ from lhotse.dataset import (
     SpecAugment,
 )
 from lhotse.dataset.input_strategies import OnTheFlyFeatures
-from lhotse.utils import fix_random_seed
-from torch.utils.data import DataLoader
+from lhotse.utils import compute_num_frames, fix_random_seed
+from torch.utils.data import DataLoader, Sampler
 
 from icefall.utils import str2bool
 
@@ -48,6 +48,91 @@ class _SeedWorkers:
         fix_random_seed(self.seed + worker_id)
 
 
+class LengthSortedDecodeSampler(Sampler):
+    """Sampler of test batches that minimizes padding.
+
+    All cuts are sorted by their number of frames, longest first, and split
+    into batches greedily. A batch is closed when adding the next cut would
+    make the batch size times the number of frames of its first (longest)
+    cut exceed `max_padded_frames`, or the total duration exceed
+    `max_duration`. Compared with bucketing by duration, cuts of a batch
+    have almost the same length, and long cuts get small batches while short
+    cuts get large ones, so that each batch costs about the same to encode.
+
+    Since the cuts of a batch are already sorted by decreasing length, the
+    sort done by pack_padded_sequence() in the search functions of
+    ./beam_search.py is an identity permutation.
+    """
+
+    def __init__(
+        self,
+        cuts: CutSet,
+        max_padded_frames: int,
+        max_duration: Optional[float] = None,
+        frame_shift: float = 0.01,
+    ):
+        """
+        Args:
+          cuts:
+            The cuts to decode. They are all read into memory.
+          max_padded_frames:
+            Maximum of batch size times the number of frames of the longest
+            cut in a batch.
+          max_duration:
+            If not None, maximum total duration of the cuts in a batch.
+          frame_shift:
+            Frame shift of the features in seconds.
+        """
+        cuts = sorted(cuts, key=lambda c: c.duration, reverse=True)
+
+        self.batches = []
+        self.num_frames = 0
+        self.num_padded_frames = 0
+        batch = []
+        batch_frames = 0
+        duration = 0.0
+        for cut in cuts:
+            num_frames = compute_num_frames(
+                cut.duration, frame_shift, cut.sampling_rate
+            )
+            if len(batch) > 0 and (
+                (len(batch) + 1) * batch_frames > max_padded_frames
+                or (max_duration is not None and duration + cut.duration > max_duration)
+            ):
+                self.batches.append(batch)
+                self.num_padded_frames += len(batch) * batch_frames
+                batch = []
+            if len(batch) == 0:
+                batch_frames = num_frames
+                duration = 0.0
+            batch.append(cut)
+            duration += cut.duration
+            self.num_frames += num_frames
+        if len(batch) > 0:
+            self.batches.append(batch)
+            self.num_padded_frames += len(batch) * batch_frames
+
+        logging.info(
+            f"{len(cuts)} cuts in {len(self.batches)} batches, "
+            f"padding efficiency: {self.padding_efficiency:.2%}"
+        )
+
+    @property
+    def padding_efficiency(self) -> float:
+        """Ratio of the number of frames of all cuts to the number of frames
+        of all batches including padding."""
+        if self.num_padded_frames == 0:
+            return 1.0
+        return self.num_frames / self.num_padded_frames
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __iter__(self) -> Iterator[CutSet]:
+        for batch in self.batches:
+            yield CutSet.from_cuts(batch)
+
+
 class MultiVENTAsrDataModule:
     """
     DataModule for k2 ASR experiments.
@@ -91,6 +176,16 @@ class MultiVENTAsrDataModule:
             help="Maximum pooled recordings duration (seconds) in a "
             "single batch. You can reduce it if it causes CUDA OOM.",
         )
+        group.add_argument(
+            "--max-padded-frames",
+            type=int,
+            default=0,
+            help="If positive, test cuts are sorted by length and batched so "
+            "that the batch size times the number of frames of the longest "
+            "cut in the batch, i.e., the number of input frames including "
+            "padding, does not exceed it. --max-duration still applies. "
+            "If 0, the DynamicBucketingSampler is used.",
+        )
         group.add_argument(
             "--bucketing-sampler",
             type=str2bool,
@@ -372,11 +467,18 @@ class MultiVENTAsrDataModule:
             ),
             return_cuts=self.args.return_cuts,
         )
-        sampler = DynamicBucketingSampler(
-            cuts,
-            max_duration=self.args.max_duration,
-            shuffle=False,
-        )
+        if self.args.max_padded_frames > 0:
+            sampler = LengthSortedDecodeSampler(
+                cuts,
+                max_padded_frames=self.args.max_padded_frames,
+                max_duration=self.args.max_duration,
+            )
+        else:
+            sampler = DynamicBucketingSampler(
+                cuts,
+                max_duration=self.args.max_duration,
+                shuffle=False,
+            )
         logging.debug("About to create test dataloader")
         test_dl = DataLoader(
             test,
@@ -407,3 +509,11 @@ class MultiVENTAsrDataModule:
         logging.info("About to get test cuts")
         cuts_test = load_manifest_lazy(self.args.manifest_dir / "multivent_cuts_test_trimmed.jsonl.gz")
         return cuts_test
+
+    @lru_cache()
+    def test_recording_cuts(self) -> CutSet:
+        """Cuts of whole test recordings, i.e., before trim-to-supervisions,
+        used for long-form decoding."""
+        logging.info("About to get test recording cuts")
+        cuts_test = load_manifest_lazy(self.args.manifest_dir / "multivent_cuts_test.jsonl.gz")
+        return cuts_test
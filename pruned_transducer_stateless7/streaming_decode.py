@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This script decodes sound files with a causal Zipformer2 transducer in
+streaming mode, using ./pruned_transducer_stateless7/streaming_recognizer.py,
+and reports its latency and throughput.
+
+The sound files are assigned to --num-streams concurrent streams in a
+round-robin fashion. Audio is fed to all streams in pieces of one chunk
+(chunk_size * 20 ms) and after each piece, the streams that are ready are
+decoded in batches of at most --max-batch-size streams. The time taken to
+decode one chunk of all streams is the latency of that chunk.
+
+Usage:
+
+./pruned_transducer_stateless7/streaming_decode.py \
+    --checkpoint ./pruned_transducer_stateless7/exp/pretrained.pt \
+    --tokens ./data/lang_bpe_500/tokens.txt \
+    --causal 1 \
+    --chunk-size 16 \
+    --left-context-frames 128 \
+    --num-streams 32 \
+    --num-threads 4 \
+    /path/to/foo.wav \
+    /path/to/bar.wav
+"""
+
+import argparse
+import logging
+import time
+from typing import List
+
+import k2
+import torch
+from detokenizer import Detokenizer
+from finetune2 import add_model_arguments, get_model, get_params
+from pretrained import read_sound_files
+from streaming_recognizer import Stream, StreamingRecognizer
+
+from icefall.utils import num_tokens, str2bool
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="Path to the checkpoint. "
+        "The checkpoint is assumed to be saved by "
+        "icefall.checkpoint.save_checkpoint().",
+    )
+
+    parser.add_argument(
+        "--tokens",
+        type=str,
+        help="Path to the tokens.txt.",
+    )
+
+    parser.add_argument(
+        "sound_files",
+        type=str,
+        nargs="+",
+        help="The input sound file(s) to transcribe. "
+        "Supported formats are those supported by torchaudio.load(). "
+        "For example, wav and flac are supported. "
+        "The sample rate has to be 16kHz.",
+    )
+
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=16000,
+        help="The sample rate of the input sound file",
+    )
+
+    parser.add_argument(
+        "--max-sym-per-frame",
+        type=int,
+        default=1,
+        help="Maximum number of symbols per frame of greedy search.",
+    )
+
+    parser.add_argument(
+        "--num-streams",
+        type=int,
+        default=1,
+        help="Number of concurrent streams.",
+    )
+
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=64,
+        help="Maximum number of streams decoded together in one batch.",
+    )
+
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=1,
+        help="Number of intra-op threads when running on CPU.",
+    )
+
+    parser.add_argument(
+        "--use-gpu",
+        type=str2bool,
+        default=False,
+        help="Whether to decode on GPU if it is available.",
+    )
+
+    parser.add_argument(
+        "--show-partial-results",
+        type=str2bool,
+        default=False,
+        help="Whether to log the partial result of each stream after each chunk.",
+    )
+
+    add_model_arguments(parser)
+
+    return parser
+
+
+def decode_ready_streams(
+    recognizer: StreamingRecognizer,
+    streams: List[Stream],
+    max_batch_size: int,
+) -> int:
+    """Decode one chunk of each stream that is ready, in batches of at most
+    `max_batch_size` streams. Return the number of decoded streams."""
+    num_decoded = 0
+    ready = [s for s in streams if s.is_ready(recognizer.chunk_size)]
+    for i in range(0, len(ready), max_batch_size):
+        num_decoded += len(recognizer.decode_streams(ready[i : i + max_batch_size]))
+    return num_decoded
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    params = get_params()
+    params.update(vars(args))
+
+    assert params.causal, "Streaming decoding requires a causal model"
+    assert "," not in params.chunk_size, "chunk_size should be one value"
+    assert (
+        "," not in params.left_context_frames
+    ), "left_context_frames should be one value"
+
+    token_table = k2.SymbolTable.from_file(params.tokens)
+    params.blank_id = token_table["<blk>"]
+    params.unk_id = token_table["<unk>"]
+    params.vocab_size = num_tokens(token_table) + 1  # +1 for <blk>
+
+    logging.info(f"{params}")
+
+    device = torch.device("cpu")
+    if params.use_gpu and torch.cuda.is_available():
+        device = torch.device("cuda", 0)
+    else:
+        torch.set_num_threads(params.num_threads)
+    logging.info(f"device: {device}")
+
+    logging.info("Creating model")
+    model = get_model(params)
+
+    num_param = sum([p.numel() for p in model.parameters()])
+    logging.info(f"Number of model parameters: {num_param}")
+
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    model.load_state_dict(checkpoint["model"], strict=False)
+    model.to(device)
+    model.eval()
+
+    recognizer = StreamingRecognizer(
+        model=model,
+        detokenizer=Detokenizer.from_symbol_table(token_table),
+        chunk_size=int(params.chunk_size),
+        left_context_frames=int(params.left_context_frames),
+        max_sym_per_frame=params.max_sym_per_frame,
+        sample_rate=params.sample_rate,
+        feature_dim=params.feature_dim,
+    )
+
+    logging.info(f"Reading sound files: {params.sound_files}")
+    waves = read_sound_files(
+        filenames=params.sound_files, expected_sample_rate=params.sample_rate
+    )
+    filenames = [
+        params.sound_files[i % len(waves)] for i in range(params.num_streams)
+    ]
+    waves = [waves[i % len(waves)] for i in range(params.num_streams)]
+    streams = [recognizer.create_stream() for _ in waves]
+
+    # Number of samples fed to the streams before each decoding step
+    piece_size = int(params.sample_rate * recognizer.chunk_size * 0.02)
+    num_samples = max(wave.numel() for wave in waves)
+
+    latencies = []
+    num_chunks = 0
+    start_time = time.time()
+    for start in range(0, num_samples + piece_size, piece_size):
+        for stream, wave in zip(streams, waves):
+            if stream.finished:
+                continue
+            if start < wave.numel():
+                stream.accept_waveform(
+                    params.sample_rate, wave[start : start + piece_size]
+                )
+            else:
+                stream.input_finished()
+
+        step_start = time.time()
+        num_decoded = decode_ready_streams(
+            recognizer, streams, max_batch_size=params.max_batch_size
+        )
+        if num_decoded > 0:
+            latencies.append(time.time() - step_start)
+            num_chunks += num_decoded
+
+        if params.show_partial_results and num_decoded > 0:
+            for i, stream in enumerate(streams):
+                logging.info(f"{i}: {recognizer.get_result(stream)}")
+
+    # Flush the tail padding of all streams
+    while True:
+        step_start = time.time()
+        num_decoded = decode_ready_streams(
+            recognizer, streams, max_batch_size=params.max_batch_size
+        )
+        if num_decoded == 0:
+            break
+        latencies.append(time.time() - step_start)
+        num_chunks += num_decoded
+    elapsed = time.time() - start_time
+
+    s = "\n"
+    for filename, stream in zip(filenames, streams):
+        s += f"{filename}:\n{recognizer.get_result(stream)}\n\n"
+    logging.info(s)
+
+    audio_duration = sum(wave.numel() for wave in waves) / params.sample_rate
+    chunk_duration = recognizer.chunk_size * 0.02
+    latencies = torch.tensor(latencies)
+    logging.info(
+        f"Decoded {num_chunks} chunks of {chunk_duration:.2f} s from "
+        f"{params.num_streams} streams, audio duration: {audio_duration:.2f} s, "
+        f"elapsed: {elapsed:.2f} s, RTF: {elapsed / audio_duration:.4f}, "
+        f"throughput: {num_chunks / elapsed:.2f} chunks/s"
+    )
+    logging.info(
+        f"Latency per step (ms): mean {latencies.mean() * 1000:.1f}, "
+        f"p50 {latencies.quantile(0.5) * 1000:.1f}, "
+        f"p90 {latencies.quantile(0.9) * 1000:.1f}, "
+        f"max {latencies.max() * 1000:.1f}"
+    )
+    if latencies.max() > chunk_duration:
+        logging.warning(
+            "Some steps took longer than one chunk of audio; "
+            "decoding is slower than real time"
+        )
+
+    logging.info("Decoding Done")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -0,0 +1,388 @@
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming recognition with a causal Zipformer2 transducer.
+
+A :class:`StreamingRecognizer` serves many :class:`Stream` objects. Audio
+is fed to each stream as it arrives and converted to features with an
+online fbank. Each call to :meth:`StreamingRecognizer.decode_streams` takes
+one chunk of features from every stream that has enough of them, stacks the
+encoder states of these streams, runs :meth:`Zipformer2.streaming_forward`
+once for the whole batch and continues the greedy search of each stream
+from its last tokens. The partial result of a stream is available at any
+time with :meth:`StreamingRecognizer.get_result`.
+
+Usage:
+
+    recognizer = StreamingRecognizer(model, detokenizer, chunk_size=16)
+    stream = recognizer.create_stream()
+    stream.accept_waveform(16000, samples)
+    while recognizer.decode_streams([stream]):
+        print(recognizer.get_result(stream))
+    stream.input_finished()
+    while recognizer.decode_streams([stream]):
+        pass
+    print(recognizer.get_result(stream))
+"""
+
+import math
+from typing import List, Optional, Tuple
+
+import kaldifeat
+import torch
+from beam_search import greedy_search_batch_multi_sym
+from decoder_cache import DecoderOutputCache
+from detokenizer import Detokenizer
+from torch import nn
+
+from icefall.utils import make_pad_mask
+
+LOG_EPS = math.log(1e-10)
+
+# Number of feature frames consumed by the encoder_embed on top of
+# 2 * chunk_size: 7 for the Conv2dSubsampling and 2 * 3 for the right
+# padding of its ConvNeXt module.
+PAD_LENGTH = 7 + 2 * 3
+
+# Number of frames of silence appended to a stream once its input is
+# finished, so that the last tokens are emitted.
+TAIL_PAD_LENGTH = 30
+
+
+def stack_states(state_list: List[List[torch.Tensor]]) -> List[torch.Tensor]:
+    """Stack the states of several streams into the states of a batch.
+
+    Args:
+      state_list:
+        state_list[i] contains the states of the i-th stream, as returned by
+        :meth:`StreamingRecognizer.get_init_states`.
+    Returns:
+      Return the states of the batch. For each encoder layer, there are 6
+      tensors (cached_key, cached_nonlin_attn, cached_val1, cached_val2,
+      cached_conv1, cached_conv2), followed by the cached left padding of
+      the encoder_embed and the number of processed frames.
+    """
+    assert (len(state_list[0]) - 2) % 6 == 0, len(state_list[0])
+    num_states = len(state_list[0])
+    return [
+        torch.cat([states[i] for states in state_list], dim=_batch_dim(i, num_states))
+        for i in range(num_states)
+    ]
+
+
+def unstack_states(batch_states: List[torch.Tensor]) -> List[List[torch.Tensor]]:
+    """Inverse of :func:`stack_states`."""
+    batch_size = batch_states[-1].size(0)
+    num_states = len(batch_states)
+    state_list = [[] for _ in range(batch_size)]
+    for i, state in enumerate(batch_states):
+        for n, s in enumerate(state.chunk(batch_size, dim=_batch_dim(i, num_states))):
+            state_list[n].append(s)
+    return state_list
+
+
+def _batch_dim(i: int, num_states: int) -> int:
+    """Return the batch dimension of the i-th of `num_states` states."""
+    if i >= num_states - 2:
+        # cached_embed_left_pad and processed_lens
+        return 0
+    # cached_key, cached_nonlin_attn, cached_val1 and cached_val2 have the
+    # batch in dim 1, cached_conv1 and cached_conv2 in dim 0.
+    return 1 if i % 6 < 4 else 0
+
+
+class Stream(object):
+    """The state of one utterance being recognized."""
+
+    def __init__(
+        self,
+        fbank_opts: kaldifeat.FbankOptions,
+        initial_states: List[torch.Tensor],
+        context: List[int],
+    ):
+        """
+        Args:
+          fbank_opts:
+            Options of the online fbank.
+          initial_states:
+            Initial states of the encoder for this stream.
+          context:
+            The initial decoder context.
+        """
+        self.online_fbank = kaldifeat.OnlineFbank(fbank_opts)
+        self.states = initial_states
+        self.context_size = len(context)
+        self.hyp = list(context)
+        # timestamps[i] is the frame index after subsampling on which the
+        # i-th decoded token is emitted
+        self.timestamps = []
+
+        # Features that are ready but not yet fully consumed. The first
+        # row is frame `num_processed_frames` of the utterance.
+        self.features = torch.empty(0, fbank_opts.mel_opts.num_bins)
+        self.num_fetched_frames = 0
+        self.num_processed_frames = 0
+        self.num_encoder_frames = 0
+        self.finished = False
+        self.done = False
+
+    def accept_waveform(self, sample_rate: float, samples: torch.Tensor) -> None:
+        """Feed audio to the stream.
+
+        Args:
+          sample_rate:
+            Sample rate of `samples`.
+          samples:
+            A 1-D float32 tensor of audio samples normalized to [-1, 1].
+        """
+        assert not self.finished
+        self.online_fbank.accept_waveform(sample_rate, samples)
+        self._fetch_features()
+
+    def input_finished(self) -> None:
+        """Signal that no more audio will be fed to the stream."""
+        self.online_fbank.input_finished()
+        self._fetch_features()
+        tail = torch.full(
+            (PAD_LENGTH + TAIL_PAD_LENGTH, self.features.size(1)), LOG_EPS
+        )
+        self.features = torch.cat([self.features, tail])
+        self.finished = True
+
+    def _fetch_features(self) -> None:
+        num_frames_ready = self.online_fbank.num_frames_ready
+        if num_frames_ready == self.num_fetched_frames:
+            return
+        frames = [
+            self.online_fbank.get_frame(i)
+            for i in range(self.num_fetched_frames, num_frames_ready)
+        ]
+        self.features = torch.cat([self.features] + frames)
+        self.num_fetched_frames = num_frames_ready
+
+    def is_ready(self, chunk_size: int) -> bool:
+        """Return True if a chunk can be decoded. `chunk_size` is the number
+        of frames after the encoder_embed, i.e., 2 * chunk_size feature
+        frames are consumed per chunk."""
+        if self.done:
+            return False
+        if self.finished:
+            return self.features.size(0) > 0
+        return self.features.size(0) >= 2 * chunk_size + PAD_LENGTH
+
+    def get_feature_frames(self, chunk_size: int) -> torch.Tensor:
+        """Return the features of the next chunk and consume them. The last
+        chunk of a finished stream may be shorter than the others."""
+        features = self.features[: 2 * chunk_size + PAD_LENGTH]
+        self.features = self.features[2 * chunk_size :]
+        self.num_processed_frames += 2 * chunk_size
+        if self.finished and self.features.size(0) <= PAD_LENGTH:
+            self.features = self.features[:0]
+            self.done = True
+        return features
+
+
+class StreamingRecognizer(object):
+    """Batched streaming recognition with greedy search. See the docstring
+    of this module for its usage."""
+
+    def __init__(
+        self,
+        model: nn.Module,
+        detokenizer: Detokenizer,
+        chunk_size: int = 16,
+        left_context_frames: int = 128,
+        max_sym_per_frame: int = 1,
+        decoder_cache: Optional[DecoderOutputCache] = None,
+        sample_rate: float = 16000,
+        feature_dim: int = 80,
+    ):
+        """
+        Args:
+          model:
+            A transducer model with a causal :class:`Zipformer2` encoder and
+            a :class:`Conv2dSubsampling` encoder_embed, e.g., an
+            :class:`AsrModel` from ./model2.py.
+          detokenizer:
+            Converts token IDs to text.
+          chunk_size:
+            Chunk size in frames after the encoder_embed, i.e., at 50 Hz.
+          left_context_frames:
+            Number of frames of left context, at 50 Hz.
+          max_sym_per_frame:
+            Maximum number of symbols per frame of greedy search.
+          decoder_cache:
+            If it is a :class:`DecoderOutputTable`, greedy search looks up
+            decoder outputs in it. See :func:`greedy_search_batch_multi_sym`.
+          sample_rate:
+            Sample rate of the audio.
+          feature_dim:
+            Number of fbank bins.
+        """
+        self.model = model
+        self.detokenizer = detokenizer
+        self.chunk_size = chunk_size
+        self.left_context_frames = left_context_frames
+        self.max_sym_per_frame = max_sym_per_frame
+        self.decoder_cache = decoder_cache
+        self.device = next(model.parameters()).device
+
+        # Zipformer2.streaming_forward() reads them from the encoder
+        model.encoder.chunk_size = [chunk_size]
+        model.encoder.left_context_frames = [left_context_frames]
+
+        opts = kaldifeat.FbankOptions()
+        opts.device = torch.device("cpu")
+        opts.frame_opts.dither = 0
+        opts.frame_opts.snip_edges = False
+        opts.frame_opts.samp_freq = sample_rate
+        opts.mel_opts.num_bins = feature_dim
+        self.fbank_opts = opts
+
+        context_size = model.decoder.context_size
+        self.initial_context = [-1] * (context_size - 1) + [model.decoder.blank_id]
+
+    def get_init_states(self) -> List[torch.Tensor]:
+        """Return the initial states of one stream."""
+        states = self.model.encoder.get_init_states(1, self.device)
+        states.append(self.model.encoder_embed.get_init_states(1, self.device))
+        states.append(torch.zeros(1, dtype=torch.int32, device=self.device))
+        return states
+
+    def create_stream(self) -> Stream:
+        return Stream(
+            self.fbank_opts,
+            initial_states=self.get_init_states(),
+            context=self.initial_context,
+        )
+
+    def streaming_forward(
+        self,
+        features: torch.Tensor,
+        feature_lens: torch.Tensor,
+        states: List[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        """Run the encoder on one chunk of a batch of streams.
+
+        Args:
+          features:
+            A 3-D tensor of shape (N, 2 * chunk_size + PAD_LENGTH, C).
+          feature_lens:
+            A 1-D tensor of shape (N,).
+          states:
+            The stacked states of the N streams.
+        Returns:
+          Return a tuple containing:
+            - encoder_out, of shape (N, chunk_size // 2, encoder_dim)
+            - encoder_out_lens, of shape (N,)
+            - the updated states
+        """
+        cached_embed_left_pad = states[-2]
+        x, x_lens, new_cached_embed_left_pad = (
+            self.model.encoder_embed.streaming_forward(
+                x=features,
+                x_lens=feature_lens,
+                cached_left_pad=cached_embed_left_pad,
+            )
+        )
+        assert x.size(1) == self.chunk_size, (x.size(1), self.chunk_size)
+
+        # Mask out the left context that has not been filled yet
+        processed_lens = states[-1]  # (N,)
+        processed_mask = torch.arange(
+            self.left_context_frames, device=x.device
+        ).expand(x.size(0), self.left_context_frames)
+        processed_mask = (processed_lens.unsqueeze(1) <= processed_mask).flip(1)
+        new_processed_lens = processed_lens + x_lens
+
+        src_key_padding_mask = make_pad_mask(x_lens)
+        src_key_padding_mask = torch.cat([processed_mask, src_key_padding_mask], dim=1)
+
+        x = x.permute(1, 0, 2)  # (N, T, C) -> (T, N, C)
+        encoder_out, encoder_out_lens, new_encoder_states = (
+            self.model.encoder.streaming_forward(
+                x=x,
+                x_lens=x_lens,
+                states=states[:-2],
+                src_key_padding_mask=src_key_padding_mask,
+            )
+        )
+        encoder_out = encoder_out.permute(1, 0, 2)  # (T, N, C) -> (N, T, C)
+
+        new_states = new_encoder_states + [
+            new_cached_embed_left_pad,
+            new_processed_lens,
+        ]
+        return encoder_out, encoder_out_lens, new_states
+
+    @torch.no_grad()
+    def decode_streams(self, streams: List[Stream]) -> List[Stream]:
+        """Decode one chunk of each stream in `streams` that is ready, as a
+        single batch.
+
+        Returns:
+          Return the streams that were decoded.
+        """
+        streams = [s for s in streams if s.is_ready(self.chunk_size)]
+        if len(streams) == 0:
+            return streams
+
+        # The last chunk of a stream is padded with silence, the same as its
+        # tail padding, so that the result of a stream does not depend on
+        # the other streams in the batch.
+        chunk_length = 2 * self.chunk_size + PAD_LENGTH
+        features = [s.get_feature_frames(self.chunk_size) for s in streams]
+        features = torch.stack(
+            [
+                nn.functional.pad(f, (0, 0, 0, chunk_length - f.size(0)), value=LOG_EPS)
+                for f in features
+            ]
+        ).to(self.device)
+        feature_lens = torch.full(
+            (len(streams),), chunk_length, dtype=torch.int64, device=self.device
+        )
+
+        states = stack_states([s.states for s in streams])
+        encoder_out, encoder_out_lens, states = self.streaming_forward(
+            features, feature_lens, states
+        )
+
+        results = greedy_search_batch_multi_sym(
+            model=self.model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            max_sym_per_frame=self.max_sym_per_frame,
+            return_timestamps=True,
+            decoder_cache=self.decoder_cache,
+            initial_contexts=torch.tensor(
+                [s.hyp[-s.context_size :] for s in streams], device=self.device
+            ),
+        )
+
+        for stream, stream_states, hyp, timestamps in zip(
+            streams, unstack_states(states), results.hyps, results.timestamps
+        ):
+            stream.states = stream_states
+            stream.hyp.extend(hyp)
+            stream.timestamps.extend(t + stream.num_encoder_frames for t in timestamps)
+            stream.num_encoder_frames += encoder_out.size(1)
+
+        return streams
+
+    def get_result(self, stream: Stream) -> str:
+        """Return the text decoded so far from `stream`."""
+        return self.detokenizer.decode([stream.hyp[stream.context_size :]])[0]
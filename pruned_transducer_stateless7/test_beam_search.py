@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    python ./pruned_transducer_stateless7/test_beam_search.py
+"""
+
+import k2
+import torch
+from beam_search import (
+    Hypothesis,
+    HypothesisList,
+    fast_beam_search_one_best,
+    greedy_search,
+    greedy_search_batch,
+    greedy_search_batch_multi_sym,
+    modified_beam_search,
+    modified_beam_search_tensorized,
+)
+from decoder import Decoder
+from decoder_cache import DecoderOutputCache
+from joiner import Joiner
+from torch import nn
+
+
+class TinyTransducer(nn.Module):
+    """The decoder and the joiner of a transducer, which is all the greedy
+    search needs."""
+
+    def __init__(self, vocab_size: int, encoder_dim: int, context_size: int):
+        super().__init__()
+        self.decoder = Decoder(
+            vocab_size=vocab_size,
+            decoder_dim=16,
+            blank_id=0,
+            context_size=context_size,
+        )
+        self.joiner = Joiner(
+            encoder_dim=encoder_dim,
+            decoder_dim=16,
+            joiner_dim=16,
+            vocab_size=vocab_size,
+        )
+
+
+def get_random_batch(seed: int, blank_bias: float):
+    torch.manual_seed(seed)
+    model = TinyTransducer(vocab_size=12, encoder_dim=8, context_size=2)
+    model.eval()
+    with torch.no_grad():
+        model.joiner.output_linear.bias[0] += blank_bias
+
+    N, T = 6, 30
+    encoder_out = torch.randn(N, T, 8) * 2
+    encoder_out_lens = torch.randint(1, T + 1, (N,))
+    encoder_out_lens[0] = T
+    return model, encoder_out, encoder_out_lens
+
+
+@torch.no_grad()
+def test_greedy_search_batch_multi_sym():
+    for seed in range(6):
+        # A negative bias on blank makes several symbols per frame likely
+        model, encoder_out, encoder_out_lens = get_random_batch(
+            seed, blank_bias=-(seed % 3)
+        )
+        for max_sym_per_frame in [1, 2, 3]:
+            results = greedy_search_batch_multi_sym(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                max_sym_per_frame=max_sym_per_frame,
+                return_timestamps=True,
+                check_interval=1 + seed % 4,
+            )
+            for i in range(encoder_out.size(0)):
+                expected = greedy_search(
+                    model=model,
+                    encoder_out=encoder_out[i : i + 1, : encoder_out_lens[i]],
+                    max_sym_per_frame=max_sym_per_frame,
+                    return_timestamps=True,
+                )
+                assert results.hyps[i] == expected.hyps[0], (seed, i)
+                assert results.timestamps[i] == expected.timestamps[0], (seed, i)
+
+            # An LRU cache is ignored by the batched search
+            hyps = greedy_search_batch_multi_sym(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                max_sym_per_frame=max_sym_per_frame,
+                decoder_cache=DecoderOutputCache(model),
+            )
+            assert hyps == results.hyps, seed
+
+            if max_sym_per_frame == 1:
+                hyps = greedy_search_batch(
+                    model=model,
+                    encoder_out=encoder_out,
+                    encoder_out_lens=encoder_out_lens,
+                )
+                assert hyps == results.hyps, seed
+
+
+@torch.no_grad()
+def test_modified_beam_search_tensorized():
+    for seed in range(6):
+        model, encoder_out, encoder_out_lens = get_random_batch(
+            seed, blank_bias=seed % 3
+        )
+        for beam in [1, 2, 4, 8]:
+            expected = modified_beam_search(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=beam,
+                return_timestamps=True,
+            )
+            results = modified_beam_search_tensorized(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=beam,
+                return_timestamps=True,
+            )
+            assert results.hyps == expected.hyps, (seed, beam)
+            assert results.timestamps == expected.timestamps, (seed, beam)
+
+
+@torch.no_grad()
+def test_fast_beam_search_one_best():
+    for seed in range(3):
+        model, encoder_out, encoder_out_lens = get_random_batch(
+            seed, blank_bias=seed % 3
+        )
+        decoding_graph = k2.trivial_graph(model.decoder.vocab_size - 1)
+        kwargs = dict(
+            model=model,
+            decoding_graph=decoding_graph,
+            beam=4,
+            max_states=32,
+            max_contexts=8,
+            return_timestamps=True,
+        )
+        # Utterances that end earlier must not be changed by the frames
+        # decoded for the longer ones
+        results = fast_beam_search_one_best(
+            encoder_out=encoder_out, encoder_out_lens=encoder_out_lens, **kwargs
+        )
+        for i in range(encoder_out.size(0)):
+            expected = fast_beam_search_one_best(
+                encoder_out=encoder_out[i : i + 1, : encoder_out_lens[i]],
+                encoder_out_lens=encoder_out_lens[i : i + 1],
+                **kwargs,
+            )
+            assert results.hyps[i] == expected.hyps[0], (seed, i)
+            assert results.timestamps[i] == expected.timestamps[0], (seed, i)
+
+
+def test_hypothesis_list_hash_collision():
+    def make_hyp(ys, log_prob):
+        hyp = Hypothesis(ys=ys, log_prob=torch.tensor([log_prob]))
+        # Give all hypotheses the same key
+        hyp.node.hash = 7
+        return hyp
+
+    a = make_hyp([1, 2, 3], 0.0)
+    b = make_hyp([4, 5, 6], -1.0)
+    c = make_hyp([7, 8, 9], -2.0)
+    hyps = HypothesisList()
+    for hyp in [a, b, c]:
+        hyps.add(hyp)
+    assert len(hyps) == 3, str(hyps)
+
+    # Only the hypothesis with the same tokens is merged
+    hyps.add(make_hyp([4, 5, 6], -1.0))
+    assert len(hyps) == 3, str(hyps)
+    expected = torch.logaddexp(torch.tensor(-1.0), torch.tensor(-1.0))
+    assert torch.allclose(b.log_prob, expected), b.log_prob
+
+    assert hyps.topk(2).get_most_probable().ys == [1, 2, 3]
+    assert [hyp.ys for hyp in hyps.topk(1)] == [[1, 2, 3]]
+
+    hyps.remove(a)
+    hyps.remove(c)
+    assert [hyp.ys for hyp in hyps] == [[4, 5, 6]]
+    hyps.remove(b)
+    assert len(hyps) == 0
+
+
+def main():
+    test_greedy_search_batch_multi_sym()
+    test_modified_beam_search_tensorized()
+    test_fast_beam_search_one_best()
+    test_hypothesis_list_hash_collision()
+
+
+if __name__ == "__main__":
+    main()
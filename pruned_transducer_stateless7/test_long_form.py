@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Copyright 2024 Johns Hopkins University (author: Dongji Gao)
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    python ./pruned_transducer_stateless7/test_long_form.py
+"""
+
+from detokenizer import Detokenizer
+from long_form import HypothesisStitcher, _cut_into_windows, stitched_results
+
+
+class FakeCut(object):
+    """The attributes and methods of a cut that are used by
+    _cut_into_windows() and HypothesisStitcher."""
+
+    def __init__(self, id: str, start: float, duration: float):
+        self.id = id
+        self.recording_id = "rec"
+        self.start = start
+        self.duration = duration
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+    def drop_supervisions(self) -> "FakeCut":
+        return self
+
+    def truncate(self, offset: float, duration: float) -> "FakeCut":
+        return FakeCut(self.id, self.start + offset, duration)
+
+    def with_id(self, id: str) -> "FakeCut":
+        return FakeCut(id, self.start, self.duration)
+
+    def fill_supervision(self, add_empty: bool) -> "FakeCut":
+        return self
+
+
+def test_cut_into_windows():
+    for duration, overlap in [(25.0, 2.0), (20.005, 0.0), (30.0, 0.0), (6.0, 2.0)]:
+        cut = FakeCut("rec", start=0.0, duration=duration)
+        windows = list(_cut_into_windows(cut, 10.0, overlap))
+
+        assert [w.id for w in windows] == [f"rec-{i}" for i in range(len(windows))]
+        assert windows[0].start == 0, duration
+        assert abs(windows[-1].end - duration) < 1e-6, duration
+        for prev, cur in zip(windows[:-1], windows[1:]):
+            assert cur.start <= prev.end - overlap + 1e-6, duration
+        # The last window is as long as the others
+        for w in windows:
+            assert abs(w.duration - min(10.0, duration)) < 1e-6, duration
+
+
+def test_hypothesis_stitcher():
+    # Tokens 1, 3 and 4 start a word
+    detokenizer = Detokenizer([b"", b" a", b"b", b" c", b" d", b"e"])
+    stitcher = HypothesisStitcher(detokenizer, frame_shift=0.5)
+
+    # The windows overlap from 8 to 10 seconds. The word "cb" starts before
+    # the middle of the overlap and ends after it, so it is taken from the
+    # first window as a whole.
+    stitcher.add(
+        FakeCut("rec-1", start=8.0, duration=10.0),
+        hyp=[3, 2, 4, 5],
+        timestamps=[0, 3, 6, 10],
+    )
+    stitcher.add(
+        FakeCut("rec-0", start=0.0, duration=10.0),
+        hyp=[1, 3, 2],
+        timestamps=[2, 16, 19],
+    )
+    assert stitcher.stitch("rec") == [1, 3, 2, 4, 5], stitcher.stitch("rec")
+
+    results = stitched_results(stitcher, detokenizer, {"rec": "a cb de"})
+    assert results == [("rec", ["a", "cb", "de"], ["a", "cb", "de"])], results
+
+
+def main():
+    test_cut_into_windows()
+    test_hypothesis_stitcher()
+
+
+if __name__ == "__main__":
+    main()